@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional
+
+# DATABASES["default"] を環境変数から組み立てる（config.settings から使う）。
+#
+# DB_ENGINE=sqlite（既定）
+#   SQLITE_PROFILE=tuned（既定）: 接続ごとに WAL / synchronous=NORMAL / cache_size / mmap を設定し、
+#     busy timeout を長めにして、書き込みトランザクションは BEGIN IMMEDIATE で始める
+#     （読み取りから書き込みへの昇格で busy_timeout を待たずに "database is locked" になるのを防ぐ）
+#   SQLITE_PROFILE=default: Django の既定のまま（ロールバックジャーナル、timeout 5秒）
+#   SQLITE_BUSY_TIMEOUT（秒）/ SQLITE_CACHE_SIZE_KB / SQLITE_MMAP_SIZE で調整できる
+#
+# DB_ENGINE=postgres
+#   POSTGRES_DB / POSTGRES_USER / POSTGRES_PASSWORD / POSTGRES_HOST / POSTGRES_PORT
+#   POSTGRES_POOL=1: psycopg のコネクションプール（要 psycopg[pool]）。POSTGRES_POOL_MIN / POSTGRES_POOL_MAX
+#   POSTGRES_POOL=0: 永続接続（CONN_MAX_AGE 秒使い回し、使う前にヘルスチェック）
+
+SQLITE_PROFILES = ("tuned", "default")
+
+
+def sqlite_options(
+    profile: str = "tuned",
+    busy_timeout: float = 20.0,
+    cache_size_kb: int = 65536,
+    mmap_size: int = 256 * 1024 * 1024,
+) -> Dict[str, Any]:
+    """
+    SQLite の OPTIONS。init_command は接続を作るたびに ; 区切りで1文ずつ実行される。
+    """
+    if profile == "default":
+        return {}
+    if profile != "tuned":
+        raise ValueError(f"unknown SQLITE_PROFILE: {profile!r} (expected one of {SQLITE_PROFILES})")
+    pragmas = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",  # WAL なら NORMAL でもコミット済みデータは壊れない（電源断で直近が消えうるだけ）
+        f"PRAGMA cache_size=-{int(cache_size_kb)}",  # 負の値は KiB 単位
+        f"PRAGMA mmap_size={int(mmap_size)}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    return {
+        "timeout": float(busy_timeout),
+        "transaction_mode": "IMMEDIATE",
+        "init_command": ";".join(pragmas),
+    }
+
+
+def _int(env: Mapping[str, str], name: str, default: int) -> int:
+    v = env.get(name, "")
+    return int(v) if v.strip() else default
+
+
+def _float(env: Mapping[str, str], name: str, default: float) -> float:
+    v = env.get(name, "")
+    return float(v) if v.strip() else default
+
+
+def _flag(env: Mapping[str, str], name: str, default: bool = False) -> bool:
+    v = env.get(name, "").strip().lower()
+    if not v:
+        return default
+    return v in ("1", "true", "yes", "on")
+
+
+def database_from_env(base_dir: Path, env: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+    env = os.environ if env is None else env
+    engine = env.get("DB_ENGINE", "sqlite").strip().lower() or "sqlite"
+
+    if engine == "sqlite":
+        return {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": env.get("SQLITE_PATH") or base_dir / "db.sqlite3",
+            "OPTIONS": sqlite_options(
+                env.get("SQLITE_PROFILE", "tuned").strip().lower() or "tuned",
+                busy_timeout=_float(env, "SQLITE_BUSY_TIMEOUT", 20.0),
+                cache_size_kb=_int(env, "SQLITE_CACHE_SIZE_KB", 65536),
+                mmap_size=_int(env, "SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+            ),
+        }
+
+    if engine in ("postgres", "postgresql"):
+        db: Dict[str, Any] = {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": env.get("POSTGRES_DB", "musictype"),
+            "USER": env.get("POSTGRES_USER", "postgres"),
+            "PASSWORD": env.get("POSTGRES_PASSWORD", ""),
+            "HOST": env.get("POSTGRES_HOST", "localhost"),
+            "PORT": env.get("POSTGRES_PORT", "5432"),
+            "OPTIONS": {},
+        }
+        if _flag(env, "POSTGRES_POOL"):
+            # プールを使うときは CONN_MAX_AGE は 0 のまま（Django がそう要求する）
+            db["OPTIONS"]["pool"] = {
+                "min_size": _int(env, "POSTGRES_POOL_MIN", 2),
+                "max_size": _int(env, "POSTGRES_POOL_MAX", 10),
+                "timeout": _float(env, "POSTGRES_POOL_TIMEOUT", 10.0),
+            }
+        else:
+            db["CONN_MAX_AGE"] = _int(env, "CONN_MAX_AGE", 60)
+            db["CONN_HEALTH_CHECKS"] = True
+        return db
+
+    raise ValueError(f"unknown DB_ENGINE: {engine!r} (expected sqlite or postgres)")
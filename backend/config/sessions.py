@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+# SESSION_MODE（環境変数）-> SESSION_ENGINE（config.settings から使う）
+#   db            : django_session テーブル（Django の既定）
+#   cached_db     : 読むのはキャッシュから、書くときは DB とキャッシュの両方（消えない）
+#   cache         : キャッシュだけ（DB に触らない。キャッシュが消えるとログアウトされる）
+#   signed_cookies: 署名付き Cookie に全部入れる（サーバ側の保存なし。中身はクライアントから読める）
+# cache / cached_db は CACHES["sessions"] を使う。既定は LocMemCache（プロセスごと）なので、
+# 複数プロセスで動かすときは共有キャッシュ（Redis / Memcached）に向けるか signed_cookies にする。
+
+SESSION_ENGINES = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "cache": "django.contrib.sessions.backends.cache",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+}
+
+
+def session_engine(mode: str) -> str:
+    mode = (mode or "db").strip().lower()
+    if mode not in SESSION_ENGINES:
+        raise ValueError(f"unknown SESSION_MODE: {mode!r} (expected one of {', '.join(SESSION_ENGINES)})")
+    return SESSION_ENGINES[mode]
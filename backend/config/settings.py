@@ -48,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.profiling.ProfilingMiddleware',
+    'core.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,13 +82,37 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# 環境変数で SQLite（WAL などのチューニング付き）/ Postgres（永続接続 or プール）を選ぶ (config.db)
+from .db import database_from_env  # noqa: E402
+
 DATABASES = {
+    'default': database_from_env(BASE_DIR),
+}
+
+
+# Cache / Session
+# SESSION_MODE: db（既定）/ cached_db / cache / signed_cookies (config.sessions)
+from .sessions import session_engine  # noqa: E402
+
+# 複数プロセスで動かすときは REDIS_URL を設定して default を共有キャッシュにする
+# （結果ページのキャッシュの invalidate が全プロセスに届くように。core.result_cache）
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    } if not os.environ.get("REDIS_URL") else {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ["REDIS_URL"],
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
 }
 
+SESSION_ENGINE = session_engine(os.environ.get("SESSION_MODE", "db"))
+SESSION_CACHE_ALIAS = 'sessions'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -123,3 +149,161 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# Outbound HTTP (core.http_client)
+HTTP_CLIENT = {
+    "pool_sizes": {
+        "https://accounts.spotify.com": 4,
+        "https://api.spotify.com": 20,
+    },
+    "default_pool_size": 10,
+    "retries": 3,
+    "backoff_factor": 0.3,
+    # Retry-After がこれより長くても、この秒数だけ待って送り直す
+    "max_retry_after": 10,
+}
+
+# /api/tracks/search の結果キャッシュ (core.search_cache)
+# BACKEND: "local"（プロセス内 LRU）または "django"（CACHES[CACHE_ALIAS] を使う）
+SEARCH_CACHE = {
+    "BACKEND": "local",
+    "TTL": 300,
+    "MAX_ENTRIES": 1024,
+    "CACHE_ALIAS": "default",
+    # TTL 後もこの秒数は残し、upstream が落ちているときの代わりに返す
+    "STALE_TTL": 86400,
+}
+
+# upstream（iTunes 検索）のサーキットブレーカー (core.circuit_breaker)
+# 失敗か SLOW_CALL_SEC 超えが FAILURE_THRESHOLD 回続いたら OPEN_SEC の間は呼ばずに古いキャッシュを返す
+CIRCUIT_BREAKER = {
+    "ENABLED": True,
+    "FAILURE_THRESHOLD": 5,
+    "SLOW_CALL_SEC": 3.0,
+    "OPEN_SEC": 30,
+    # half_open の試しが結果を報告しないままこの秒数経ったら、別のリクエストに試し直させる
+    "PROBE_TIMEOUT_SEC": 60,
+}
+
+# /api/tracks/search のローカル曲カタログ (core.track_catalog)
+# iTunes から返ってきた曲を貯めて、MIN_RESULTS 件以上ローカルで見つかれば upstream に行かない
+TRACK_CATALOG = {
+    "ENABLED": True,
+    "MIN_RESULTS": 10,
+    "MAX_TRACKS": 200000,
+    # 起動時に DB から索引を作る（config.wsgi / config.asgi から core.warmup）
+    "BUILD_AT_STARTUP": True,
+    # 他のワーカーが足した曲をこの秒数ごとに読み足す
+    "RELOAD_SEC": 60,
+}
+
+# /api/result/<username> のレンダリング済みキャッシュと HTTP キャッシュヘッダ (core.result_cache)
+RESULT_CACHE = {
+    "CACHE_ALIAS": "default",
+    "TIMEOUT": 3600,
+    # CACHE_ALIAS がプロセス内キャッシュ（LocMem）のときの TTL（他プロセスの invalidate が届かないので短く）
+    "LOCAL_TIMEOUT": 5,
+    "MAX_AGE": 60,
+    "S_MAXAGE": 300,
+    "STALE_WHILE_REVALIDATE": 600,
+}
+
+# Spotify 診断で使う top_tracks の time_range（複数指定すると並列に取って重複を除く）
+# 例: ["short_term", "medium_term", "long_term"]
+SPOTIFY_TOP_TIME_RANGES = ["medium_term"]
+# top_tracks / audio_features（100件ずつ）を並列に取るときの最大同時数
+SPOTIFY_FETCH_WORKERS = 4
+
+# Spotify access token を期限の何秒前からバックグラウンド更新するか (core.tokens)
+SPOTIFY_TOKEN_REFRESH_AHEAD = 300
+
+# Spotify 診断のバックグラウンドジョブ (core.jobs, /api/diagnose/jobs)
+# MODE: "local"（このプロセスのスレッドプールで実行）または "db"（manage.py run_diagnosis_jobs が実行）
+DIAGNOSIS_JOBS = {
+    "MODE": "local",
+    "WORKERS": 4,
+    "MAX_ATTEMPTS": 3,
+    "RETRY_BACKOFF": 2.0,  # 秒。attempt ごとに倍
+    "STALE_AFTER": 300,  # 秒。running のままこれだけ更新が無いジョブは止まったと見なして積み直す
+    "SWEEP_AT_STARTUP": True,  # local モード: 起動時に DB に残ったジョブを拾い直す
+    "SSE_POLL_INTERVAL": 0.5,
+    "SSE_TIMEOUT": 60,
+}
+
+# /api/result/<username>/similar の近傍インデックス (core.similar)
+# CELLS: グリッドの各軸の分割数（None ならユーザー数から自動）
+SIMILAR_INDEX = {
+    "CELLS": None,
+    "DEFAULT_K": 10,
+    "MAX_K": 50,
+    # CELLS が None のとき、人数が前回のセル分けのこの倍数になったら分割数を見直す
+    "REBUILD_GROWTH": 2.0,
+    # 起動時に DB から作る（config.wsgi / config.asgi から core.warmup）
+    "BUILD_AT_STARTUP": True,
+}
+
+# DiagnosisResult のまとめ書き (core.write_behind)
+# 有効にすると結果はメモリに積まれ、MAX_ROWS 件ごと / 最古が MAX_DELAY_MS 経ったら bulk_create される。
+# 書き込み前の結果も /api/result/<username> から読めるが、読めるのは積んだワーカープロセスの中だけ
+# （他のプロセスには書き込まれるまで前の結果が見える）。MAX_PENDING を超えたらその場で保存する。
+# 行自体が書けない結果（ユーザー削除など）はログに出して捨て、直近 DEAD_LETTERS 件を stats から見られる
+WRITE_BEHIND = {
+    "ENABLED": os.environ.get("WRITE_BEHIND", "") == "1",
+    "MAX_ROWS": 200,
+    "MAX_DELAY_MS": 50,
+    "MAX_PENDING": 10000,
+    "DEAD_LETTERS": 100,
+}
+
+# スコア分布（percentile / タイプ分布）(core.score_stats)
+# BINS: 各軸のヒストグラムの分割数 / PERSIST_INTERVAL: 差分を ScoreStats に足し込む間隔（秒）
+SCORE_STATS = {
+    "BINS": 1000,
+    "PERSIST_INTERVAL": 10.0,
+}
+
+# 提携先向けのまとめ診断 POST /api/diagnose/batch (core.batch_views)
+# staff のセッションか、TOKENS のどれかを Authorization: Bearer で付ける。
+# TOKENS は token -> 名前空間。token で書けるのは "<名前空間>.<id>" のユーザーの結果だけ
+# （env は "名前空間:token" のカンマ区切り）
+BATCH_DIAGNOSIS = {
+    "TOKENS": {
+        token: ns
+        for ns, _, token in (t.partition(":") for t in os.environ.get("BATCH_DIAGNOSIS_TOKENS", "").split(","))
+        if ns and token
+    },
+    "MAX_ENTRIES": 1000,
+    "MAX_TRACKS": 100,  # 1件あたりの曲数の上限
+}
+
+# API レスポンスの JSON (core.fast_json)
+# BACKEND: "auto"（orjson があれば使う）/ "orjson" / "stdlib"。どれも UTF-8 そのまま（\uXXXX にしない）
+# FRAGMENTS: type_catalog の共有 dict/list はエンコード済みの断片を差し込む（"auto" は stdlib のときだけ）
+JSON_RESPONSE = {
+    "BACKEND": os.environ.get("JSON_BACKEND", "auto"),
+    "FRAGMENTS": "auto",
+}
+
+# API レスポンスの圧縮 (core.compression)
+# Accept-Encoding を見て br（brotli が入っていれば）/ gzip。MIN_SIZE バイト未満とストリーミングは圧縮しない
+COMPRESSION = {
+    "ENABLED": True,
+    "MIN_SIZE": 1024,
+    "GZIP_LEVEL": 5,
+    "BROTLI_QUALITY": 4,
+    "PATH_PREFIXES": ("/api/",),
+    "CACHE_ENTRIES": 256,  # 同じ本文の圧縮結果を使い回す件数
+}
+
+# リクエスト計測 (core.profiling)
+# Server-Timing ヘッダ（db / spotify / itunes / app / total）と /api/metrics（Prometheus 形式）。
+# SAMPLE_RATE の割合のリクエストを cProfile して PROFILE_DIR に .prof を書く（PROFILE_DIR が空なら取らない）
+PROFILING = {
+    "ENABLED": True,
+    "SERVER_TIMING": True,
+    "SAMPLE_RATE": 0.0,
+    "PROFILE_DIR": os.environ.get("PROFILE_DIR", ""),
+    "BUCKETS": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    "METRICS_ALLOWED_IPS": ["127.0.0.1", "::1"],
+}
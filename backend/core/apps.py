@@ -3,3 +3,15 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_save
+
+        from . import result_cache
+        from .profiling import _conf, install_db_wrapper
+
+        if _conf()["ENABLED"]:
+            connection_created.connect(install_db_wrapper, dispatch_uid="core.profiling.db")
+        post_save.connect(result_cache.on_user_saved, sender=User, dispatch_uid="core.result_cache.user")
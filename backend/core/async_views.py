@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from .diagnosis import (
+    compute_scores,
+    compute_scores_from_selected_tracks,
+    describe_type,
+    pick_sample_tracks,
+    pick_sample_tracks_fake,
+    scores_to_type_code,
+)
+from . import profiling, result_cache, type_catalog, write_behind
+from .circuit_breaker import CircuitOpenError, get_breaker
+from .http_client import get_async_client
+from .diagnosis_inputs import store_selected, store_spotify
+from .fast_json import FastJsonResponse
+from .models import DiagnosisInput, DiagnosisResult
+from .search_cache import get_search_cache, normalize_key
+from .spotify import afetch_top_tracks_and_features
+from .tokens import get_token_manager
+from .track_catalog import search_local
+from .track_views import itunes_items, itunes_url, _remember, _search_payload, _upstream_unavailable
+from .views import seeded_scores
+
+# ASGI 用の async view。
+# 外部HTTPは httpx（core.http_client.get_async_client）、ORM は Django の async API を使うので、
+# upstream を待っている間もワーカースレッドを占有しない。
+# レスポンスの形は sync 版（views / track_views）と同じ。
+
+
+async def _itunes_search(term: str, limit: int = 20, country: str = "JP") -> List[Dict[str, Any]]:
+    fetched: List[List[Dict[str, Any]]] = []
+
+    async def fetch() -> List[Dict[str, Any]]:
+        with profiling.timed("itunes"):
+            r = await get_async_client().get(itunes_url(term, limit, country), timeout=10)
+            r.raise_for_status()
+        items = itunes_items(json.loads(r.content.decode("utf-8", errors="ignore")))
+        fetched.append(items)
+        return items
+
+    key = normalize_key(term, limit, country)
+    items = await get_search_cache().aget_or_fetch(key, fetch, get_breaker("itunes"))
+    if fetched:
+        # カタログへの書き込みはブレーカーの計測・single-flight の外で（sync 版と同じ）
+        await sync_to_async(_remember)(fetched[0])
+    return items
+
+
+async def _create_result(
+    user: User,
+    scores: Dict[str, float],
+    type_code: str,
+    sample_ids: List[str],
+    inp: Optional[DiagnosisInput] = None,
+) -> None:
+    await write_behind.asave_result(
+        DiagnosisResult(
+            user=user,
+            input=inp,
+            energy_score=scores["energy_score"],
+            mood_score=scores["mood_score"],
+            texture_score=scores["texture_score"],
+            explore_score=scores["explore_score"],
+            type_code=type_code,
+            sample_track_ids=sample_ids,
+        )
+    )
+
+
+@require_GET
+async def tracks_search(request):
+    """
+    GET /api/async/tracks/search?q=...[&fields=id,title,...][&compact=1]
+    -> { items: Track[], prefixes?: string[] }
+    """
+    q = request.GET.get("q", "")
+    try:
+        items = await sync_to_async(search_local)(q, 20)
+        if items is None:
+            items = await _itunes_search(q, limit=20, country="JP")
+        return FastJsonResponse(_search_payload(request, items))
+    except CircuitOpenError:
+        return _upstream_unavailable()
+    except Exception as e:
+        return FastJsonResponse({"error": "search_failed", "detail": str(e)}, status=500)
+
+
+@csrf_exempt
+@require_POST
+async def diagnose_from_tracks(request):
+    """
+    POST /api/async/diagnose_from_tracks
+    body: { tracks: [{id,title,artist,tempo,bright,electro,explore}, ...] }
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return FastJsonResponse({"error": "unauthorized"}, status=401)
+
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        return FastJsonResponse({"error": "bad_json"}, status=400)
+
+    tracks = payload.get("tracks")
+    if not isinstance(tracks, list) or len(tracks) == 0:
+        return FastJsonResponse({"error": "no_tracks"}, status=400)
+
+    scores = compute_scores_from_selected_tracks(tracks)
+    type_code = scores_to_type_code(scores)
+    type_info = describe_type(type_code)
+
+    sample_tracks = pick_sample_tracks_fake(type_code)
+    sample_ids = list(type_catalog.get(type_code).track_titles)
+
+    inp = await sync_to_async(store_selected)(tracks)
+    await _create_result(user, scores, type_code, sample_ids, inp)
+
+    return FastJsonResponse(
+        {
+            "username": user.username,
+            "type_code": type_code,
+            "type_info": type_info,
+            "scores": scores,
+            "sample_track_ids": sample_ids,
+            "sample_tracks": sample_tracks,
+            "result_path": f"/result/{user.username}",
+        }
+    )
+
+
+@csrf_exempt
+@require_POST
+async def diagnose(request):
+    """
+    POST /api/async/diagnose
+    views.diagnose の async 版（Spotify 未接続なら seed でダミー診断）。
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return FastJsonResponse({"error": "unauthorized"}, status=401)
+
+    # 更新が必要なときだけ DB/HTTP に触るので、スレッドに逃がして待つ
+    access_token = await sync_to_async(get_token_manager().access_token, thread_sensitive=False)(user.id)
+
+    inp = None
+    if access_token is None:
+        scores = seeded_scores(user.username)
+        type_code = scores_to_type_code(scores)
+        sample_tracks = pick_sample_tracks_fake(type_code)
+        sample_ids = list(type_catalog.get(type_code).track_titles)
+    else:
+        items, feats = await afetch_top_tracks_and_features(
+            access_token,
+            time_ranges=settings.SPOTIFY_TOP_TIME_RANGES,
+            limit=50,
+            max_workers=settings.SPOTIFY_FETCH_WORKERS,
+        )
+
+        scores = compute_scores(items, feats)
+        type_code = scores_to_type_code(scores)
+        sample_tracks = []
+        sample_ids = pick_sample_tracks(items, feats, type_code)
+        inp = await sync_to_async(store_spotify)(items, feats)
+
+    await _create_result(user, scores, type_code, sample_ids, inp)
+
+    return FastJsonResponse(
+        {
+            "username": user.username,
+            "type_code": type_code,
+            "type_info": describe_type(type_code),
+            "scores": scores,
+            "sample_track_ids": sample_ids,
+            "sample_tracks": sample_tracks,
+            "result_path": f"/result/{user.username}",
+        }
+    )
+
+
+@require_GET
+async def result_json(request, username: str):
+    """
+    GET /api/async/result/<username>
+    """
+    entry = await sync_to_async(result_cache.get_entry)(username)
+    if entry is None:
+        if not await User.objects.filter(username=username).aexists():
+            return FastJsonResponse({"error": "not_found"}, status=404)
+        return FastJsonResponse({"error": "no_result"}, status=404)
+    return result_cache.respond(request, entry)
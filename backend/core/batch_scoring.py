@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from . import diagnosis
+
+# diagnosis.compute_scores / scores_to_type_code / pick_sample_tracks を
+# 多ユーザー分まとめて NumPy で計算する版（再診断バッチ・ベンチ用）。
+# 結果は scalar 版とビット単位で一致させる:
+# - 重み付き和は「列を左から順に足す」（BLAS の FMA / pairwise sum は使わない）
+# - 平均も曲の並び順に逐次加算する（Python の sum() と同じ順序）
+
+# packed features の列
+F_ENERGY, F_DANCE, F_TEMPO, F_VALENCE, F_ACOUSTIC, F_INSTR, F_POPULARITY = range(7)
+N_FEATURES = 7
+FEATURE_KEYS = ("energy", "danceability", "tempo", "valence", "acousticness", "instrumentalness")
+
+# 重み・しきい値は diagnosis と共有（列は diagnosis.AGG_FEATURES の順）
+SCORE_WEIGHTS = np.array(diagnosis.SCORE_WEIGHTS, dtype=np.float64)
+ARTIST_RATIO_DENOM = diagnosis.ARTIST_RATIO_DENOM
+TYPE_THRESHOLDS = np.array([th for _, th, _, _ in diagnosis.TYPE_AXES], dtype=np.float64)
+# A*8 + B*4 + C*2 + D -> type_code
+TYPE_CODES = np.array(
+    [
+        "".join(hi if i & (8 >> k) else lo for k, (_, _, hi, lo) in enumerate(diagnosis.TYPE_AXES))
+        for i in range(16)
+    ]
+)
+
+
+@dataclass
+class BatchInput:
+    """
+    U ユーザー × 最大 M 曲に詰めた列指向の入力。
+    features: (U, M, 7) float64, valid: (U, M) bool（audio feature がある曲）
+    first: (U, M) bool（同じ track id の初出。代表曲選びで使う）
+    track_ids: (U, M) object, unique_artists: (U,) int
+    """
+
+    features: np.ndarray
+    valid: np.ndarray
+    first: np.ndarray
+    track_ids: np.ndarray
+    unique_artists: np.ndarray
+
+    @property
+    def n_users(self) -> int:
+        return int(self.features.shape[0])
+
+
+@dataclass
+class BatchResult:
+    scores: np.ndarray  # (U, 4) energy, mood, texture, explore
+    type_codes: np.ndarray  # (U,) str
+    sample_track_ids: List[List[str]]
+
+    def score_dicts(self) -> List[Dict[str, float]]:
+        return [
+            {
+                "energy_score": float(e),
+                "mood_score": float(m),
+                "texture_score": float(t),
+                "explore_score": float(x),
+            }
+            for e, m, t, x in self.scores.tolist()
+        ]
+
+
+def _f(v: Any) -> float:
+    return float(v or 0.0)
+
+
+def pack_inputs(
+    users: Sequence[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]],
+) -> BatchInput:
+    """
+    [(top_tracks_items, audio_features_list), ...] を BatchInput に詰める。
+    曲の選別（id があり feature がある曲だけ）は compute_scores と同じ。
+    """
+    # 1曲ごとの list を作ると GC 追跡対象が増えて遅いので、float を平らに並べる
+    vals: List[float] = []
+    tids: List[str] = []
+    firsts: List[bool] = []
+    user_idx: List[int] = []
+    col_idx: List[int] = []
+    artists: List[int] = []
+    width = 0
+    for u, (items, feats_list) in enumerate(users):
+        feats_by_id = {f["id"]: f for f in feats_list if f and f.get("id")}
+        artist_ids = set()
+        seen = set()
+        j = 0
+        for t in items:
+            tid = t.get("id")
+            f = feats_by_id.get(tid)
+            if not tid or not f:
+                continue
+            vals.extend([_f(f.get(k)) for k in FEATURE_KEYS])
+            vals.append(_f(t.get("popularity")))
+            tids.append(tid)
+            firsts.append(tid not in seen)
+            seen.add(tid)
+            user_idx.append(u)
+            col_idx.append(j)
+            j += 1
+            for a in t.get("artists", []):
+                aid = a.get("id")
+                if aid:
+                    artist_ids.add(aid)
+        artists.append(len(artist_ids))
+        width = max(width, j)
+
+    n_users = len(artists)
+    features = np.zeros((n_users, width, N_FEATURES), dtype=np.float64)
+    valid = np.zeros((n_users, width), dtype=bool)
+    first = np.zeros((n_users, width), dtype=bool)
+    track_ids = np.full((n_users, width), "", dtype=object)
+
+    if vals:
+        ui = np.asarray(user_idx, dtype=np.int64)
+        ci = np.asarray(col_idx, dtype=np.int64)
+        features[ui, ci] = np.asarray(vals, dtype=np.float64).reshape(-1, N_FEATURES)
+        valid[ui, ci] = True
+        first[ui, ci] = np.asarray(firsts, dtype=bool)
+        track_ids[ui, ci] = np.asarray(tids, dtype=object)
+
+    return BatchInput(
+        features=features,
+        valid=valid,
+        first=first,
+        track_ids=track_ids,
+        unique_artists=np.asarray(artists, dtype=np.int64),
+    )
+
+
+def concat_inputs(batches: Sequence[BatchInput]) -> BatchInput:
+    """
+    チャンクごとに pack した BatchInput を1つにつなげる（曲数の幅は最大に揃える）。
+    """
+    width = max((b.features.shape[1] for b in batches), default=0)
+
+    def pad(a: np.ndarray, fill: Any) -> np.ndarray:
+        extra = width - a.shape[1]
+        if extra == 0:
+            return a
+        shape = (a.shape[0], extra) + a.shape[2:]
+        return np.concatenate([a, np.full(shape, fill, dtype=a.dtype)], axis=1)
+
+    return BatchInput(
+        features=np.concatenate([pad(b.features, 0.0) for b in batches]),
+        valid=np.concatenate([pad(b.valid, False) for b in batches]),
+        first=np.concatenate([pad(b.first, False) for b in batches]),
+        track_ids=np.concatenate([pad(b.track_ids, "") for b in batches]),
+        unique_artists=np.concatenate([b.unique_artists for b in batches]),
+    )
+
+
+def _seq_sum(m: np.ndarray) -> np.ndarray:
+    """
+    (U, M) を行ごとに左から逐次加算する（sum() と同じ丸め）。
+    パディングは 0.0 なので足しても値は変わらない。
+    """
+    acc = np.zeros(m.shape[0], dtype=np.float64)
+    for j in range(m.shape[1]):
+        acc = acc + m[:, j]
+    return acc
+
+
+def _ranked(key: np.ndarray, usable: np.ndarray, descending: np.ndarray) -> np.ndarray:
+    """
+    行ごとに key で stable sort した列インデックスの先頭3つ（足りなければ -1）。
+    descending は行ごとの bool（sorted(reverse=True) の stable 性と一致させるため符号反転で並べる）。
+    """
+    signed = np.where(descending[:, None], -key, key)
+    signed = np.where(usable, signed, np.inf)
+    order = np.argsort(signed, axis=1, kind="stable")[:, :3]
+    ok = np.take_along_axis(usable, order, axis=1)
+    order = np.where(ok, order, -1)
+    if order.shape[1] < 3:
+        pad = np.full((order.shape[0], 3 - order.shape[1]), -1, dtype=order.dtype)
+        order = np.concatenate([order, pad], axis=1)
+    return order
+
+
+def _first_not_in(cands: np.ndarray, *taken: np.ndarray) -> np.ndarray:
+    out = np.full(cands.shape[0], -1, dtype=np.int64)
+    done = np.zeros(cands.shape[0], dtype=bool)
+    for k in range(cands.shape[1]):
+        c = cands[:, k]
+        ok = (c >= 0) & ~done
+        for t in taken:
+            ok &= c != t
+        out = np.where(ok, c, out)
+        done |= ok
+    return out
+
+
+def score_batch(batch: BatchInput) -> BatchResult:
+    """
+    全ユーザーの4スコア・type_code・代表曲3つを一括で計算する。
+    """
+    F = batch.features
+    valid = batch.valid
+    n = np.maximum(1, valid.sum(axis=1)).astype(np.float64)
+
+    # diagnosis.AGG_FEATURES 順の集計特徴（曲の平均 6つ + explore_base + artist_ratio）
+    tempo_norm = np.clip((F[:, :, F_TEMPO] - 60.0) / 120.0, 0.0, 1.0)
+    per_track = (
+        F[:, :, F_ENERGY],
+        F[:, :, F_DANCE],
+        tempo_norm,
+        F[:, :, F_VALENCE],
+        F[:, :, F_ACOUSTIC],
+        F[:, :, F_INSTR],
+    )
+    agg = [_seq_sum(np.where(valid, col, 0.0)) / n for col in per_track]
+    pop = np.where(valid, F[:, :, F_POPULARITY] / 100.0, 0.0)
+    agg.append(1.0 - (_seq_sum(pop) / n))
+    agg.append(np.minimum(batch.unique_artists / ARTIST_RATIO_DENOM, 1.0))
+
+    # diagnosis.weighted_scores と同じく、重みとの積を左から順に足す
+    axes = []
+    for w in SCORE_WEIGHTS:
+        acc = np.zeros(n.shape[0], dtype=np.float64)
+        for k in range(len(agg)):
+            acc = acc + w[k] * agg[k]
+        axes.append(acc)
+    scores = np.clip(np.stack(axes, axis=1), 0.0, 1.0)
+
+    bits = (scores >= TYPE_THRESHOLDS).astype(np.int64)
+    type_codes = TYPE_CODES[bits[:, 0] * 8 + bits[:, 1] * 4 + bits[:, 2] * 2 + bits[:, 3]]
+
+    # 代表曲: energy 高い順 / valence（明なら高い順）/ acousticness（生なら高い順）
+    usable = valid & batch.first
+    n_users = F.shape[0]
+    always = np.ones(n_users, dtype=bool)
+    by_energy = _ranked(F[:, :, F_ENERGY], usable, always)
+    by_valence = _ranked(F[:, :, F_VALENCE], usable, bits[:, 1] == 1)
+    by_acoustic = _ranked(F[:, :, F_ACOUSTIC], usable, bits[:, 2] == 1)
+
+    p1 = by_energy[:, 0]
+    p2 = _first_not_in(by_valence, p1)
+    p3 = _first_not_in(by_acoustic, p1, p2)
+
+    picks_idx = np.stack([p1, p2, p3], axis=1).tolist()
+    track_ids = batch.track_ids
+    samples = [[track_ids[u, j] for j in row if j >= 0] for u, row in enumerate(picks_idx)]
+
+    return BatchResult(scores=scores, type_codes=type_codes, sample_track_ids=samples)
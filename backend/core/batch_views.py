@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import hmac
+import json
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import fast_json, type_catalog
+from .diagnosis import compute_scores_from_selected_tracks, scores_to_type_code
+from .diagnosis_inputs import store_selected_many
+from .fast_json import FastJsonResponse
+from .models import DiagnosisResult, LatestDiagnosis
+
+# 提携先向けのまとめ診断 API。
+# POST /api/diagnose/batch  body: {"entries": [{"user": "<username>", "tracks": [...]}, ...]}
+# - 採点は diagnose_from_tracks と同じ（compute_scores_from_selected_tracks）で、全件を1周で済ませる
+# - 採点した順に1件1行の NDJSON で返す（書き込みを待たずに最初の行が届く）
+# - 最後に入力・ユーザー・結果を1トランザクションで書き（結果は bulk_create 1回）、
+#   {"done": true, ...} の行で件数を返す。書き込みに失敗したら何も保存しない
+# 認可: staff のセッションか、BATCH_DIAGNOSIS.TOKENS（token -> 名前空間）のどれかを Authorization: Bearer で。
+# token で書けるのは "<名前空間>.<id>" のユーザーだけ（それ以外は not_owned）。
+# 居ないユーザーは使えないパスワードで作る（ログインはできない）。
+# 提携先が作ったのではないアカウント（staff・Spotify 連携済み・パスワードで入れる人）は、
+# staff のセッションからでも書き換えない（not_owned）。
+
+
+_ANY = ""  # staff のセッション: 名前空間の縛りなし
+
+
+def _conf() -> dict:
+    conf = {"TOKENS": {}, "MAX_ENTRIES": 1000, "MAX_TRACKS": 100}
+    conf.update(getattr(settings, "BATCH_DIAGNOSIS", {}))
+    return conf
+
+
+def _namespace(request, tokens: Dict[str, str]) -> Optional[str]:
+    """
+    書いてよいユーザー名の名前空間。staff のセッションなら _ANY、認可されなければ None。
+    """
+    if request.user.is_authenticated and request.user.is_staff:
+        return _ANY
+    auth = request.META.get("HTTP_AUTHORIZATION", "")
+    if not auth.startswith("Bearer "):
+        return None
+    given = auth[len("Bearer ") :].strip().encode("utf-8")
+    found = None
+    for token, ns in tokens.items():
+        # 一致したかどうかで時間が変わらないよう、全部比べる
+        if token and ns and hmac.compare_digest(given, token.encode("utf-8")):
+            found = ns
+    return found
+
+
+def _line(obj: Dict[str, Any]) -> bytes:
+    return fast_json.dumps(obj) + b"\n"
+
+
+def _check(entry: Any, max_tracks: int, namespace: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    (username, error)。error が None なら使える。
+    """
+    if not isinstance(entry, dict):
+        return None, "bad_entry"
+    username = entry.get("user")
+    if not isinstance(username, str) or not username:
+        return None, "bad_user"
+    if namespace != _ANY and (not username.startswith(namespace + ".") or username == namespace + "."):
+        return username, "not_owned"
+    try:
+        User.username_validator(username)
+    except ValidationError:
+        return username, "bad_user"
+    if len(username) > User._meta.get_field("username").max_length:
+        return username, "bad_user"
+    tracks = entry.get("tracks")
+    if not isinstance(tracks, list) or not tracks:
+        return username, "no_tracks"
+    if len(tracks) > max_tracks or not all(isinstance(t, dict) for t in tracks):
+        return username, "bad_tracks"
+    return username, None
+
+
+def _not_owned(usernames: List[str]) -> set:
+    """
+    usernames のうち、このエンドポイントで結果を書き換えてはいけない既存アカウント。
+    """
+    protected = (
+        Q(is_staff=True)
+        | Q(is_superuser=True)
+        | Q(spotify__isnull=False)
+        | ~Q(password__startswith=UNUSABLE_PASSWORD_PREFIX)
+    )
+    return set(User.objects.filter(protected, username__in=set(usernames)).values_list("username", flat=True))
+
+
+def _users(usernames: List[str]) -> Dict[str, User]:
+    """
+    username -> User。居なければ作る（SELECT 1回、足りなければ bulk_create + 読み直し）。
+    書き換えてはいけないアカウント（_not_owned。先に確かめた後で変わった場合）は含めない。
+    """
+    names = set(usernames)
+    users = {u.username: u for u in User.objects.filter(username__in=names).select_related("spotify")}
+    missing = names - users.keys()
+    if missing:
+        password = make_password(None)  # 使えないパスワード（ログインはさせない）
+        User.objects.bulk_create([User(username=n, password=password) for n in missing], ignore_conflicts=True)
+        users.update((u.username, u) for u in User.objects.filter(username__in=missing).select_related("spotify"))
+    return {
+        name: u
+        for name, u in users.items()
+        if not (u.is_staff or u.is_superuser or u.has_usable_password() or hasattr(u, "spotify"))
+    }
+
+
+def _stream(entries: List[Any], conf: dict, namespace: str) -> Iterator[bytes]:
+    scored: List[Tuple[int, str, List[Dict[str, Any]], Dict[str, float], str]] = []
+    errors = 0
+    try:
+        checked = [_check(entry, conf["MAX_TRACKS"], namespace) for entry in entries]
+        not_owned = _not_owned([name for name, error in checked if error is None])
+        for i, (entry, (username, error)) in enumerate(zip(entries, checked)):
+            if error is None and username in not_owned:
+                error = "not_owned"
+            if error is not None:
+                errors += 1
+                yield _line({"index": i, "user": username, "error": error})
+                continue
+            tracks = entry["tracks"]
+            scores = compute_scores_from_selected_tracks(tracks)
+            type_code = scores_to_type_code(scores)
+            scored.append((i, username, tracks, scores, type_code))
+            yield _line(
+                {
+                    "index": i,
+                    "user": username,
+                    "type_code": type_code,
+                    "scores": scores,
+                    "result_path": f"/result/{username}",
+                }
+            )
+
+        saved = 0
+        if scored:
+            try:
+                with transaction.atomic():
+                    users = _users([s[1] for s in scored])
+                    scored = [s for s in scored if s[1] in users]
+                    inputs = store_selected_many([s[2] for s in scored])
+                    results = [
+                        DiagnosisResult(
+                            user=users[name],
+                            input=inp,
+                            energy_score=scores["energy_score"],
+                            mood_score=scores["mood_score"],
+                            texture_score=scores["texture_score"],
+                            explore_score=scores["explore_score"],
+                            type_code=type_code,
+                            sample_track_ids=list(type_catalog.get(type_code).track_titles),
+                        )
+                        for (_, name, _, scores, type_code), inp in zip(scored, inputs)
+                    ]
+                    DiagnosisResult.objects.bulk_create(results)
+                    LatestDiagnosis.point_to(results)
+                    saved = len(results)
+            except Exception as e:
+                yield _line({"done": True, "error": "write_failed", "detail": str(e), "saved": 0, "errors": errors})
+                return
+        yield _line({"done": True, "entries": len(entries), "saved": saved, "errors": errors})
+    finally:
+        # ストリーム中はリクエスト終了シグナルの外で DB を使うので自分で閉じる
+        close_old_connections()
+
+
+@csrf_exempt
+@require_POST
+def diagnose_batch(request):
+    """
+    POST /api/diagnose/batch
+    body: { entries: [{user, tracks: [{id,tempo,bright,electro,explore}, ...]}, ...] }
+    -> application/x-ndjson: 1件1行 {index, user, type_code, scores, result_path} か {index, user, error}、
+       最後に {done: true, entries, saved, errors}
+    token で呼ぶときの user は "<名前空間>.<id>"。
+    """
+    conf = _conf()
+    namespace = _namespace(request, conf["TOKENS"])
+    if namespace is None:
+        return FastJsonResponse({"error": "unauthorized"}, status=401)
+
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        return FastJsonResponse({"error": "bad_json"}, status=400)
+
+    entries = payload.get("entries") if isinstance(payload, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return FastJsonResponse({"error": "no_entries"}, status=400)
+    if len(entries) > conf["MAX_ENTRIES"]:
+        return FastJsonResponse({"error": "too_many_entries", "max": conf["MAX_ENTRIES"]}, status=413)
+
+    response = StreamingHttpResponse(_stream(entries, conf, namespace), content_type="application/x-ndjson")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
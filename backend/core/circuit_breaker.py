@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+# upstream（iTunes 検索など）用のサーキットブレーカー。
+# - closed: 普通に呼ぶ。失敗（例外 or SLOW_CALL_SEC 超え）が FAILURE_THRESHOLD 回続いたら open
+# - open: 呼ばずにすぐ諦める（呼び出し側は古いキャッシュを返す）。OPEN_SEC 経ったら
+#   try_start_probe() が1人だけに True を返し、その人がバックグラウンドで1回だけ試す（half_open）
+# - half_open: 試しの1回が成功なら closed、失敗なら open に戻る。結果を出さずに終わった
+#   （キャンセル・ループ終了）なら abort() で open に戻す。それも来ないまま PROBE_TIMEOUT_SEC 経ったら
+#   試しは失われたものとして次の try_start_probe() で別の人に任せる
+# 呼び出しそのもの（スレッド / asyncio タスク）は呼び出し側が持つ。ここは状態だけ。
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class CircuitOpenError(Exception):
+    """
+    ブレーカーが開いているので upstream を呼ばなかった。
+    """
+
+
+def _conf() -> dict:
+    conf = {"ENABLED": True, "FAILURE_THRESHOLD": 5, "SLOW_CALL_SEC": 3.0, "OPEN_SEC": 30.0, "PROBE_TIMEOUT_SEC": 60.0}
+    conf.update(getattr(settings, "CIRCUIT_BREAKER", {}))
+    return conf
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        slow_call_sec: float = 3.0,
+        open_sec: float = 30.0,
+        probe_timeout_sec: float = 60.0,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.slow_call_sec = float(slow_call_sec)
+        self.open_sec = float(open_sec)
+        self.probe_timeout_sec = float(probe_timeout_sec)
+        self._state = CLOSED
+        self._failures = 0  # closed での連続失敗数
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+        # metrics
+        self.transitions: Dict[str, int] = {}  # "closed->open" -> 回数
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.probes = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def _move(self, state: str) -> None:
+        # self._lock を持って呼ぶ
+        if state == self._state:
+            return
+        key = f"{self._state}->{state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._failures = 0
+
+    def allow(self) -> bool:
+        """
+        今 upstream を呼んでよいか（closed のときだけ True）。False なら rejected に数える。
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            self.rejected += 1
+            return False
+
+    def try_start_probe(self) -> bool:
+        """
+        open で OPEN_SEC 経っていれば half_open にして True（同時に1人だけ）。
+        True を受け取った人は1回だけ呼んで record() か abort() すること。
+        half_open のまま PROBE_TIMEOUT_SEC 経った（試しが報告されずに消えた）ときも True。
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._state == OPEN and now - self._opened_at >= self.open_sec:
+                self._move(HALF_OPEN)
+            elif not (self._state == HALF_OPEN and now - self._probe_at >= self.probe_timeout_sec):
+                return False
+            self._probe_at = now
+            self.probes += 1
+            return True
+
+    def abort(self) -> None:
+        """
+        呼び出しが結果を出さずに終わった（キャンセルなど）。half_open なら open に戻す。
+        closed の連続失敗には数えない（upstream のせいとは限らない）。
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._move(OPEN)
+
+    def record(self, ok: bool, seconds: float = 0.0) -> None:
+        """
+        呼び出し結果を記録する。成功でも SLOW_CALL_SEC を超えたら失敗扱い。
+        """
+        slow = ok and seconds > self.slow_call_sec
+        with self._lock:
+            self.calls += 1
+            if slow:
+                self.slow_calls += 1
+            if ok and not slow:
+                if self._state == HALF_OPEN:
+                    self._move(CLOSED)
+                self._failures = 0
+                return
+            self.failures += 1
+            if self._state == HALF_OPEN:
+                self._move(OPEN)
+            elif self._state == CLOSED:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._move(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "name": self.name,
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "open_for_sec": round(time.monotonic() - self._opened_at, 1) if self._state != CLOSED else 0.0,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "rejected": self.rejected,
+                "probes": self.probes,
+                "transitions": dict(self.transitions),
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> Optional[CircuitBreaker]:
+    """
+    名前ごとの共有ブレーカー（settings.CIRCUIT_BREAKER から作る）。ENABLED が False なら None。
+    """
+    b = _breakers.get(name)
+    if b is not None:
+        return b
+    conf = _conf()
+    if not conf["ENABLED"]:
+        return None
+    with _breakers_lock:
+        b = _breakers.get(name)
+        if b is None:
+            b = _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=conf["FAILURE_THRESHOLD"],
+                slow_call_sec=conf["SLOW_CALL_SEC"],
+                open_sec=conf["OPEN_SEC"],
+                probe_timeout_sec=conf["PROBE_TIMEOUT_SEC"],
+            )
+    return b
+
+
+def reset_breakers() -> None:
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def render_metrics() -> List[str]:
+    """
+    /api/metrics に足す行（Prometheus text format）。
+    """
+    with _breakers_lock:
+        breakers = sorted(_breakers.values(), key=lambda b: b.name)
+    lines = [
+        "# HELP circuit_breaker_state Current breaker state (1 for the active state).",
+        "# TYPE circuit_breaker_state gauge",
+    ]
+    stats = [b.stats() for b in breakers]
+    for s in stats:
+        for state in STATES:
+            lines.append(f'circuit_breaker_state{{name="{s["name"]}",state="{state}"}} {int(s["state"] == state)}')
+    lines += [
+        "# HELP circuit_breaker_transitions_total Breaker state transitions.",
+        "# TYPE circuit_breaker_transitions_total counter",
+    ]
+    for s in stats:
+        for key, n in sorted(s["transitions"].items()):
+            src, dst = key.split("->")
+            lines.append(f'circuit_breaker_transitions_total{{name="{s["name"]}",from="{src}",to="{dst}"}} {n}')
+    for metric, field, help_text in (
+        ("circuit_breaker_calls_total", "calls", "Upstream calls recorded by the breaker."),
+        ("circuit_breaker_failures_total", "failures", "Failed or slow upstream calls."),
+        ("circuit_breaker_rejected_total", "rejected", "Calls short-circuited while the breaker was not closed."),
+        ("circuit_breaker_probes_total", "probes", "Background probes started from the open state."),
+    ):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        for s in stats:
+            lines.append(f'{metric}{{name="{s["name"]}"}} {s[field]}')
+    return lines
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 検索結果（/api/tracks/search）の軽量表現。既定のレスポンスは変えず、クエリで選ぶ。
+# - fields=id,title,artist: 指定した項目だけ返す（未知の項目名は無視）
+# - compact=1: URL 項目の共通の前半を "prefixes" にまとめ、各 URL は [番号, 残り] にする
+#     {"items": [{"artwork": [0, "Music/v4/.../100x100bb.jpg"], ...}], "prefixes": ["https://is1-ssl.mzstatic.com/image/thumb/"]}
+#   前半は "/" の区切りで切り、同じレスポンスの中で2回以上出てくる最長のものを使う
+
+TRACK_FIELDS = ("id", "title", "artist", "artwork", "preview_url", "external_url")
+URL_FIELDS = ("artwork", "preview_url", "external_url")
+MIN_PREFIX_LEN = 12
+MAX_PREFIX_DEPTH = 4  # ホストの後ろのパスは4段まで（それより深いところは曲ごとに違う）
+
+
+def parse_fields(raw: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """
+    "id,title" -> ("id", "title")。指定なし・有効な項目が無ければ None（全項目）。
+    """
+    if not raw:
+        return None
+    wanted = {f.strip() for f in raw.split(",")}
+    fields = tuple(f for f in TRACK_FIELDS if f in wanted)
+    return fields or None
+
+
+def select_fields(items: Iterable[Dict[str, Any]], fields: Sequence[str]) -> List[Dict[str, Any]]:
+    # items は検索キャッシュの共有オブジェクトなので書き換えずに作り直す
+    return [{f: it[f] for f in fields if f in it} for it in items]
+
+
+def _candidates(url: str) -> List[str]:
+    # "https://host/a/b/c.jpg" -> ["https://host/", "https://host/a/", "https://host/a/b/"]（短いものは除く）
+    start = url.find("://")
+    if start < 0:
+        return []
+    out = []
+    i = url.find("/", start + 3)
+    while i >= 0 and len(out) <= MAX_PREFIX_DEPTH:
+        if i + 1 >= MIN_PREFIX_LEN:
+            out.append(url[: i + 1])
+        i = url.find("/", i + 1)
+    if out and len(out[-1]) == len(url):
+        out.pop()
+    return out
+
+
+def compact_urls(items: List[Dict[str, Any]], url_fields: Sequence[str] = URL_FIELDS) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    URL 項目を [prefix 番号, 残り] にした items（新しい dict）と prefixes を返す。
+    前半が他と共有されない URL は文字列のまま残す。
+    """
+    cands = [[_candidates(it.get(f) or "") for f in url_fields] for it in items]
+    counts: Counter = Counter(p for row in cands for c in row for p in c)
+
+    prefixes: List[str] = []
+    index: Dict[str, int] = {}
+    out = []
+    for it, row_cands in zip(items, cands):
+        row = dict(it)
+        for f, c in zip(url_fields, row_cands):
+            best = next((p for p in reversed(c) if counts[p] >= 2), None)  # 長いほうから
+            if best is None:
+                continue
+            i = index.get(best)
+            if i is None:
+                i = index[best] = len(prefixes)
+                prefixes.append(best)
+            row[f] = [i, it[f][len(best) :]]
+        out.append(row)
+    return out, prefixes
+
+
+def expand_urls(items: List[Dict[str, Any]], prefixes: List[str]) -> List[Dict[str, Any]]:
+    """
+    compact_urls の逆（クライアント実装の参照用とテスト用）。
+    """
+    out = []
+    for it in items:
+        row = dict(it)
+        for f, v in it.items():
+            if isinstance(v, list) and len(v) == 2 and isinstance(v[0], int):
+                row[f] = prefixes[v[0]] + v[1]
+        out.append(row)
+    return out
+
+
+def search_payload(items: List[Dict[str, Any]], fields: Optional[Sequence[str]] = None, compact: bool = False) -> Dict[str, Any]:
+    """
+    /api/tracks/search のレスポンス本体。fields も compact も無ければ従来どおり {"items": items}。
+    """
+    if fields:
+        items = select_fields(items, fields)
+    if not compact:
+        return {"items": items}
+    url_fields = [f for f in URL_FIELDS if not fields or f in fields]
+    items, prefixes = compact_urls(items, url_fields)
+    return {"items": items, "prefixes": prefixes}
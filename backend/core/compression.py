@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.regex_helper import _lazy_re_compile
+
+# API レスポンスの圧縮（Accept-Encoding を見て br / gzip）。
+# - MIN_SIZE バイト未満・ストリーミング（NDJSON / SSE）・JSON 以外・既に Content-Encoding があるものは触らない
+# - brotli は任意の依存（入っていなければ gzip だけ）
+# - 同じ本文（キャッシュ済みの検索結果や結果ページ）は圧縮結果を CACHE_ENTRIES 件まで使い回す
+
+try:
+    import brotli
+except ImportError:  # 任意の依存
+    brotli = None
+
+
+def _conf() -> dict:
+    conf = {
+        "ENABLED": True,
+        "MIN_SIZE": 1024,
+        "GZIP_LEVEL": 5,
+        "BROTLI_QUALITY": 4,
+        "PATH_PREFIXES": ("/api/",),
+        "CACHE_ENTRIES": 256,
+        "CACHE_MAX_BODY": 64 * 1024,
+    }
+    conf.update(getattr(settings, "COMPRESSION", {}))
+    return conf
+
+
+def _compressors(conf: dict) -> Dict[str, Callable[[bytes], bytes]]:
+    # 優先順（同じ q ならこの順で選ぶ）
+    out: Dict[str, Callable[[bytes], bytes]] = {}
+    if brotli is not None:
+        quality = int(conf["BROTLI_QUALITY"])
+        out["br"] = lambda body: brotli.compress(body, quality=quality, mode=brotli.MODE_TEXT)
+    level = int(conf["GZIP_LEVEL"])
+    # mtime=0: 同じ本文なら同じバイト列（ETag / キャッシュが揺れない）
+    out["gzip"] = lambda body: gzip.compress(body, compresslevel=level, mtime=0)
+    return out
+
+
+_ACCEPT_RE = _lazy_re_compile(r"\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*")
+
+
+def choose_encoding(accept_encoding: str, available: List[str]) -> Optional[str]:
+    """
+    Accept-Encoding（q 値つき）から使う符号化を選ぶ。無ければ None（identity）。
+    """
+    q: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        m = _ACCEPT_RE.fullmatch(part)
+        if not m:
+            continue
+        try:
+            q[m.group(1).lower()] = float(m.group(2)) if m.group(2) else 1.0
+        except ValueError:
+            continue
+    best, best_q = None, 0.0
+    for coding in available:
+        value = q.get(coding, q.get("*", 0.0))
+        if value > best_q:
+            best, best_q = coding, value
+    return best
+
+
+class _CompressedCache:
+    """
+    (符号化, 本文) -> 圧縮済み本文 の小さい LRU。
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max(0, int(max_entries))
+        self._data: "OrderedDict[Tuple[str, bytes], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compress(self, coding: str, body: bytes, compress: Callable[[bytes], bytes], max_body: int) -> bytes:
+        if not self.max_entries or len(body) > max_body:
+            return compress(body)
+        key = (coding, body)
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is not None:
+                self._data.move_to_end(key)
+                return hit
+        out = compress(body)
+        with self._lock:
+            self._data[key] = out
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return out
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    MIDDLEWARE では ProfilingMiddleware のすぐ後に置く（圧縮の時間も total に入る）。
+    """
+
+    def __init__(self, get_response) -> None:
+        super().__init__(get_response)
+        conf = _conf()
+        self.enabled = bool(conf["ENABLED"])
+        self.min_size = int(conf["MIN_SIZE"])
+        self.prefixes = tuple(conf["PATH_PREFIXES"])
+        self.max_body = int(conf["CACHE_MAX_BODY"])
+        self.compressors = _compressors(conf)
+        self.cache = _CompressedCache(conf["CACHE_ENTRIES"])
+
+    def process_response(self, request, response):
+        if not self.enabled or not request.path.startswith(self.prefixes):
+            return response
+        if response.streaming or response.has_header("Content-Encoding"):
+            return response
+        if not response.get("Content-Type", "").startswith("application/json"):
+            return response
+        # 小さくて圧縮しない応答も、Accept-Encoding で中身が変わりうることを共有キャッシュに伝える
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if len(response.content) < self.min_size:
+            return response
+        coding = choose_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""), list(self.compressors))
+        if coding is None:
+            return response
+
+        body = self.cache.get_or_compress(coding, response.content, self.compressors[coding], self.max_body)
+        if len(body) >= len(response.content):
+            return response
+        response.content = body
+        response["Content-Length"] = str(len(body))
+        response["Content-Encoding"] = coding
+        # 中身が変わるので強い ETag は弱くする（304 の判定は弱い比較なのでそのまま効く）
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+        return response
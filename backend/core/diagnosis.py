@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Mapping, Sequence
+
+from . import type_catalog
 
 
 # -------------------------
@@ -18,6 +20,53 @@ def clamp01(x: float) -> float:
     return v
 
 
+# -------------------------
+# 重みとしきい値（core.batch_scoring もここから作る）
+# -------------------------
+# ユーザーごとの集計特徴。曲の平均（tempo_norm は 60..180 BPM を 0..1 に）と、
+# explore_base = 1 - 平均人気、artist_ratio = ユニークアーティスト数 / ARTIST_RATIO_DENOM（1 まで）
+AGG_FEATURES = (
+    "energy",
+    "danceability",
+    "tempo_norm",
+    "valence",
+    "acousticness",
+    "instrumentalness",
+    "explore_base",
+    "artist_ratio",
+)
+SCORE_KEYS = ("energy_score", "mood_score", "texture_score", "explore_score")
+# 行が SCORE_KEYS、列が AGG_FEATURES。スコア = 行と集計特徴の積を左から順に足したもの
+SCORE_WEIGHTS = (
+    (0.45, 0.35, 0.20, 0.0, 0.0, 0.0, 0.0, 0.0),  # energy: energy/danceability/tempo
+    (0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0),  # mood: valence
+    (0.0, 0.0, 0.0, 0.0, 0.60, 0.40, 0.0, 0.0),  # texture: acousticness/instrumentalness（生寄りほど高い）
+    (0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.8, 0.2),  # explore: 人気が低い+アーティスト多様性
+)
+# top_tracks 50件想定（time_range を増やして 50 組より多くのアーティストが来ても 1 で頭打ち）
+ARTIST_RATIO_DENOM = 50.0
+# scores_to_type_code の軸: (スコア, しきい値, 以上の文字, 未満の文字)
+TYPE_AXES = (
+    ("energy_score", 0.55, "A", "a"),
+    ("mood_score", 0.52, "B", "b"),
+    ("texture_score", 0.50, "C", "c"),
+    ("explore_score", 0.50, "D", "d"),
+)
+
+
+def weighted_scores(agg: List[float]) -> Dict[str, float]:
+    """
+    AGG_FEATURES 順の集計特徴から4スコア(0..1)。
+    """
+    out = {}
+    for key, weights in zip(SCORE_KEYS, SCORE_WEIGHTS):
+        acc = 0.0
+        for w, x in zip(weights, agg):
+            acc = acc + w * x
+        out[key] = float(clamp01(acc))
+    return out
+
+
 # -------------------------
 # Spotify 版（audio_features を使う）
 # -------------------------
@@ -27,16 +76,12 @@ def compute_scores(
 ) -> Dict[str, float]:
     """
     Spotifyの top_tracks + audio_features から4スコア(0..1)を算出する。
-    - energy_score: energy/danceability/tempo
-    - mood_score: valence
-    - texture_score: acousticness/instrumentalness（生寄りほど高い）
-    - explore_score: 人気が低い+アーティスト多様性（探索ほど高い）
+    重みは SCORE_WEIGHTS（energy / mood / texture / explore）。
     """
     feats_by_id = {f["id"]: f for f in audio_features_list if f and f.get("id")}
 
-    energy_terms: List[float] = []
-    mood_terms: List[float] = []
-    texture_terms: List[float] = []
+    # AGG_FEATURES の曲ごとの列（先頭6つ）と人気
+    columns: List[List[float]] = [[] for _ in range(6)]
     pop_terms: List[float] = []
     artist_ids: List[str] = []
 
@@ -47,60 +92,35 @@ def compute_scores(
             continue
 
         tempo = float(f.get("tempo") or 0.0)
-        # tempo を 60..180 BPM の範囲で 0..1 に正規化（雑でOK）
-        tempo_norm = clamp01((tempo - 60.0) / 120.0)
-
-        energy = float(f.get("energy") or 0.0)
-        dance = float(f.get("danceability") or 0.0)
-        valence = float(f.get("valence") or 0.0)
-
-        acoustic = float(f.get("acousticness") or 0.0)
-        instr = float(f.get("instrumentalness") or 0.0)
-
-        popularity = float(t.get("popularity") or 0.0) / 100.0
-
-        energy_terms.append(0.45 * energy + 0.35 * dance + 0.20 * tempo_norm)
-        mood_terms.append(valence)
-        texture_terms.append(0.60 * acoustic + 0.40 * instr)
-        pop_terms.append(popularity)
+        columns[0].append(float(f.get("energy") or 0.0))
+        columns[1].append(float(f.get("danceability") or 0.0))
+        columns[2].append(clamp01((tempo - 60.0) / 120.0))
+        columns[3].append(float(f.get("valence") or 0.0))
+        columns[4].append(float(f.get("acousticness") or 0.0))
+        columns[5].append(float(f.get("instrumentalness") or 0.0))
+        pop_terms.append(float(t.get("popularity") or 0.0) / 100.0)
 
         for a in t.get("artists", []):
             aid = a.get("id")
             if aid:
                 artist_ids.append(aid)
 
-    n = max(1, len(energy_terms))
-    energy_score = sum(energy_terms) / n
-    mood_score = sum(mood_terms) / n
-    texture_score = sum(texture_terms) / n
-
-    # explore: 人気が低いほど探索、＋アーティスト多様性
-    explore_base = 1.0 - (sum(pop_terms) / max(1, len(pop_terms)))
-    # top_tracks 50件想定
-    unique_artists_ratio = len(set(artist_ids)) / 50.0
-    explore_score = clamp01(explore_base * 0.8 + unique_artists_ratio * 0.2)
-
-    return {
-        "energy_score": float(clamp01(energy_score)),
-        "mood_score": float(clamp01(mood_score)),
-        "texture_score": float(clamp01(texture_score)),
-        "explore_score": float(clamp01(explore_score)),
-    }
+    n = max(1, len(pop_terms))
+    agg = [sum(col) / n for col in columns]
+    agg.append(1.0 - sum(pop_terms) / n)
+    agg.append(min(1.0, len(set(artist_ids)) / ARTIST_RATIO_DENOM))
+    return weighted_scores(agg)
 
 
 def scores_to_type_code(s: Dict[str, float]) -> str:
     """
-    4スコアからタイプコード（AbcD みたいな 4文字）を作る。
+    4スコアからタイプコード（AbcD みたいな 4文字）を作る。しきい値は TYPE_AXES。
     A/a: 動/静（energy）
     B/b: 明/影（mood）
     C/c: 生/電（texture） ※ texture高い=生寄り
     D/d: 探索/定番（explore）
     """
-    A = "A" if s.get("energy_score", 0.0) >= 0.55 else "a"
-    B = "B" if s.get("mood_score", 0.0) >= 0.52 else "b"
-    C = "C" if s.get("texture_score", 0.0) >= 0.50 else "c"
-    D = "D" if s.get("explore_score", 0.0) >= 0.50 else "d"
-    return f"{A}{B}{C}{D}"
+    return "".join(hi if s.get(key, 0.0) >= th else lo for key, th, hi, lo in TYPE_AXES)
 
 
 def pick_sample_tracks(
@@ -199,63 +219,17 @@ def compute_scores_from_selected_tracks(tracks: List[Dict[str, Any]]) -> Dict[st
 # -------------------------
 # 表示用（フロント表示/OGP用）
 # -------------------------
-def describe_type(type_code: str) -> Dict[str, Any]:
+def describe_type(type_code: str) -> Mapping[str, Any]:
     """
     type_code から表示用情報を返す（フロント表示/OGP用）。
-    差し替え前提でOK。
+    core.type_catalog の共有 dict（書き換えできない。変えるならコピーして）を返す。
     """
-    axes = {
-        "axis1": "動" if type_code[0] == "A" else "静",
-        "axis2": "光" if type_code[1] == "B" else "影",
-        "axis3": "生" if type_code[2] == "C" else "電",
-        "axis4": "探索" if type_code[3] == "D" else "定番",
-    }
-
-    presets = {
-        "AbcD": {
-            "name": "夜更かしドライブタイプ",
-            "tagline": "暗めで速い。電子寄りで探索好き。",
-        },
-        "AbCD": {
-            "name": "夜更かしインディタイプ",
-            "tagline": "暗めで速い。生音寄りで探索好き。",
-        },
-    }
-
-    base = presets.get(
-        type_code,
-        {"name": f"Type {type_code}", "tagline": "あなたの音楽の傾向を表すタイプ。"},
-    )
-
-    return {
-        "name": base["name"],
-        "tagline": base["tagline"],
-        "axes": axes,
-    }
+    return type_catalog.get(type_code).info
 
 
-def pick_sample_tracks_fake(type_code: str) -> List[Dict[str, str]]:
+def pick_sample_tracks_fake(type_code: str) -> Sequence[Mapping[str, str]]:
     """
     Spotifyが無い時の“それっぽい代表曲”を返す。
-    type_codeごとに固定なので、シェアしてもブレない。
+    type_codeごとに固定なので、シェアしてもブレない（共有の書き換えできない list）。
     """
-    catalog: Dict[str, List[Dict[str, str]]] = {
-        "AbCD": [
-            {"title": "Midnight Loop", "artist": "Neon Taxi", "note": "夜の高速、低音が気持ちいい"},
-            {"title": "Shadow Sprint", "artist": "City Pulse", "note": "暗め×速め、集中スイッチ"},
-            {"title": "Analog Rain", "artist": "Blue Static", "note": "冷たい空気、ドライブ向け"},
-        ],
-        "AbcD": [
-            {"title": "Late Night Drive", "artist": "Pastel FM", "note": "暗め電子、探索モード"},
-            {"title": "Tunnel Lights", "artist": "Noon Runner", "note": "一定のビートが心地いい"},
-            {"title": "Quiet Accel", "artist": "Soda Wave", "note": "静かに加速する感じ"},
-        ],
-    }
-
-    fallback = [
-        {"title": "Daydream Pop", "artist": "Paper Sun", "note": "軽くて聴きやすい"},
-        {"title": "Stereo Breeze", "artist": "Room Radio", "note": "作業BGMにちょうどいい"},
-        {"title": "Afterglow", "artist": "Glass Hour", "note": "余韻が残る、落ち着く"},
-    ]
-
-    return catalog.get(type_code, fallback)
+    return type_catalog.get(type_code).track_dicts
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from django.db import IntegrityError, transaction
+
+from .diagnosis import compute_scores_from_selected_tracks
+from .models import DiagnosisInput
+
+# 診断入力を DiagnosisInput に詰める/戻す。
+# 今の計算式に合わせて丸めたり捨てたりせず、受け取った値をそのまま残す（式を変えても再計算できるように）。
+# features は float64 の固定幅配列（行=曲, 列は下記）。JSON より小さく、NumPy からはコピー無しで読める。
+#   selected: tempo, bright, electro, explore（受け取った値のまま。clamp01 は再計算のときにかける）
+#   spotify : SPOTIFY_COLUMNS（audio feature の数値項目すべて + popularity。audio feature がある曲だけ、
+#             top_tracks の順）。先頭7列は core.batch_scoring の列順と同じ。
+#             meta: {"columns": [...], "artist_ids": [[曲ごとのアーティスト id], ...]}
+#             （meta に columns が無い古い行は先頭7列だけで、meta は {"unique_artists": n}）
+# 数値にできない値は 0.0 にする（clamp01 と同じ扱い）。
+
+SELECTED_KEYS = ("tempo", "bright", "electro", "explore")
+SPOTIFY_FEATURE_KEYS = ("energy", "danceability", "tempo", "valence", "acousticness", "instrumentalness")
+SPOTIFY_LEGACY_COLUMNS = SPOTIFY_FEATURE_KEYS + ("popularity",)
+SPOTIFY_COLUMNS = SPOTIFY_LEGACY_COLUMNS + (
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "liveness",
+    "duration_ms",
+    "time_signature",
+)
+
+
+def _to_bytes(values: List[float]) -> bytes:
+    a = array("d", values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_bytes(raw: bytes) -> array:
+    a = array("d")
+    a.frombytes(bytes(raw))
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _f(v: Any) -> float:
+    try:
+        return float(v or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def columns(kind: str, meta: Optional[Dict[str, Any]] = None) -> Tuple[str, ...]:
+    """
+    features の列名（spotify は行ごとに meta に残した列。無ければ古い7列）。
+    """
+    if kind == DiagnosisInput.KIND_SELECTED:
+        return SELECTED_KEYS
+    return tuple((meta or {}).get("columns") or SPOTIFY_LEGACY_COLUMNS)
+
+
+def pack_selected(tracks: List[Dict[str, Any]]) -> Tuple[bytes, List[str], Dict[str, Any]]:
+    values: List[float] = []
+    ids: List[str] = []
+    for t in tracks:
+        values.extend(_f(t.get(k, 0.5)) for k in SELECTED_KEYS)
+        ids.append(str(t.get("id") or ""))
+    return _to_bytes(values), ids, {}
+
+
+def pack_spotify(
+    top_tracks_items: List[Dict[str, Any]],
+    audio_features_list: List[Dict[str, Any]],
+) -> Tuple[bytes, List[str], Dict[str, Any]]:
+    """
+    compute_scores と同じ選別（id があり feature がある曲）で、SPOTIFY_COLUMNS と曲ごとのアーティスト id を詰める。
+    """
+    feats_by_id = {f["id"]: f for f in audio_features_list if f and f.get("id")}
+    values: List[float] = []
+    ids: List[str] = []
+    artist_ids: List[List[str]] = []
+    for t in top_tracks_items:
+        tid = t.get("id")
+        f = feats_by_id.get(tid)
+        if not tid or not f:
+            continue
+        values.extend(_f(t.get(k) if k == "popularity" else f.get(k)) for k in SPOTIFY_COLUMNS)
+        ids.append(tid)
+        artist_ids.append([a["id"] for a in t.get("artists", []) if a.get("id")])
+    return _to_bytes(values), ids, {"columns": list(SPOTIFY_COLUMNS), "artist_ids": artist_ids}
+
+
+def _content_hash(kind: str, blob: bytes, ids: List[str], meta: Dict[str, Any]) -> str:
+    h = hashlib.sha256()
+    h.update(kind.encode("ascii"))
+    h.update(b"\0")
+    h.update(blob)
+    h.update(json.dumps([ids, meta], sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _store(kind: str, blob: bytes, ids: List[str], meta: Dict[str, Any]) -> DiagnosisInput:
+    content_hash = _content_hash(kind, blob, ids, meta)
+
+    existing = DiagnosisInput.objects.filter(content_hash=content_hash).first()
+    if existing is not None:
+        return existing
+    try:
+        with transaction.atomic():
+            return DiagnosisInput.objects.create(
+                content_hash=content_hash,
+                kind=kind,
+                n_tracks=len(ids),
+                features=blob,
+                track_ids=ids,
+                meta=meta,
+            )
+    except IntegrityError:
+        # 同じ入力が同時に保存された
+        return DiagnosisInput.objects.get(content_hash=content_hash)
+
+
+def store_selected(tracks: List[Dict[str, Any]]) -> DiagnosisInput:
+    return _store(DiagnosisInput.KIND_SELECTED, *pack_selected(tracks))
+
+
+def store_selected_many(track_lists: Sequence[List[Dict[str, Any]]]) -> List[DiagnosisInput]:
+    """
+    store_selected の複数版（入力の並びで返す）。既存の SELECT 1回 + 新規の bulk_create 1回 + 読み直し1回。
+    """
+    kind = DiagnosisInput.KIND_SELECTED
+    packed = [pack_selected(tracks) for tracks in track_lists]
+    hashes = [_content_hash(kind, *p) for p in packed]
+    found = {i.content_hash: i for i in DiagnosisInput.objects.filter(content_hash__in=set(hashes))}
+    new: Dict[str, DiagnosisInput] = {}
+    for content_hash, (blob, ids, meta) in zip(hashes, packed):
+        if content_hash not in found and content_hash not in new:
+            new[content_hash] = DiagnosisInput(
+                content_hash=content_hash, kind=kind, n_tracks=len(ids), features=blob, track_ids=ids, meta=meta
+            )
+    if new:
+        # 同時に同じ入力が保存されても落ちないように ignore_conflicts にして、pk は読み直す
+        DiagnosisInput.objects.bulk_create(new.values(), ignore_conflicts=True)
+        found.update((i.content_hash, i) for i in DiagnosisInput.objects.filter(content_hash__in=list(new)))
+    return [found[h] for h in hashes]
+
+
+def store_spotify(
+    top_tracks_items: List[Dict[str, Any]],
+    audio_features_list: List[Dict[str, Any]],
+) -> DiagnosisInput:
+    return _store(DiagnosisInput.KIND_SPOTIFY, *pack_spotify(top_tracks_items, audio_features_list))
+
+
+# -------------------------
+# replay
+# -------------------------
+def rows(kind: str, raw: bytes, meta: Optional[Dict[str, Any]] = None) -> List[List[float]]:
+    a = _from_bytes(raw)
+    w = len(columns(kind, meta))
+    return [list(a[i : i + w]) for i in range(0, len(a), w)]
+
+
+def unique_artists(meta: Dict[str, Any]) -> int:
+    if "artist_ids" in meta:
+        return len({aid for ids in meta["artist_ids"] for aid in ids})
+    return int(meta.get("unique_artists", 0))
+
+
+def replay_selected(raw: bytes) -> Dict[str, float]:
+    """
+    selected 入力から compute_scores_from_selected_tracks をそのまま再実行する。
+    """
+    tracks = [dict(zip(SELECTED_KEYS, r)) for r in rows(DiagnosisInput.KIND_SELECTED, raw)]
+    return compute_scores_from_selected_tracks(tracks)
+
+
+def spotify_batch(inputs: Sequence[Tuple[bytes, List[str], Dict[str, Any]]]):
+    """
+    spotify 入力（features, track_ids, meta）の列を batch_scoring.BatchInput にする。
+    dict を経由しないので、保存済み入力の再計算はこれで一気に流せる。
+    """
+    import numpy as np
+
+    from .batch_scoring import N_FEATURES, BatchInput
+
+    width = max((len(ids) for _, ids, _ in inputs), default=0)
+    n = len(inputs)
+    features = np.zeros((n, width, N_FEATURES), dtype=np.float64)
+    valid = np.zeros((n, width), dtype=bool)
+    first = np.zeros((n, width), dtype=bool)
+    track_ids = np.full((n, width), "", dtype=object)
+    artists = np.zeros(n, dtype=np.int64)
+
+    for u, (raw, ids, meta) in enumerate(inputs):
+        k = len(ids)
+        if k:
+            cols = columns(DiagnosisInput.KIND_SPOTIFY, meta)
+            packed = np.frombuffer(bytes(raw), dtype="<f8").reshape(k, len(cols))
+            features[u, :k] = packed[:, [cols.index(c) for c in SPOTIFY_LEGACY_COLUMNS]]
+            valid[u, :k] = True
+            track_ids[u, :k] = ids
+            seen = set()
+            for j, tid in enumerate(ids):
+                if tid not in seen:
+                    seen.add(tid)
+                    first[u, j] = True
+        artists[u] = unique_artists(meta)
+
+    return BatchInput(features=features, valid=valid, first=first, track_ids=track_ids, unique_artists=artists)
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import json
+import secrets
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+# API レスポンスの JSON エンコード。
+# - orjson が入っていればそれを使い、無ければ標準の json（どちらも ensure_ascii なしの UTF-8、区切りの空白なし）
+# - 起動時に作る共有オブジェクト（type_catalog の info / track_dicts）は register_fragment() で
+#   エンコード済みの断片を登録しておき、トップレベルの値がそのオブジェクトなら断片をそのまま差し込む
+#   （orjson だと dict 1つをエンコードし直すほうが速いので、既定の "auto" では stdlib のときだけ）
+# JSON_RESPONSE.BACKEND: "auto"（既定）/ "orjson" / "stdlib"、FRAGMENTS: "auto" / True / False
+
+try:
+    import orjson
+except ImportError:  # 任意の依存
+    orjson = None
+
+
+def _conf() -> dict:
+    conf = {"BACKEND": "auto", "FRAGMENTS": "auto"}
+    conf.update(getattr(settings, "JSON_RESPONSE", {}))
+    return conf
+
+
+_django_default = DjangoJSONEncoder().default
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), cls=DjangoJSONEncoder).encode("utf-8")
+
+
+def _orjson_dumps(obj: Any) -> bytes:
+    # datetime は orjson がそのまま書く。Decimal / UUID / lazy str などは Django の encoder に任せる
+    return orjson.dumps(obj, default=_django_default)
+
+
+BACKENDS: Dict[str, Callable[[Any], bytes]] = {"stdlib": _stdlib_dumps}
+if orjson is not None:
+    BACKENDS["orjson"] = _orjson_dumps
+
+
+def backend_name(name: Optional[str] = None) -> str:
+    name = name or _conf()["BACKEND"]
+    if name == "auto":
+        return "orjson" if "orjson" in BACKENDS else "stdlib"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown or unavailable JSON backend: {name}")
+    return name
+
+
+# -------------------------
+# pre-encoded fragments
+# -------------------------
+# id(obj) -> (obj, エンコード済み bytes)。obj も持っておくので id が使い回されることはない
+_fragments: Dict[int, tuple] = {}
+_fragments_lock = threading.Lock()
+_MARK = secrets.token_hex(8)
+
+
+def register_fragment(obj: Any, encoded: Optional[bytes] = None) -> bytes:
+    """
+    プロセス中ずっと書き換えない共有オブジェクトを登録し、エンコード済みの断片を返す。
+    """
+    if encoded is None:
+        encoded = _stdlib_dumps(obj)
+    with _fragments_lock:
+        _fragments[id(obj)] = (obj, encoded)
+    return encoded
+
+
+def _fragment(value: Any) -> Optional[bytes]:
+    hit = _fragments.get(id(value))
+    if hit is not None and hit[0] is value:
+        return hit[1]
+    return None
+
+
+def dumps(obj: Any, backend: Optional[str] = None, fragments: Optional[bool] = None) -> bytes:
+    """
+    obj を UTF-8 の JSON bytes にする。
+    """
+    name = backend_name(backend)
+    enc = BACKENDS[name]
+    if fragments is None:
+        fragments = _conf()["FRAGMENTS"]
+        if fragments == "auto":
+            fragments = name == "stdlib"
+    if not fragments or not isinstance(obj, dict) or not _fragments:
+        return enc(obj)
+    # 断片の値を目印の文字列に置き換えて1回でエンコードし、目印を断片に差し替える
+    # （目印は NUL + プロセスごとの乱数。NUL は JSON では必ず "\u0000" になる）
+    swapped = None
+    raws = []
+    for k, v in obj.items():
+        raw = _fragment(v)
+        if raw is None:
+            continue
+        if swapped is None:
+            swapped = dict(obj)
+        swapped[k] = f"\x00{_MARK}{len(raws)}\x00"
+        raws.append((b'"\\u0000%s%d\\u0000"' % (_MARK.encode(), len(raws)), raw))
+    if swapped is None:
+        return enc(obj)
+    body = enc(swapped)
+    for mark, raw in raws:
+        body = body.replace(mark, raw, 1)
+    return body
+
+
+class FastJsonResponse(HttpResponse):
+    """
+    JsonResponse の置き換え（encoder / json_dumps_params は取らない）。エンコードは dumps()。
+    """
+
+    def __init__(self, data: Any, safe: bool = True, **kwargs) -> None:
+        if safe and not isinstance(data, dict):
+            raise TypeError("In order to allow non-dict objects to be serialized set the safe parameter to False.")
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=dumps(data), **kwargs)
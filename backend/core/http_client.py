@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import asyncio
+import ssl
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (method, url, status, elapsed_sec) -> None
+# status は例外で終わった場合 0
+TimingHook = Callable[[str, str, int, float], None]
+
+# 送り直してよいメソッド。POST（token endpoint の一度きりの認可コードなど）は、
+# 送れていないことが確かな接続失敗のときだけ送り直す
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+class _Retry(Retry):
+    """
+    Retry-After を max_retry_after 秒で頭打ちにする Retry（長い値でワーカーを止めない）。
+    """
+
+    def __init__(self, *args: Any, max_retry_after: float = 10.0, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_retry_after = max_retry_after
+
+    def new(self, **kw: Any) -> "_Retry":
+        retry = super().new(**kw)
+        retry.max_retry_after = self.max_retry_after
+        return retry
+
+    def get_retry_after(self, response: Any) -> Optional[float]:
+        value = super().get_retry_after(response)
+        if value is None:
+            return None
+        return min(value, self.max_retry_after)
+
+
+class HttpClient:
+    """
+    外部API呼び出し用の共有クライアント。
+    - keep-alive（requests.Session + urllib3 のコネクションプール）
+    - ホストごとにプールサイズを設定できる
+    - 429/5xx・読み取り失敗は冪等なメソッドだけ backoff 付きでリトライ（Retry-After ヘッダを優先、
+      max_retry_after 秒まで）。POST は接続できなかったときだけ送り直す
+    - 呼び出しごとの所要時間をフックに通知
+
+    Session のアダプタは mount 後に変更しないので、スレッド間で共有してOK。
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        pool_sizes: Optional[Dict[str, int]] = None,
+        default_pool_size: int = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.3,
+        timeout: float = 15.0,
+        max_retry_after: float = 10.0,
+    ) -> None:
+        self.timeout = timeout
+        self.max_retry_after = max_retry_after
+        self._hooks: List[TimingHook] = []
+        self._hooks_lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter(default_pool_size, retries, backoff_factor))
+        self.session.mount("https://", self._adapter(default_pool_size, retries, backoff_factor))
+
+        # より長い prefix が優先されるので、ホスト単位の設定が既定を上書きする
+        for base, size in (pool_sizes or {}).items():
+            parts = urlsplit(base)
+            prefix = f"{parts.scheme}://{parts.netloc}"
+            self.session.mount(prefix, self._adapter(size, retries, backoff_factor))
+
+    def _adapter(self, pool_size: int, retries: int, backoff_factor: float) -> HTTPAdapter:
+        retry = _Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=self.RETRY_STATUSES,
+            # 読み取り失敗・status でのリトライは冪等なメソッドだけ（接続失敗はメソッドによらず送り直す）
+            allowed_methods=IDEMPOTENT_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            max_retry_after=self.max_retry_after,
+        )
+        return HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(1, int(pool_size)),
+            max_retries=retry,
+            pool_block=False,
+        )
+
+    # -------------------------
+    # timing hooks
+    # -------------------------
+    def add_timing_hook(self, hook: TimingHook) -> None:
+        with self._hooks_lock:
+            self._hooks.append(hook)
+
+    def remove_timing_hook(self, hook: TimingHook) -> None:
+        with self._hooks_lock:
+            if hook in self._hooks:
+                self._hooks.remove(hook)
+
+    def _emit(self, method: str, url: str, status: int, elapsed: float) -> None:
+        with self._hooks_lock:
+            hooks = list(self._hooks)
+        for h in hooks:
+            try:
+                h(method, url, status, elapsed)
+            except Exception:
+                # 計測フックの失敗で本処理を落とさない
+                pass
+
+    # -------------------------
+    # requests
+    # -------------------------
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        status = 0
+        t0 = time.perf_counter()
+        try:
+            r = self.session.request(method, url, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            self._emit(method, url, status, time.perf_counter() - t0)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncHttpClient:
+    """
+    HttpClient の非同期版（httpx.AsyncClient）。async view から使う。
+    httpx 自体は接続失敗しかリトライしないので、429/5xx のリトライはここでやる（冪等なメソッドだけ）。
+    AsyncClient はイベントループに紐づくので、ループごとに1つ作る（get_async_client）。
+    SSLContext はループに依存しないのでプロセスで1つを共有する（作るのが重い）。
+    """
+
+    RETRY_STATUSES = HttpClient.RETRY_STATUSES
+
+    def __init__(
+        self,
+        pool_sizes: Optional[Dict[str, int]] = None,
+        default_pool_size: int = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.3,
+        timeout: float = 15.0,
+        max_retry_after: float = 10.0,
+    ) -> None:
+        import httpx
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self._hooks: List[TimingHook] = []
+        self._closer: "Optional[asyncio.Task[None]]" = None  # get_async_client が付ける
+
+        # httpx はホスト単位の上限を持たないので、合計を上限にする
+        total = default_pool_size + sum((pool_sizes or {}).values())
+        # transport を渡すと AsyncClient 側の limits / verify は使われないので transport に渡す
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            transport=httpx.AsyncHTTPTransport(
+                verify=_shared_ssl_context(),
+                limits=httpx.Limits(max_connections=total, max_keepalive_connections=total),
+                retries=retries,
+            ),
+        )
+
+    def add_timing_hook(self, hook: TimingHook) -> None:
+        self._hooks.append(hook)
+
+    def remove_timing_hook(self, hook: TimingHook) -> None:
+        if hook in self._hooks:
+            self._hooks.remove(hook)
+
+    def _retry_after(self, value: Optional[str], attempt: int) -> float:
+        return min(self._parse_retry_after(value, attempt), self.max_retry_after)
+
+    def _parse_retry_after(self, value: Optional[str], attempt: int) -> float:
+        backoff = self.backoff_factor * (2 ** attempt)
+        if not value:
+            return backoff
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except Exception:
+            return backoff
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> Any:
+        status = 0
+        t0 = time.perf_counter()
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+        try:
+            for attempt in range(retries + 1):
+                r = await self.client.request(method, url, **kwargs)
+                status = r.status_code
+                if status not in self.RETRY_STATUSES or attempt == retries:
+                    return r
+                await asyncio.sleep(self._retry_after(r.headers.get("Retry-After"), attempt))
+            return r
+        finally:
+            elapsed = time.perf_counter() - t0
+            for h in list(self._hooks):
+                try:
+                    h(method, url, status, elapsed)
+                except Exception:
+                    pass
+
+    async def get(self, url: str, **kwargs: Any) -> Any:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> Any:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+_client: Optional[HttpClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    """
+    プロセス共有のクライアントを返す（初回だけ生成）。
+    設定は settings.HTTP_CLIENT（HttpClient の引数）で上書きできる。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HttpClient(**_settings_kwargs())
+    return _client
+
+
+def set_client(client: Optional[HttpClient]) -> None:
+    """
+    共有クライアントを差し替える（テストでスタブサーバ向けに使う）。
+    None を渡すと次の get_client() で作り直す。
+    """
+    global _client
+    with _client_lock:
+        old, _client = _client, client
+    if old is not None and old is not client:
+        old.close()
+
+
+_ssl_context: Optional[ssl.SSLContext] = None
+
+
+def _shared_ssl_context() -> ssl.SSLContext:
+    global _ssl_context
+    if _ssl_context is None:
+        with _client_lock:
+            if _ssl_context is None:
+                import httpx
+
+                _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncHttpClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+async def _close_with_loop(loop: asyncio.AbstractEventLoop, client: AsyncHttpClient) -> None:
+    # ループの終わり（asyncio.run / async_to_sync / ASGI サーバの停止）で残りのタスクと一緒に
+    # キャンセルされたら、接続を閉じる
+    try:
+        await loop.create_future()
+    finally:
+        if _async_clients.get(loop) is client:
+            del _async_clients[loop]
+        await client.aclose()
+
+
+def get_async_client() -> AsyncHttpClient:
+    """
+    実行中のイベントループ用の AsyncHttpClient を返す（ループごとに1つ、ループが終わるときに閉じる）。
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncHttpClient(**_settings_kwargs())
+        # タスクはループからは弱参照なので、client に持たせておく
+        client._closer = loop.create_task(_close_with_loop(loop, client))
+    return client
+
+
+def _settings_kwargs() -> Dict[str, Any]:
+    try:
+        from django.conf import settings
+
+        return dict(getattr(settings, "HTTP_CLIENT", {}))
+    except Exception:
+        return {}
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Dict, Iterator
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from .fast_json import FastJsonResponse
+from .jobs import enqueue
+from .models import DiagnosisJob
+
+# 診断ジョブの API（core.jobs）。
+# POST /api/diagnose/jobs で積んで 202、あとは status をポーリングするか events（SSE）を購読する。
+
+
+def _status_url(job_id: str) -> str:
+    return f"/api/diagnose/jobs/{job_id}"
+
+
+def _payload(job: DiagnosisJob) -> Dict[str, Any]:
+    body: Dict[str, Any] = {
+        "job_id": job.pk,
+        "status": job.status,
+        "progress": job.progress,
+        "stage": job.stage,
+        "attempts": job.attempts,
+    }
+    if job.status == DiagnosisJob.STATUS_DONE:
+        body["result"] = job.result
+    elif job.status == DiagnosisJob.STATUS_FAILED:
+        body["error"] = job.error.splitlines()[0] if job.error else ""
+    return body
+
+
+def _get_own_job(request, job_id: str):
+    if not request.user.is_authenticated:
+        return None, FastJsonResponse({"error": "unauthorized"}, status=401)
+    job = DiagnosisJob.objects.filter(pk=job_id, user_id=request.user.id).first()
+    if job is None:
+        # 他人のジョブも not_found にする（id の存在を漏らさない）
+        return None, FastJsonResponse({"error": "not_found"}, status=404)
+    return job, None
+
+
+@csrf_exempt
+@require_POST
+def create_job(request):
+    if not request.user.is_authenticated:
+        return FastJsonResponse({"error": "unauthorized"}, status=401)
+
+    job = enqueue(request.user)
+    response = FastJsonResponse(
+        {
+            "job_id": job.pk,
+            "status": job.status,
+            "status_url": _status_url(job.pk),
+            "events_url": f"{_status_url(job.pk)}/events",
+        },
+        status=202,
+    )
+    response["Location"] = _status_url(job.pk)
+    return response
+
+
+@require_GET
+def job_status(request, job_id: str):
+    job, error = _get_own_job(request, job_id)
+    if error is not None:
+        return error
+    response = FastJsonResponse(_payload(job))
+    if not job.finished:
+        response["Retry-After"] = "1"
+    return response
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _events(job_id: str, interval: float, timeout: float) -> Iterator[str]:
+    deadline = time.monotonic() + timeout
+    last = None
+    try:
+        while True:
+            job = DiagnosisJob.objects.filter(pk=job_id).first()
+            if job is None:
+                yield _sse("error", {"error": "not_found"})
+                return
+            body = _payload(job)
+            state = (job.status, job.progress, job.stage, job.attempts)
+            if state != last:
+                last = state
+                yield _sse(job.status if job.finished else "progress", body)
+            if job.finished:
+                return
+            if time.monotonic() >= deadline:
+                # クライアントは status_url のポーリングか再接続で続きを取る
+                yield _sse("timeout", {"job_id": job_id, "status_url": _status_url(job_id)})
+                return
+            time.sleep(interval)
+    finally:
+        # ストリーム中はリクエスト終了シグナルの外で DB を使うので自分で閉じる
+        close_old_connections()
+
+
+@require_GET
+def job_events(request, job_id: str):
+    """
+    進捗を Server-Sent Events で流す。終わったら done / failed を1つ送って閉じる。
+    WSGI ではストリーム中ワーカーを1本使うので、長く待つならポーリングの方が軽い。
+    """
+    job, error = _get_own_job(request, job_id)
+    if error is not None:
+        return error
+
+    conf = getattr(settings, "DIAGNOSIS_JOBS", {})
+    response = StreamingHttpResponse(
+        _events(job.pk, conf.get("SSE_POLL_INTERVAL", 0.5), conf.get("SSE_TIMEOUT", 60)),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DiagnosisJob, DiagnosisResult
+
+# Spotify 診断をリクエストの外で走らせるジョブキュー。
+# - MODE="local": このプロセスのスレッドプールで走らせる（WORKERS 本まで同時実行）
+# - MODE="db"   : DiagnosisJob を積むだけ。manage.py run_diagnosis_jobs が拾って走らせる
+# どちらも状態は DiagnosisJob に書くので、ステータス API は同じ。
+# local モードのキュー（executor・再試行の Timer）はメモリにしかないので、起動時に
+# sweep() で queued のジョブと止まった running のジョブを拾い直す（core.warmup から）。
+
+
+def _conf() -> dict:
+    conf = {
+        "MODE": "local",
+        "WORKERS": 4,
+        "MAX_ATTEMPTS": 3,
+        "RETRY_BACKOFF": 2.0,
+        "STALE_AFTER": 300.0,
+        "SWEEP_AT_STARTUP": True,
+    }
+    conf.update(getattr(settings, "DIAGNOSIS_JOBS", {}))
+    return conf
+
+
+# -------------------------
+# job 1件の実行
+# -------------------------
+def claim(job_id: str) -> Optional[DiagnosisJob]:
+    """
+    queued かつ run_after を過ぎたジョブを running にする。取れなければ None。
+    条件付き UPDATE 1文なので、複数ワーカー/プロセスが同時に取りに来ても1つしか勝たない。
+    """
+    n = DiagnosisJob.objects.filter(
+        pk=job_id,
+        status=DiagnosisJob.STATUS_QUEUED,
+        run_after__lte=timezone.now(),
+    ).update(
+        status=DiagnosisJob.STATUS_RUNNING,
+        attempts=F("attempts") + 1,
+        progress=0,
+        stage="",
+        updated_at=timezone.now(),
+    )
+    if n == 0:
+        return None
+    return DiagnosisJob.objects.select_related("user").get(pk=job_id)
+
+
+class _Superseded(Exception):
+    """
+    このワーカーが実行中に、ジョブが積み直されて別の実行に渡った。
+    """
+
+
+def run_job(job_id: str, max_attempts: int, retry_backoff: float) -> Optional[float]:
+    """
+    ジョブを1回実行する。失敗して再試行するなら、何秒後に再実行すべきかを返す。
+    結果（DiagnosisResult）の保存と done への更新は1トランザクションで行うので、
+    結果だけ書かれて再試行され、同じジョブの結果が2つできることはない。
+    """
+    from .views import run_diagnosis
+
+    job = claim(job_id)
+    if job is None:
+        return None
+    # この実行の行だけを更新する（止まったと見なされて積み直された後なら 0 件）
+    mine = DiagnosisJob.objects.filter(pk=job_id, status=DiagnosisJob.STATUS_RUNNING, attempts=job.attempts)
+
+    def progress(percent: int, stage: str) -> None:
+        mine.update(progress=percent, stage=stage, updated_at=timezone.now())
+
+    try:
+        pending: List[DiagnosisResult] = []
+        result = run_diagnosis(job.user, progress=progress, save=pending.append)
+        with transaction.atomic():
+            for r in pending:
+                r.save()
+            n = mine.update(
+                status=DiagnosisJob.STATUS_DONE,
+                progress=100,
+                stage="done",
+                result=result,
+                error="",
+                updated_at=timezone.now(),
+            )
+            if n == 0:
+                raise _Superseded(job_id)  # 結果の保存ごと取り消す
+    except _Superseded:
+        return None
+    except Exception as e:
+        retry = job.attempts < max_attempts
+        delay = retry_backoff * (2 ** (job.attempts - 1))
+        mine.update(
+            status=DiagnosisJob.STATUS_QUEUED if retry else DiagnosisJob.STATUS_FAILED,
+            run_after=timezone.now() + timedelta(seconds=delay),
+            error=f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}",
+            updated_at=timezone.now(),
+        )
+        return delay if retry else None
+    return None
+
+
+def runnable_ids(limit: int) -> List[str]:
+    return list(
+        DiagnosisJob.objects.filter(status=DiagnosisJob.STATUS_QUEUED, run_after__lte=timezone.now())
+        .order_by("run_after")
+        .values_list("pk", flat=True)[:limit]
+    )
+
+
+def requeue_stale(older_than: float) -> int:
+    """
+    running のまま older_than 秒更新が無いジョブ（ワーカーが落ちた等）を queued に戻す。
+    """
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return DiagnosisJob.objects.filter(status=DiagnosisJob.STATUS_RUNNING, updated_at__lt=cutoff).update(
+        status=DiagnosisJob.STATUS_QUEUED,
+        run_after=timezone.now(),
+        updated_at=timezone.now(),
+    )
+
+
+# -------------------------
+# local queue
+# -------------------------
+class LocalJobQueue:
+    """
+    プロセス内スレッドプール。同時実行は workers 本まで、残りは executor のキューで待つ。
+    再試行は run_after まで Timer で待ってから積み直す。
+    """
+
+    def __init__(self, workers: int = 4, max_attempts: int = 3, retry_backoff: float = 2.0) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="diagnosis-job")
+
+    def submit(self, job_id: str) -> None:
+        self._executor.submit(self._run, job_id)
+
+    def submit_after(self, job_id: str, delay: float) -> None:
+        if delay <= 0:
+            self.submit(job_id)
+            return
+        t = threading.Timer(delay, self.submit, args=(job_id,))
+        t.daemon = True
+        t.start()
+
+    def _run(self, job_id: str) -> None:
+        try:
+            delay = run_job(job_id, self.max_attempts, self.retry_backoff)
+        finally:
+            close_old_connections()
+        if delay is not None:
+            self.submit_after(job_id, delay)
+
+    def sweep(self, stale_after: float) -> int:
+        """
+        DB に残っているジョブを拾い直す（前のプロセスの executor や Timer にあって失われたもの）。
+        running のまま stale_after 秒更新が無いものは queued に戻し、queued は run_after に合わせて積む。
+        まだ止まったとは言えない running が残っていれば、それが stale になる頃にもう一度掃除する。
+        拾ったジョブ数を返す。他のプロセスと同じジョブを積んでも、claim で1つしか走らない。
+        """
+        requeue_stale(stale_after)
+        now = timezone.now()
+        queued = DiagnosisJob.objects.filter(status=DiagnosisJob.STATUS_QUEUED).values_list("pk", "run_after")
+        n = 0
+        for job_id, run_after in queued:
+            self.submit_after(job_id, (run_after - now).total_seconds())
+            n += 1
+        oldest = (
+            DiagnosisJob.objects.filter(status=DiagnosisJob.STATUS_RUNNING)
+            .order_by("updated_at")
+            .values_list("updated_at", flat=True)
+            .first()
+        )
+        if oldest is not None:
+            delay = (oldest - now).total_seconds() + stale_after + 1
+            t = threading.Timer(max(delay, 1.0), self._sweep_later, args=(stale_after,))
+            t.daemon = True
+            t.start()
+        return n
+
+    def _sweep_later(self, stale_after: float) -> None:
+        try:
+            self.sweep(stale_after)
+        finally:
+            close_old_connections()
+
+
+_queue: Optional[LocalJobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_local_queue() -> LocalJobQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                conf = _conf()
+                _queue = LocalJobQueue(
+                    workers=conf["WORKERS"],
+                    max_attempts=conf["MAX_ATTEMPTS"],
+                    retry_backoff=conf["RETRY_BACKOFF"],
+                )
+    return _queue
+
+
+def sweep() -> int:
+    """
+    local モードの起動時の掃除（LocalJobQueue.sweep）。db モードでは何もしない（ワーカーが拾う）。
+    """
+    conf = _conf()
+    if conf["MODE"] != "local":
+        return 0
+    return get_local_queue().sweep(conf["STALE_AFTER"])
+
+
+def enqueue(user: User) -> DiagnosisJob:
+    """
+    診断ジョブを積む。local モードならコミット後にこのプロセスのワーカーへ渡す。
+    """
+    job = DiagnosisJob.objects.create(id=uuid.uuid4().hex, user=user, run_after=timezone.now())
+    if _conf()["MODE"] == "local":
+        transaction.on_commit(lambda: get_local_queue().submit(job.pk))
+    return job
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+
+from core import track_views
+from core.search_cache import get_search_cache
+from core.upstream_stubs import StubServer
+
+
+def _summary(name: str, latencies: List[float], wall: float) -> Dict[str, float]:
+    lat = sorted(latencies)
+    n = len(lat)
+    return {
+        "mode": name,
+        "requests": n,
+        "wall_sec": round(wall, 3),
+        "rps": round(n / wall, 1) if wall else 0.0,
+        "p50_ms": round(lat[n // 2] * 1000, 1) if n else 0.0,
+        "p99_ms": round(lat[min(n - 1, int(n * 0.99))] * 1000, 1) if n else 0.0,
+    }
+
+
+class Command(BaseCommand):
+    help = "sync / async の /api/tracks/search を、遅いローカル upstream に対して同時実行で比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--latency", type=float, default=0.2, help="stub upstream の遅延（秒）")
+        parser.add_argument("--sync-workers", type=int, default=8, help="sync 側のワーカースレッド数")
+        parser.add_argument("--concurrency", type=int, default=200, help="async 側の同時リクエスト数")
+
+    @override_settings(ALLOWED_HOSTS=["testserver"])
+    def handle(self, *args, **opts):
+        stub = StubServer(latency=opts["latency"]).start()
+        track_views.ITUNES_SEARCH_URL = f"{stub.base_url}/search"
+        # クエリは毎回ユニークにして、キャッシュではなく upstream 待ちを測る
+        n = opts["requests"]
+        try:
+            results = [
+                self._run_sync(n, opts["sync_workers"]),
+                asyncio.run(self._run_async(n, opts["concurrency"])),
+            ]
+        finally:
+            stub.stop()
+
+        for r in results:
+            self.stdout.write(
+                f"{r['mode']:>5}: {r['requests']} req in {r['wall_sec']}s "
+                f"-> {r['rps']} req/s (p50 {r['p50_ms']}ms, p99 {r['p99_ms']}ms)"
+            )
+        self.stdout.write(f"search cache: {get_search_cache().stats()}")
+
+    def _run_sync(self, n: int, workers: int) -> Dict[str, float]:
+        client = Client()
+
+        def one(i: int) -> float:
+            t0 = time.perf_counter()
+            r = client.get("/api/tracks/search", {"q": f"sync {i}"})
+            assert r.status_code == 200, r.content
+            return time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            lat = list(ex.map(one, range(n)))
+        return _summary("sync", lat, time.perf_counter() - t0)
+
+    async def _run_async(self, n: int, concurrency: int) -> Dict[str, float]:
+        client = AsyncClient()
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(i: int) -> float:
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.get("/api/async/tracks/search", {"q": f"async {i}"})
+                assert r.status_code == 200, r.content
+                return time.perf_counter() - t0
+
+        # upstream 側の同時接続数が律速にならないようにプールを広げる
+        with override_settings(HTTP_CLIENT={"default_pool_size": concurrency}):
+            t0 = time.perf_counter()
+            lat = await asyncio.gather(*(one(i) for i in range(n)))
+        return _summary("async", list(lat), time.perf_counter() - t0)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import json
+import random
+import time
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import get_runner
+
+from core import write_behind
+from core.management.commands.bench_sessions import _Counter
+
+TOKEN = "bench-token"
+
+
+def _entries(rng: random.Random, n: int, prefix: str) -> List[Dict[str, Any]]:
+    return [
+        {
+            "user": f"{prefix}{i}",
+            "tracks": [
+                {"id": f"t{rng.randrange(10**6)}", "tempo": rng.random(), "bright": rng.random(), "electro": rng.random(), "explore": rng.random()}
+                for _ in range(5)
+            ],
+        }
+        for i in range(n)
+    ]
+
+
+class Command(BaseCommand):
+    help = "N ユーザー分の診断を、diagnose_from_tracks のループと /api/diagnose/batch の1回で比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=500)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        rng = random.Random(opts["seed"])
+        n = opts["users"]
+        runner = get_runner(settings)(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            with override_settings(ALLOWED_HOSTS=["testserver"], BATCH_DIAGNOSIS={"TOKENS": {TOKEN: "bench"}, "MAX_ENTRIES": max(1000, n)}):
+                self._loop(_entries(rng, n, "loop_"))
+                self._batch(_entries(rng, n, "bench."))
+        finally:
+            write_behind.set_buffer(None)
+            runner.teardown_databases(old_config)
+
+    def _report(self, label: str, n: int, seconds: float, queries: int, extra: str = "") -> None:
+        self.stdout.write(
+            f"{label:>6}: {n} users in {seconds * 1000:8.1f}ms ({n / seconds:8.1f} users/s)  {queries} queries{extra}"
+        )
+
+    def _loop(self, entries: List[Dict[str, Any]]) -> None:
+        # 提携先が今やっていること: ユーザーごとにログインして1件ずつ POST（ログインは計測に入れない）
+        users = User.objects.bulk_create([User(username=e["user"]) for e in entries])
+        clients = []
+        for u in users:
+            c = Client()
+            c.force_login(u)
+            clients.append(c)
+        counter = _Counter()
+        with connection.execute_wrapper(counter):
+            t0 = time.perf_counter()
+            for c, e in zip(clients, entries):
+                r = c.post("/api/diagnose_from_tracks", json.dumps({"tracks": e["tracks"]}), content_type="application/json")
+                if r.status_code != 200:
+                    raise CommandError(f"loop: {r.status_code} {r.content[:200]!r}")
+            buf = write_behind.get_buffer()
+            if buf is not None:
+                buf.flush()
+            seconds = time.perf_counter() - t0
+        self._report("loop", len(entries), seconds, counter.total)
+
+    def _batch(self, entries: List[Dict[str, Any]]) -> None:
+        counter = _Counter()
+        with connection.execute_wrapper(counter):
+            t0 = time.perf_counter()
+            r = Client().post(
+                "/api/diagnose/batch",
+                json.dumps({"entries": entries}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {TOKEN}",
+            )
+            stream = iter(r.streaming_content)
+            first = next(stream)
+            t_first = time.perf_counter() - t0
+            last = b"".join(stream).splitlines()[-1]
+            seconds = time.perf_counter() - t0
+        done = json.loads(last)
+        if done.get("saved") != len(entries):
+            raise CommandError(f"batch: {first!r} ... {last!r}")
+        self._report("batch", len(entries), seconds, counter.total, f"  first line after {t_first * 1000:.2f}ms")
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import random
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from django.core.management.base import BaseCommand
+
+from core import compact, compression, fast_json
+
+
+def realistic_items(rng: random.Random, n: int = 20) -> List[Dict[str, Any]]:
+    # iTunes Search の実レスポンスに近い URL（CDN のホスト番号やパスが曲ごとに違う）
+    items = []
+    for i in range(n):
+        tid = rng.randrange(10**9, 2 * 10**9)
+        album = rng.randrange(10**9, 2 * 10**9)
+        h = uuid.UUID(int=rng.getrandbits(128))
+        path = f"Music{rng.randint(112, 126)}/v4/{h.hex[:2]}/{h.hex[2:4]}/{h.hex[4:6]}/{h}"
+        items.append(
+            {
+                "id": str(tid),
+                "title": f"夜に駆ける {i}" if i % 2 else f"Night Drive {i}",
+                "artist": rng.choice(["YOASOBI", "Ado", "米津玄師", "King Gnu", "Vaundy"]),
+                "artwork": f"https://is{rng.randint(1, 5)}-ssl.mzstatic.com/image/thumb/{path}/{rng.choice(['4547366', '1976'])}{tid}.jpg/100x100bb.jpg",
+                "preview_url": f"https://audio-ssl.itunes.apple.com/itunes-assets/AudioPreview{rng.randint(112, 126)}/v4/{h.hex[6:8]}/{h.hex[8:10]}/{h.hex[10:12]}/{h}/mzaf_{tid}.plus.aac.p.m4a",
+                "external_url": f"https://music.apple.com/jp/album/{album}?i={tid}&uo=4",
+            }
+        )
+    return items
+
+
+MODES = {
+    "full": dict(fields=None, compact=False),
+    "fields": dict(fields=("id", "title", "artist", "artwork"), compact=False),
+    "compact": dict(fields=None, compact=True),
+    "fields+compact": dict(fields=("id", "title", "artist", "artwork"), compact=True),
+}
+
+
+class Command(BaseCommand):
+    help = "/api/tracks/search のレスポンスを、表現（full / fields / compact）× 圧縮（identity / gzip / br）で比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        items = realistic_items(random.Random(opts["seed"]))
+        compressors: Dict[str, Optional[Callable[[bytes], bytes]]] = {"identity": None}
+        compressors.update(compression._compressors(compression._conf()))
+        if "br" not in compressors:
+            self.stdout.write("brotli is not installed: br skipped")
+        n = opts["iterations"]
+        base = None
+        for mode, kw in MODES.items():
+            payload = compact.search_payload(items, **kw)
+            if kw["compact"]:
+                restored = compact.expand_urls(payload["items"], payload["prefixes"])
+                expected = compact.select_fields(items, kw["fields"]) if kw["fields"] else items
+                assert restored == expected, mode
+            for coding, compress in compressors.items():
+                t0 = time.perf_counter()
+                for _ in range(n):
+                    body = fast_json.dumps(compact.search_payload(items, **kw))
+                    if compress is not None:
+                        body = compress(body)
+                us = (time.perf_counter() - t0) / n * 1e6
+                if base is None:
+                    base = len(body)
+                self.stdout.write(f"{mode:>15} {coding:>8}: {len(body):6d} bytes ({len(body) / base * 100:5.1f}%)  {us:7.1f}us CPU/response")
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+
+from config.db import SQLITE_PROFILES, sqlite_options
+from core.models import DiagnosisResult, LatestDiagnosis
+
+
+class Command(BaseCommand):
+    help = "同時書き込み（DiagnosisResult の作成 + 最新結果の付け替え）を SQLite のプロファイルごとに比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--writes", type=int, default=200, help="スレッドごとの書き込み回数")
+        parser.add_argument("--readers", type=int, default=2, help="同時に読み続けるスレッド数")
+        parser.add_argument("--profiles", default=",".join(reversed(SQLITE_PROFILES)))
+
+    def handle(self, *args, **opts):
+        if connection.vendor != "sqlite":
+            raise CommandError("SQLite のプロファイル比較用（Postgres は DB_ENGINE=postgres のまま他のベンチで見る）")
+        profiles = [p for p in opts["profiles"].split(",") if p]
+        saved_options = connection.settings_dict.get("OPTIONS", {})
+        tmpdir = tempfile.mkdtemp(prefix="bench-db-")
+        try:
+            for profile in profiles:
+                self._run(profile, tmpdir, opts)
+        finally:
+            connection.settings_dict["OPTIONS"] = saved_options
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _run(self, profile: str, tmpdir: str, opts: Dict[str, Any]) -> None:
+        # 新しいスレッドの接続も同じ settings_dict から作られるので、ここを差し替えれば全員に効く
+        connection.settings_dict["OPTIONS"] = sqlite_options(profile)
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tmpdir, f"{profile}.sqlite3")
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users = [User(username=f"bench{i}") for i in range(opts["threads"])]
+            User.objects.bulk_create(users)
+            users = list(User.objects.filter(username__startswith="bench").order_by("pk"))
+            self._measure(profile, users, opts)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _measure(self, profile: str, users: List[User], opts: Dict[str, Any]) -> None:
+        stop = threading.Event()
+        lat: List[float] = []
+        errors = {"locked": 0, "other": 0}
+        reads = [0]
+        lock = threading.Lock()
+
+        def writer(user: User) -> None:
+            rng = np.random.default_rng(user.pk)
+            try:
+                for _ in range(opts["writes"]):
+                    e, m, t, x = rng.random(4).round(4).tolist()
+                    t0 = time.perf_counter()
+                    try:
+                        with transaction.atomic():
+                            r = DiagnosisResult.objects.create(
+                                user=user,
+                                type_code="AbcD",
+                                energy_score=e,
+                                mood_score=m,
+                                texture_score=t,
+                                explore_score=x,
+                                sample_track_ids=[],
+                            )
+                            LatestDiagnosis.point_to([r])
+                    except OperationalError as ex:
+                        with lock:
+                            errors["locked" if "locked" in str(ex) else "other"] += 1
+                        continue
+                    with lock:
+                        lat.append(time.perf_counter() - t0)
+            finally:
+                connection.close()
+
+        def reader() -> None:
+            try:
+                while not stop.is_set():
+                    list(LatestDiagnosis.objects.select_related("result")[:50])
+                    reads[0] += 1
+            except OperationalError:
+                with lock:
+                    errors["other"] += 1
+            finally:
+                connection.close()
+
+        readers = [threading.Thread(target=reader) for _ in range(opts["readers"])]
+        for th in readers:
+            th.start()
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(users)) as pool:
+            list(pool.map(writer, users))
+        wall = time.perf_counter() - t0
+        stop.set()
+        for th in readers:
+            th.join()
+
+        ms = np.array(lat) * 1000 if lat else np.zeros(1)
+        total = len(users) * opts["writes"]
+        self.stdout.write(
+            f"{profile:>8}: {len(lat) / wall:8.1f} writes/s  p50 {np.percentile(ms, 50):7.2f}ms  "
+            f"p99 {np.percentile(ms, 99):8.2f}ms  ok {len(lat)}/{total}  locked {errors['locked']}  "
+            f"other errors {errors['other']}  reads {reads[0]}"
+        )
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from core import fast_json, type_catalog
+from core.models import DiagnosisResult
+from core.result_cache import payload_for
+from core.track_views import itunes_items
+from core.upstream_stubs import fake_itunes_results
+
+
+def _payloads() -> Dict[str, Any]:
+    user = User(username="bench_user", first_name="ベンチ")
+    latest = DiagnosisResult(
+        user=user,
+        type_code="ABcD",
+        energy_score=72,
+        mood_score=64,
+        texture_score=31,
+        explore_score=58,
+        sample_track_ids=[f"t{i}" for i in range(5)],
+        computed_at=timezone.now(),
+    )
+    tracks = itunes_items(fake_itunes_results("夜に駆ける", 20))
+    return {"result_json": payload_for(user, latest), "tracks_search": {"items": tracks}}
+
+
+def _encoders() -> List[Tuple[str, Callable[[Any], bytes]]]:
+    out = [
+        # これまでの JsonResponse（DjangoJSONEncoder、ensure_ascii=True）
+        ("JsonResponse", lambda obj: json.dumps(obj, cls=DjangoJSONEncoder).encode("utf-8")),
+        ("stdlib", lambda obj: fast_json.dumps(obj, backend="stdlib", fragments=False)),
+        ("stdlib+fragments", lambda obj: fast_json.dumps(obj, backend="stdlib", fragments=True)),
+    ]
+    if "orjson" in fast_json.BACKENDS:
+        out += [
+            ("orjson", lambda obj: fast_json.dumps(obj, backend="orjson", fragments=False)),
+            ("orjson+fragments", lambda obj: fast_json.dumps(obj, backend="orjson", fragments=True)),
+        ]
+    return out
+
+
+class Command(BaseCommand):
+    help = "result_json / tracks_search のレスポンス本文のバイト数とエンコード時間をエンコーダごとに比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20000)
+
+    def handle(self, *args, **opts):
+        n = opts["iterations"]
+        self.stdout.write(f"auto backend: {fast_json.backend_name('auto')}  (type_catalog fragments: {len(type_catalog.CATALOG) * 2})")
+        for name, payload in _payloads().items():
+            base = None
+            for label, enc in _encoders():
+                body = enc(payload)
+                if json.loads(body) != json.loads(json.dumps(payload, cls=DjangoJSONEncoder)):
+                    raise AssertionError(f"{label} produced a different document for {name}")
+                t0 = time.perf_counter()
+                for _ in range(n):
+                    enc(payload)
+                us = (time.perf_counter() - t0) / n * 1e6
+                if base is None:
+                    base = (len(body), us)
+                self.stdout.write(
+                    f"{name:>13} {label:>17}: {len(body):6d} bytes ({len(body) / base[0] * 100:5.1f}%)  "
+                    f"{us:7.2f}us/encode ({base[1] / us:4.1f}x)"
+                )
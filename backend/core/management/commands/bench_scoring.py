@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import random
+import time
+from typing import Any, Dict, List, Tuple
+
+from django.core.management.base import BaseCommand
+
+from core.batch_scoring import concat_inputs, pack_inputs, score_batch
+from core.diagnosis import compute_scores, pick_sample_tracks, scores_to_type_code
+
+
+def synth_user(rng: random.Random, n_tracks: int = 50) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Spotify の top_tracks / audio_features と同じ形のダミー入力を作る。
+    """
+    items = []
+    feats = []
+    for _ in range(n_tracks):
+        tid = f"t{rng.randrange(10**9):09d}"
+        items.append(
+            {
+                "id": tid,
+                "popularity": rng.randrange(101),
+                "artists": [{"id": f"a{rng.randrange(400)}"}],
+            }
+        )
+        if rng.random() < 0.97:  # 一部は feature 欠け
+            feats.append(
+                {
+                    "id": tid,
+                    "energy": rng.random(),
+                    "danceability": rng.random(),
+                    "tempo": rng.uniform(50, 200),
+                    "valence": round(rng.random(), 2),  # 同値を作って stable sort も確認する
+                    "acousticness": rng.random(),
+                    "instrumentalness": rng.random(),
+                }
+            )
+    return items, feats
+
+
+CHUNK = 10_000
+
+
+class Command(BaseCommand):
+    help = "compute_scores（scalar）と batch_scoring（NumPy 一括）の速度比較（一致は core.tests.BatchScoringTests で確認）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", default="1000,10000,100000", help="カンマ区切りのユーザー数")
+        parser.add_argument("--tracks", type=int, default=50)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        for n_users in [int(x) for x in opts["users"].split(",") if x]:
+            rng = random.Random(opts["seed"])
+            # dict 入力を全ユーザー分持つとメモリが足りないので、チャンクごとに作って捨てる
+            packed = []
+            t_scalar = t_pack = 0.0
+            for start in range(0, n_users, CHUNK):
+                users = [synth_user(rng, opts["tracks"]) for _ in range(min(CHUNK, n_users - start))]
+
+                t0 = time.perf_counter()
+                for items, feats in users:
+                    s = compute_scores(items, feats)
+                    code = scores_to_type_code(s)
+                    pick_sample_tracks(items, feats, code)
+                t_scalar += time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                packed.append(pack_inputs(users))
+                t_pack += time.perf_counter() - t0
+                del users
+
+            t0 = time.perf_counter()
+            batch = concat_inputs(packed)
+            t_pack += time.perf_counter() - t0
+            del packed
+
+            t0 = time.perf_counter()
+            score_batch(batch)
+            t_batch = time.perf_counter() - t0
+
+            self.stdout.write(
+                f"{n_users:>7} users: scalar {t_scalar:.3f}s | pack {t_pack:.3f}s + batch {t_batch:.3f}s "
+                f"(x{t_scalar / max(t_batch, 1e-9):.1f} on scoring)"
+            )
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import json
+import random
+import time
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import get_runner
+
+from config.sessions import SESSION_ENGINES
+
+
+class _Counter:
+    def __init__(self) -> None:
+        self.total = 0
+        self.session = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.total += 1
+        if "django_session" in sql:
+            self.session += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = "セッションの保存先（SESSION_MODE）ごとに、ログイン済みリクエスト1回あたりの DB クエリ数と時間を比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=300)
+        parser.add_argument("--modes", default=",".join(SESSION_ENGINES))
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        modes = [m for m in opts["modes"].split(",") if m]
+        unknown = set(modes) - set(SESSION_ENGINES)
+        if unknown:
+            raise CommandError(f"unknown modes: {', '.join(sorted(unknown))}")
+
+        # 全モードで1本の乱数列を使う（同じ入力だと DiagnosisInput の重複排除で書き込みが減ってしまう）
+        self.rng = random.Random(opts["seed"])
+        runner = get_runner(settings)(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            with override_settings(ALLOWED_HOSTS=["testserver"]):
+                for mode in modes:
+                    self._run(mode, opts)
+        finally:
+            runner.teardown_databases(old_config)
+
+    def _run(self, mode: str, opts: Dict) -> None:
+        rng = self.rng
+        with override_settings(SESSION_ENGINE=SESSION_ENGINES[mode]):
+            caches["sessions"].clear()
+            client = Client()
+            client.get("/api/dev/login")
+
+            endpoints = {
+                "diagnose_from_tracks": lambda: client.post(
+                    "/api/diagnose_from_tracks",
+                    json.dumps(
+                        {
+                            "tracks": [
+                                {"id": f"t{i}", "tempo": rng.random(), "bright": rng.random(), "electro": rng.random(), "explore": rng.random()}
+                                for i in range(5)
+                            ]
+                        }
+                    ),
+                    content_type="application/json",
+                ),
+                "login (repeat)": lambda: client.get("/api/dev/login"),
+            }
+            for name, call in endpoints.items():
+                counter = _Counter()
+                lat: List[float] = []
+                with connection.execute_wrapper(counter):
+                    for _ in range(opts["requests"]):
+                        t0 = time.perf_counter()
+                        r = call()
+                        lat.append(time.perf_counter() - t0)
+                        if r.status_code != 200:
+                            raise CommandError(f"{mode} {name}: {r.status_code} {r.content[:200]!r}")
+                n = opts["requests"]
+                lat.sort()
+                self.stdout.write(
+                    f"{mode:>14} {name:>20}: {counter.total / n:5.2f} queries/req  "
+                    f"{counter.session / n:5.2f} session queries/req  "
+                    f"p50 {lat[n // 2] * 1000:6.2f}ms  mean {sum(lat) / n * 1000:6.2f}ms"
+                )
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from core.batch_scoring import TYPE_CODES, TYPE_THRESHOLDS
+from core.similar import SimilarityIndex, auto_cells
+
+
+def synth_scores(rng: np.random.Generator, n: int) -> np.ndarray:
+    """
+    実データっぽく中央寄り＋タイプごとの塊になるように、beta 分布の混合でスコアを作る。
+    """
+    centers = rng.beta(2.0, 2.0, size=(16, 4))
+    which = rng.integers(0, 16, size=n)
+    pts = centers[which] + rng.normal(0.0, 0.12, size=(n, 4))
+    return np.round(np.clip(pts, 0.0, 1.0), 2)  # 保存値と同じく2桁に丸める（同距離も作る）
+
+
+class Command(BaseCommand):
+    help = "音楽の双子検索: グリッドインデックス（core.similar）と全件スキャンの速度比較と一致確認"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", default="10000,100000,1000000", help="カンマ区切りのユーザー数")
+        parser.add_argument("--queries", type=int, default=2000)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--cells", type=int, default=0, help="0 ならユーザー数から自動")
+        parser.add_argument("--updates", type=int, default=10000, help="インクリメンタル更新の計測回数")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        k = opts["k"]
+        for n in [int(x) for x in opts["users"].split(",") if x]:
+            rng = np.random.default_rng(opts["seed"])
+            pts = synth_scores(rng, n)
+            bits = (pts >= TYPE_THRESHOLDS).astype(np.int64)
+            codes = TYPE_CODES[bits @ np.array([8, 4, 2, 1])].tolist()
+            names = [f"user{i}" for i in range(n)]
+
+            cells = opts["cells"] or auto_cells(n)
+            index = SimilarityIndex(cells=cells, capacity=n)
+            t0 = time.perf_counter()
+            index.bulk_load(np.arange(1, n + 1), names, pts, codes)
+            t_build = time.perf_counter() - t0
+
+            queries = [names[i] for i in rng.integers(0, n, size=opts["queries"]).tolist()]
+            lat = []
+            fast = []
+            for name in queries:
+                t0 = time.perf_counter()
+                fast.append(index.nearest(name, k))
+                lat.append(time.perf_counter() - t0)
+            lat_ms = np.array(lat) * 1000
+
+            n_brute = min(len(queries), 200)
+            t0 = time.perf_counter()
+            brute = [index.brute_force(name, k) for name in queries[:n_brute]]
+            t_brute = (time.perf_counter() - t0) / n_brute * 1000
+
+            for name, a, b in zip(queries, fast, brute):
+                if [x.username for x in a] != [x.username for x in b]:
+                    raise CommandError(f"mismatch for {name}: {a} != {b}")
+
+            upd = rng.integers(0, n, size=opts["updates"]).tolist()
+            new_pts = synth_scores(rng, len(upd)).tolist()
+            t0 = time.perf_counter()
+            for i, p in zip(upd, new_pts):
+                index.upsert(i + 1, names[i], p, codes[i])
+            t_upd = (time.perf_counter() - t0) / max(1, len(upd)) * 1e6
+
+            self.stdout.write(
+                f"users={n} cells={cells}^4 build={t_build:.2f}s | "
+                f"grid p50={np.percentile(lat_ms, 50):.3f}ms p99={np.percentile(lat_ms, 99):.3f}ms | "
+                f"brute mean={t_brute:.3f}ms | upsert={t_upd:.1f}us | {n_brute} queries identical"
+            )
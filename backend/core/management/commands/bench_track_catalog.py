@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import random
+import time
+import unicodedata
+from typing import Dict, List
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from core.track_catalog import TrackCatalog, normalize
+
+_LATIN = ["night", "drive", "love", "summer", "blue", "city", "pop", "dream", "light", "rain", "star", "heart", "run", "moon"]
+_KANA = ["アイドル", "ヨル", "ハナビ", "サクラ", "キミ", "ソラ", "ユメ", "ミライ", "ナツ", "ウタ", "ヒカリ", "コイ"]
+_KANJI = ["夜", "駆", "花", "火", "桜", "空", "夢", "未来", "夏", "歌", "光", "恋", "雨", "星"]
+
+
+def synth_tracks(rng: random.Random, n: int) -> List[Dict[str, str]]:
+    out = []
+    for i in range(n):
+        kind = rng.random()
+        if kind < 0.4:
+            title = " ".join(rng.choice(_LATIN).title() for _ in range(rng.randint(1, 3)))
+        elif kind < 0.7:
+            title = "".join(rng.choice(_KANA) for _ in range(rng.randint(1, 2)))
+        else:
+            title = "".join(rng.choice(_KANJI) for _ in range(rng.randint(2, 4))) + rng.choice(["", "に", "の", "を"])
+        artist = rng.choice(_LATIN).upper() + str(rng.randint(1, 999)) if rng.random() < 0.5 else rng.choice(_KANA) + "ズ"
+        out.append({"id": str(100000 + i), "title": f"{title} {i % 97}", "artist": artist, "artwork": "", "preview_url": "", "external_url": ""})
+    return out
+
+
+def _halfwidth(s: str) -> str:
+    # 入力ゆれの再現: カタカナを半角に、英字を全角にする
+    out = []
+    for ch in s:
+        name = unicodedata.name(ch, "")
+        if "KATAKANA" in name and "LETTER" in name:
+            out.append(unicodedata.lookup("HALFWIDTH " + name) if _has("HALFWIDTH " + name) else ch)
+        elif "a" <= ch.lower() <= "z":
+            out.append(chr(ord(ch) + 0xFEE0))
+        else:
+            out.append(ch)
+    return "".join(out)
+
+
+def _has(name: str) -> bool:
+    try:
+        unicodedata.lookup(name)
+        return True
+    except KeyError:
+        return False
+
+
+class Command(BaseCommand):
+    help = "ローカル曲カタログ（core.track_catalog）のオートコンプリート速度とローカルで答えられた割合"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tracks", type=int, default=100_000)
+        parser.add_argument("--queries", type=int, default=5000)
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--min-results", type=int, default=10)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        rng = random.Random(opts["seed"])
+        tracks = synth_tracks(rng, opts["tracks"])
+        catalog = TrackCatalog(max_tracks=len(tracks))
+        t0 = time.perf_counter()
+        catalog.add(tracks)
+        t_build = time.perf_counter() - t0
+
+        # 打鍵途中の問い合わせ: 実在の曲のタイトル/アーティストの先頭 1..6 文字（半分は全角/半角ゆれ付き）
+        queries = []
+        for _ in range(opts["queries"]):
+            t = rng.choice(tracks)
+            src = t["title"] if rng.random() < 0.7 else t["artist"]
+            q = src[: rng.randint(1, 6)]
+            queries.append(_halfwidth(q) if rng.random() < 0.5 else q)
+
+        lat = []
+        answered = 0
+        for q in queries:
+            t0 = time.perf_counter()
+            items = catalog.search(q, opts["limit"])
+            lat.append(time.perf_counter() - t0)
+            if len(items) >= min(opts["limit"], opts["min_results"]):
+                answered += 1
+            nq = normalize(q)
+            for it in items:
+                text = normalize(it["title"]) + " " + normalize(it["artist"])
+                if not all(term in text for term in nq.split()):
+                    raise CommandError(f"bad hit for {q!r}: {it}")
+
+        ms = np.array(lat) * 1000
+        self.stdout.write(
+            f"tracks={len(tracks)} build={t_build:.2f}s | search p50={np.percentile(ms, 50):.3f}ms "
+            f"p90={np.percentile(ms, 90):.3f}ms p99={np.percentile(ms, 99):.3f}ms | "
+            f"answered locally {answered / len(queries) * 100:.1f}% (>= {opts['min_results']} hits)"
+        )
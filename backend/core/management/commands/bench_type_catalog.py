@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import json
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from core import result_cache, type_catalog
+from core.diagnosis import describe_type, pick_sample_tracks_fake
+
+
+# -------------------------
+# 以前の実装（呼ぶたびに dict リテラルを組み立てる）
+# -------------------------
+def legacy_describe_type(type_code: str) -> Dict[str, Any]:
+    axes = {
+        "axis1": "動" if type_code[0] == "A" else "静",
+        "axis2": "光" if type_code[1] == "B" else "影",
+        "axis3": "生" if type_code[2] == "C" else "電",
+        "axis4": "探索" if type_code[3] == "D" else "定番",
+    }
+    presets = {
+        "AbcD": {"name": "夜更かしドライブタイプ", "tagline": "暗めで速い。電子寄りで探索好き。"},
+        "AbCD": {"name": "夜更かしインディタイプ", "tagline": "暗めで速い。生音寄りで探索好き。"},
+    }
+    base = presets.get(type_code, {"name": f"Type {type_code}", "tagline": "あなたの音楽の傾向を表すタイプ。"})
+    return {"name": base["name"], "tagline": base["tagline"], "axes": axes}
+
+
+def legacy_pick_sample_tracks_fake(type_code: str) -> List[Dict[str, str]]:
+    catalog = {
+        "AbCD": [
+            {"title": "Midnight Loop", "artist": "Neon Taxi", "note": "夜の高速、低音が気持ちいい"},
+            {"title": "Shadow Sprint", "artist": "City Pulse", "note": "暗め×速め、集中スイッチ"},
+            {"title": "Analog Rain", "artist": "Blue Static", "note": "冷たい空気、ドライブ向け"},
+        ],
+        "AbcD": [
+            {"title": "Late Night Drive", "artist": "Pastel FM", "note": "暗め電子、探索モード"},
+            {"title": "Tunnel Lights", "artist": "Noon Runner", "note": "一定のビートが心地いい"},
+            {"title": "Quiet Accel", "artist": "Soda Wave", "note": "静かに加速する感じ"},
+        ],
+    }
+    fallback = [
+        {"title": "Daydream Pop", "artist": "Paper Sun", "note": "軽くて聴きやすい"},
+        {"title": "Stereo Breeze", "artist": "Room Radio", "note": "作業BGMにちょうどいい"},
+        {"title": "Afterglow", "artist": "Glass Hour", "note": "余韻が残る、落ち着く"},
+    ]
+    return catalog.get(type_code, fallback)
+
+
+def _body(user, latest, describe, pick) -> bytes:
+    payload = {
+        "username": user.username,
+        "display_name": user.first_name or user.username,
+        "computed_at": latest.computed_at.isoformat(),
+        "type_code": latest.type_code,
+        "type_info": describe(latest.type_code),
+        "scores": {
+            "energy": latest.energy_score,
+            "mood": latest.mood_score,
+            "texture": latest.texture_score,
+            "explore": latest.explore_score,
+        },
+        "sample_track_ids": latest.sample_track_ids,
+        "sample_tracks": pick(latest.type_code),
+    }
+    return json.dumps(payload, cls=DjangoJSONEncoder).encode("utf-8")
+
+
+def _allocs(fn: Callable[[], Any], n: int = 1000) -> float:
+    """
+    1回あたりに新しく確保されるメモリブロック数（戻り値を保持したまま数える）。
+    """
+    fn()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = [fn() for _ in range(n)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del keep
+    stats = after.compare_to(before, "filename")
+    return sum(s.count_diff for s in stats) / n
+
+
+class Command(BaseCommand):
+    help = "type_catalog（import 時に1回だけ構築）と以前の describe_type / pick_sample_tracks_fake の比較"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=200_000)
+
+    def handle(self, *args, **opts):
+        number = opts["number"]
+        codes = list(type_catalog.TYPE_CODES)
+
+        user = SimpleNamespace(username="bench_user", first_name="Bench")
+        latest = SimpleNamespace(
+            pk=1,
+            computed_at=timezone.now(),
+            energy_score=0.8123,
+            mood_score=0.2,
+            texture_score=0.61,
+            explore_score=0.4,
+            sample_track_ids=["Neon Sprint", "Glitter Mode", "Fast Forward"],
+        )
+        # 事前シリアライズした断片と共有 dict が一致し、結果ページの本文も変わらないこと
+        for code in codes:
+            entry = type_catalog.get(code)
+            if json.loads(entry.info_json) != describe_type(code) or json.loads(entry.tracks_json) != pick_sample_tracks_fake(code):
+                raise CommandError(f"fragment differs for {code}")
+            latest.type_code = code
+            # バイト列は fast_json（区切りの空白なし・UTF-8）と違うので、内容で比べる
+            rendered = json.loads(result_cache._render(user, latest).body)
+            if rendered != json.loads(_body(user, latest, describe_type, pick_sample_tracks_fake)):
+                raise CommandError(f"rendered body differs for {code}")
+
+        cases = [
+            ("describe_type", lambda c: legacy_describe_type(c), lambda c: describe_type(c)),
+            ("pick_sample_tracks_fake", lambda c: legacy_pick_sample_tracks_fake(c), lambda c: pick_sample_tracks_fake(c)),
+        ]
+        for name, old, new in cases:
+            it = iter(codes * (number // len(codes) + 1))
+            t_old = timeit.timeit(lambda: old(next(it)), number=number) / number * 1e9
+            it = iter(codes * (number // len(codes) + 1))
+            t_new = timeit.timeit(lambda: new(next(it)), number=number) / number * 1e9
+            a_old = _allocs(lambda: old("AbcD"))
+            a_new = _allocs(lambda: new("AbcD"))
+            self.stdout.write(
+                f"{name:24s} legacy={t_old:7.0f}ns ({a_old:4.1f} allocs)  "
+                f"catalog={t_new:5.0f}ns ({a_new:4.1f} allocs)  x{t_old / t_new:.1f}"
+            )
+
+        n = max(1, number // 20)
+        latest.type_code = "AbcD"
+        t_old = timeit.timeit(
+            lambda: _body(user, latest, legacy_describe_type, legacy_pick_sample_tracks_fake), number=n
+        ) / n * 1e6
+        t_new = timeit.timeit(lambda: result_cache._render(user, latest), number=n) / n * 1e6
+        self.stdout.write(f"{'result body render':24s} legacy={t_old:6.1f}us  catalog={t_new:5.1f}us  x{t_old / t_new:.1f}")
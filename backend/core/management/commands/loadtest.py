@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from core import circuit_breaker, score_stats, similar, spotify, track_views, write_behind
+from core.models import SpotifyAccount
+from core.search_cache import get_search_cache
+from core.upstream_stubs import StubServer
+
+# ローカル upstream（core.upstream_stubs）に向けて主要エンドポイントへ同時に負荷をかけ、
+# エンドポイントごとのスループット・レイテンシ分位・DB クエリ数を JSON に残す。
+# DB はテスト用 DB（SQLite ならファイル）を作って使い、終わったら消す。
+
+ENDPOINTS = ("login", "search", "diagnose_from_tracks", "result", "spotify_diagnose")
+USERNAME = "dev_user"  # /api/dev/login が作るユーザー
+
+
+class _QueryCounter:
+    """
+    connection.execute_wrapper 用。このスレッドの接続で実行したクエリ数と時間を数える。
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - t0
+
+
+def _pct(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def _summary(samples: List[Dict[str, Any]], wall: float, upstream: int) -> Dict[str, Any]:
+    lat = sorted(s["seconds"] for s in samples)
+    queries = [s["queries"] for s in samples]
+    statuses: Dict[str, int] = {}
+    for s in samples:
+        statuses[str(s["status"])] = statuses.get(str(s["status"]), 0) + 1
+    n = len(samples)
+    return {
+        "requests": n,
+        "errors": sum(1 for s in samples if s["status"] >= 400),
+        "statuses": statuses,
+        "wall_sec": round(wall, 3),
+        "rps": round(n / wall, 1) if wall else 0.0,
+        "latency_ms": {
+            "mean": round(sum(lat) / n * 1000, 2) if n else 0.0,
+            "p50": round(_pct(lat, 0.50) * 1000, 2),
+            "p90": round(_pct(lat, 0.90) * 1000, 2),
+            "p99": round(_pct(lat, 0.99) * 1000, 2),
+            "max": round(lat[-1] * 1000, 2) if n else 0.0,
+        },
+        "db_queries": {
+            "per_request": round(sum(queries) / n, 2) if n else 0.0,
+            "max": max(queries) if queries else 0,
+            "ms_per_request": round(sum(s["query_seconds"] for s in samples) / n * 1000, 3) if n else 0.0,
+        },
+        "upstream_requests": upstream,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5, check=False
+        )
+        return out.stdout.strip()
+    except Exception:
+        return ""
+
+
+class Command(BaseCommand):
+    help = "ローカル upstream スタブに対する負荷試験（エンドポイントごとの req/s・分位・DB クエリ数を JSON に保存）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=300, help="エンドポイントごとのリクエスト数")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--latency", type=float, default=0.05, help="stub upstream の遅延（秒）")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="stub upstream が 503 を返す割合")
+        parser.add_argument("--search-terms", type=int, default=100, help="検索語の種類（小さいほどキャッシュが効く）")
+        parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"カンマ区切り: {','.join(ENDPOINTS)}")
+        parser.add_argument("--output", default="loadtest.json", help="結果の JSON（空なら保存しない）")
+        parser.add_argument("--compare", default="", help="比較する以前の結果 JSON")
+        parser.add_argument("--seed", type=int, default=0)
+
+    @override_settings(ALLOWED_HOSTS=["testserver"])
+    def handle(self, *args, **opts):
+        endpoints = [e for e in opts["endpoints"].split(",") if e]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"unknown endpoints: {', '.join(sorted(unknown))}")
+        self.rng = random.Random(opts["seed"])
+        self.opts = opts
+
+        stub = StubServer(latency=opts["latency"], error_rate=opts["error_rate"]).start()
+        saved = (track_views.ITUNES_SEARCH_URL, spotify.SPOTIFY_ACCOUNTS_BASE, spotify.SPOTIFY_API_BASE)
+        track_views.ITUNES_SEARCH_URL = f"{stub.base_url}/search"
+        spotify.SPOTIFY_ACCOUNTS_BASE = stub.base_url
+        spotify.SPOTIFY_API_BASE = f"{stub.base_url}/v1"
+
+        tmpdir = tempfile.mkdtemp(prefix="loadtest-")
+        old_name = self._create_db(tmpdir)
+        try:
+            self._reset_state()
+            self._warmup()
+            results: Dict[str, Any] = {}
+            for name in endpoints:
+                results[name] = self._run_phase(name, stub)
+                self._print_line(name, results[name])
+        finally:
+            write_behind.set_buffer(None)  # 溜まっている結果を書いてから DB を消す
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            track_views.ITUNES_SEARCH_URL, spotify.SPOTIFY_ACCOUNTS_BASE, spotify.SPOTIFY_API_BASE = saved
+            stub.stop()
+
+        report = {
+            "meta": {
+                "commit": _git_commit(),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "db_vendor": connection.vendor,
+                "requests": opts["requests"],
+                "concurrency": opts["concurrency"],
+                "upstream_latency": opts["latency"],
+                "upstream_error_rate": opts["error_rate"],
+                "search_terms": opts["search_terms"],
+            },
+            "endpoints": results,
+        }
+        if opts["output"]:
+            with open(opts["output"], "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"saved: {opts['output']}")
+        if opts["compare"]:
+            self._compare(opts["compare"], report)
+
+    # -------------------------
+    # setup
+    # -------------------------
+    def _create_db(self, tmpdir: str) -> str:
+        # SQLite のインメモリ DB はスレッド間の同時書き込みに向かないので、ファイルにする
+        if connection.vendor == "sqlite":
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tmpdir, "loadtest.sqlite3")
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return old_name
+
+    def _reset_state(self) -> None:
+        caches["default"].clear()
+        get_search_cache().backend.clear()
+        similar.reset_index()
+        score_stats.reset_store()
+        circuit_breaker.reset_breakers()
+
+    def _warmup(self) -> None:
+        client = Client()
+        client.get("/api/dev/login")
+        r = self._post_tracks(client)
+        if r.status_code != 200:
+            raise CommandError(f"warmup failed: {r.status_code} {r.content[:200]!r}")
+        # spotify_diagnose 用: 期限切れトークンの SpotifyAccount（最初の1回で stub の /api/token から更新される）
+        SpotifyAccount.objects.update_or_create(
+            user=User.objects.get(username=USERNAME),
+            defaults={
+                "spotify_user_id": "stub_user",
+                "access_token": "expired",
+                "refresh_token": "stub-refresh",
+                "token_expires_at": datetime.now(timezone.utc) - timedelta(minutes=1),
+            },
+        )
+
+    # -------------------------
+    # load
+    # -------------------------
+    def _post_tracks(self, client: Client):
+        tracks = [
+            {
+                "id": f"t{self.rng.randrange(10**6)}",
+                "tempo": self.rng.random(),
+                "bright": self.rng.random(),
+                "electro": self.rng.random(),
+                "explore": self.rng.random(),
+            }
+            for _ in range(5)
+        ]
+        return client.post("/api/diagnose_from_tracks", json.dumps({"tracks": tracks}), content_type="application/json")
+
+    def _request(self, name: str, client: Client):
+        if name == "login":
+            return client.get("/api/dev/login")
+        if name == "search":
+            term = f"term {self.rng.randrange(self.opts['search_terms'])}"
+            return client.get("/api/tracks/search", {"q": term})
+        if name == "diagnose_from_tracks":
+            return self._post_tracks(client)
+        if name == "result":
+            return client.get(f"/api/result/{USERNAME}")
+        if name == "spotify_diagnose":
+            return client.post("/api/async/diagnose")
+        raise CommandError(name)
+
+    def _run_phase(self, name: str, stub: StubServer) -> Dict[str, Any]:
+        local = threading.local()
+
+        def client() -> Client:
+            c = getattr(local, "client", None)
+            if c is None:
+                c = local.client = Client()
+                if name != "login":
+                    # /api/dev/login は毎回パスワードハッシュを書き換えて他のセッションを無効にするので、
+                    # 計測対象でないフェーズは force_login で入る
+                    c.force_login(User.objects.get(username=USERNAME))
+            return c
+
+        def one(_: int) -> Dict[str, Any]:
+            c = client()
+            counter = _QueryCounter()
+            t0 = time.perf_counter()
+            try:
+                with connection.execute_wrapper(counter):
+                    status = self._request(name, c).status_code
+            except Exception:
+                status = 599
+            return {
+                "seconds": time.perf_counter() - t0,
+                "status": status,
+                "queries": counter.count,
+                "query_seconds": counter.seconds,
+            }
+
+        def close(_: int) -> None:
+            connection.close()
+
+        upstream_before = stub.requests
+        workers = max(1, self.opts["concurrency"])
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda _: client(), range(workers)))  # ログインは計測に入れない
+            t0 = time.perf_counter()
+            samples = list(pool.map(one, range(self.opts["requests"])))
+            wall = time.perf_counter() - t0
+            list(pool.map(close, range(workers)))
+        buf = write_behind.get_buffer()
+        if buf is not None:
+            buf.flush()
+        return _summary(samples, wall, stub.requests - upstream_before)
+
+    # -------------------------
+    # output
+    # -------------------------
+    def _print_line(self, name: str, r: Dict[str, Any]) -> None:
+        lat = r["latency_ms"]
+        self.stdout.write(
+            f"{name:>21}: {r['rps']:8.1f} req/s  p50 {lat['p50']:7.2f}ms  p90 {lat['p90']:7.2f}ms  "
+            f"p99 {lat['p99']:7.2f}ms  {r['db_queries']['per_request']:5.2f} q/req  "
+            f"errors {r['errors']}/{r['requests']}  upstream {r['upstream_requests']}"
+        )
+
+    def _compare(self, path: str, report: Dict[str, Any]) -> None:
+        with open(path, encoding="utf-8") as f:
+            base = json.load(f)
+        self.stdout.write(f"vs {path} (commit {base.get('meta', {}).get('commit', '?')}):")
+
+        def delta(new: float, old: float) -> str:
+            if not old:
+                return "   n/a"
+            return f"{(new - old) / old * 100:+6.1f}%"
+
+        metrics = [
+            ("req/s", lambda r: r["rps"]),
+            ("p50", lambda r: r["latency_ms"]["p50"]),
+            ("p99", lambda r: r["latency_ms"]["p99"]),
+            ("q/req", lambda r: r["db_queries"]["per_request"]),
+        ]
+        for name, r in report["endpoints"].items():
+            old: Optional[Dict[str, Any]] = base.get("endpoints", {}).get(name)
+            if old is None:
+                continue
+            parts = [f"{label} {delta(get(r), get(old))}" for label, get in metrics]
+            self.stdout.write(f"{name:>21}: " + "  ".join(parts))
@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import score_stats
+
+
+class Command(BaseCommand):
+    help = "スコア分布（ScoreStats）を LatestDiagnosis から作り直す（差分の取りこぼしや手作業の更新の後に）"
+
+    def handle(self, *args, **opts):
+        t0 = time.perf_counter()
+        hist = score_stats.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(f"rebuilt from {hist.total} users in {time.perf_counter() - t0:.2f}s")
+        )
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import result_cache, score_stats, similar, type_catalog
+from core.diagnosis import scores_to_type_code
+from core.diagnosis_inputs import replay_selected, spotify_batch
+from core.models import DiagnosisInput, DiagnosisResult, LatestDiagnosis
+
+# (result_id, user_id, energy, mood, texture, explore, type_code, sample_track_ids,
+#  input kind, input features, input track_ids, input meta, input_id)
+Row = Tuple[int, int, float, float, float, float, str, List[str], Any, Any, Any, Any, Any]
+
+
+def _fake_ids(type_code: str) -> List[str]:
+    return list(type_catalog.get(type_code).track_titles)
+
+
+# seed ダミー結果の sample_track_ids（代表曲のタイトル）として保存されたことのある並び。
+# 今のカタログの分と、カタログ（core.type_catalog）より前の固定リストの分
+_KNOWN_FAKE_IDS = {tuple(_fake_ids(code)) for code in type_catalog.TYPE_CODES} | {
+    ("Midnight Loop", "Shadow Sprint", "Analog Rain"),
+    ("Late Night Drive", "Tunnel Lights", "Quiet Accel"),
+    ("Daydream Pop", "Stereo Breeze", "Afterglow"),
+}
+
+
+def _is_fake(ids: Any) -> bool:
+    return isinstance(ids, list) and tuple(ids) in _KNOWN_FAKE_IDS
+
+
+def rescore_chunk(rows: List[Row]) -> List[Dict[str, Any]]:
+    """
+    保存済みの値だけで再計算する（プロセスプールの中で動くので DB/Spotify には触らない）。
+    - 生入力（DiagnosisInput）がある結果: 今の重みでスコアから計算し直す
+      （spotify 入力は batch_scoring でまとめて、selected 入力は compute_scores_from_selected_tracks）
+    - 無い結果（seed ダミー等）: 保存済みスコアに今のしきい値を当て直し、
+      ダミー代表曲（タイトル）だった場合だけ今のカタログの代表曲に差し替える
+    """
+    out: List[Dict[str, Any]] = []
+    spotify_rows: List[int] = []
+
+    for i, (rid, uid, e, m, t, x, old_code, old_ids, kind, raw, _tids, _meta, _inp) in enumerate(rows):
+        if kind == DiagnosisInput.KIND_SPOTIFY:
+            spotify_rows.append(i)
+            out.append({"id": rid, "user_id": uid})
+            continue
+
+        if kind == DiagnosisInput.KIND_SELECTED:
+            scores = replay_selected(raw)
+            code = scores_to_type_code(scores)
+            ids = _fake_ids(code)
+        else:
+            scores = {"energy_score": e, "mood_score": m, "texture_score": t, "explore_score": x}
+            code = scores_to_type_code(scores)
+            ids = _fake_ids(code) if _is_fake(old_ids) else old_ids
+        out.append({"id": rid, "user_id": uid, "scores": scores, "type_code": code, "sample_track_ids": ids})
+
+    if spotify_rows:
+        from core.batch_scoring import score_batch
+
+        res = score_batch(spotify_batch([(rows[i][9], rows[i][10], rows[i][11]) for i in spotify_rows]))
+        dicts = res.score_dicts()
+        for k, i in enumerate(spotify_rows):
+            out[i].update(
+                scores=dicts[k],
+                type_code=str(res.type_codes[k]),
+                sample_track_ids=res.sample_track_ids[k],
+            )
+
+    for r, row in zip(out, rows):
+        old_scores = {"energy_score": row[2], "mood_score": row[3], "texture_score": row[4], "explore_score": row[5]}
+        r["input_id"] = row[12]
+        r["old"] = (row[2], row[3], row[4], row[5], row[6])  # 分布から引く行
+        r["changed"] = (
+            r["scores"] != old_scores or r["type_code"] != row[6] or r["sample_track_ids"] != row[7]
+        )
+    return out
+
+
+class _Inline:
+    """
+    --workers 0 用。ProcessPoolExecutor と同じ submit() で、その場で計算する。
+    """
+
+    def __enter__(self) -> "_Inline":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+    def submit(self, fn, *args) -> Future:
+        fut: Future = Future()
+        fut.set_result(fn(*args))
+        return fut
+
+
+class Command(BaseCommand):
+    help = "保存済みの最新 DiagnosisResult を、保存済み入力と今の重み/しきい値でまとめて再計算する（Spotify は呼ばない）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1, help="0 ならプロセスプールを使わずこのプロセスで計算する"
+        )
+        parser.add_argument(
+            "--mode",
+            choices=("update", "append"),
+            default="update",
+            help="update: 最新結果を書き換える / append: 新しい結果行として追加する",
+        )
+        parser.add_argument("--checkpoint", default="", help="再開用のチェックポイントファイル（JSON）")
+        parser.add_argument("--reset", action="store_true", help="チェックポイントを無視して最初から")
+
+    def handle(self, *args, **opts):
+        chunk_size = max(1, opts["chunk_size"])
+        checkpoint = opts["checkpoint"]
+        state = {"last_user_id": 0, "rows": 0, "changed": 0}
+        if checkpoint and not opts["reset"] and os.path.exists(checkpoint):
+            with open(checkpoint, encoding="utf-8") as f:
+                state.update(json.load(f))
+            self.stdout.write(f"resume after user_id={state['last_user_id']} ({state['rows']} rows done)")
+
+        t0 = time.perf_counter()
+        rows_this_run = 0
+        cursor = state["last_user_id"]
+        pending: deque = deque()
+        workers = opts["workers"]
+
+        # spawn 起動の環境でもワーカー側で models を import できるように django.setup しておく
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) if workers > 0 else _Inline() as pool:
+            while True:
+                # 書き込みは順番通り（チェックポイントを単調にするため）。先読みは workers*2 まで
+                while len(pending) < max(1, workers) * 2:
+                    rows = self._fetch_chunk(cursor, chunk_size)
+                    if not rows:
+                        break
+                    cursor = rows[-1][1]
+                    pending.append((cursor, pool.submit(rescore_chunk, rows)))
+                if not pending:
+                    break
+
+                last_uid, fut = pending.popleft()
+                results = fut.result()
+                changed = self._write(results, opts["mode"])
+
+                rows_this_run += len(results)
+                state["last_user_id"] = last_uid
+                state["rows"] += len(results)
+                state["changed"] += changed
+                self._save_checkpoint(checkpoint, state)
+
+                elapsed = time.perf_counter() - t0
+                self.stdout.write(
+                    f"user_id<={last_uid}: {state['rows']} rows ({state['changed']} changed), "
+                    f"{rows_this_run / elapsed:.0f} rows/s"
+                )
+
+        elapsed = time.perf_counter() - t0
+        rate = rows_this_run / elapsed if elapsed else 0.0
+        self.stdout.write(
+            self.style.SUCCESS(f"done: {rows_this_run} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+        )
+
+    def _fetch_chunk(self, after_user_id: int, size: int) -> List[Row]:
+        # keyset pagination（LatestDiagnosis の主キー = user_id）
+        qs = (
+            LatestDiagnosis.objects.filter(user_id__gt=after_user_id)
+            .order_by("user_id")
+            .values_list(
+                "result_id",
+                "user_id",
+                "result__energy_score",
+                "result__mood_score",
+                "result__texture_score",
+                "result__explore_score",
+                "result__type_code",
+                "result__sample_track_ids",
+                "result__input__kind",
+                "result__input__features",
+                "result__input__track_ids",
+                "result__input__meta",
+                "result__input_id",
+            )[:size]
+        )
+        # BinaryField は backend によって memoryview で返る（プロセス間で pickle できない）
+        return [r[:9] + (bytes(r[9]) if r[9] is not None else None,) + r[10:] for r in qs]
+
+    def _write(self, results: List[Dict[str, Any]], mode: str) -> int:
+        changed = [r for r in results if r["changed"]]
+        if not changed:
+            return 0
+
+        with transaction.atomic():
+            if mode == "append":
+                objs = DiagnosisResult.objects.bulk_create(
+                    [
+                        DiagnosisResult(
+                            user_id=r["user_id"],
+                            input_id=r["input_id"],
+                            type_code=r["type_code"],
+                            sample_track_ids=r["sample_track_ids"],
+                            **r["scores"],
+                        )
+                        for r in changed
+                    ]
+                )
+                LatestDiagnosis.point_to(objs)
+            else:
+                objs = [
+                    DiagnosisResult(
+                        id=r["id"],
+                        user_id=r["user_id"],
+                        type_code=r["type_code"],
+                        sample_track_ids=r["sample_track_ids"],
+                        **r["scores"],
+                    )
+                    for r in changed
+                ]
+                # 読んだ後に新しい診断が来たユーザーの結果は、もう最新ではない（書き換えはするが分布などには入れない）。
+                # ポインタをロックしておくので、point_to は書き換え後の値を「置き換える前の最新」として読む
+                still_latest = set(
+                    LatestDiagnosis.objects.select_for_update()
+                    .filter(result_id__in=[o.pk for o in objs])
+                    .values_list("result_id", flat=True)
+                )
+                DiagnosisResult.objects.bulk_update(
+                    objs,
+                    [
+                        "energy_score",
+                        "mood_score",
+                        "texture_score",
+                        "explore_score",
+                        "type_code",
+                        "sample_track_ids",
+                    ],
+                )
+                latest = [o for o in objs if o.pk in still_latest]
+                replaced = [r["old"] for r in changed if r["id"] in still_latest]
+                # bulk_update は point_to を通らないので、キャッシュ・近傍インデックス・分布をここで直す
+                result_cache.invalidate_results(latest)
+                similar.on_results(latest)
+                score_stats.on_results(latest, replaced)
+        return len(changed)
+
+    def _save_checkpoint(self, path: Optional[str], state: Dict[str, Any]) -> None:
+        if not path:
+            return
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core import jobs
+
+
+def _run(job_id: str, max_attempts: int, retry_backoff: float) -> None:
+    try:
+        # 再試行は run_after を後ろにずらして queued に戻るだけ。次のポーリングで拾い直す
+        jobs.run_job(job_id, max_attempts, retry_backoff)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = "DB に積まれた診断ジョブ（DIAGNOSIS_JOBS MODE=db）を処理するワーカー"
+
+    def add_arguments(self, parser):
+        conf = jobs._conf()
+        parser.add_argument("--workers", type=int, default=conf["WORKERS"])
+        parser.add_argument("--max-attempts", type=int, default=conf["MAX_ATTEMPTS"])
+        parser.add_argument("--retry-backoff", type=float, default=conf["RETRY_BACKOFF"])
+        parser.add_argument("--poll-interval", type=float, default=0.5)
+        parser.add_argument(
+            "--stale-after",
+            type=float,
+            default=conf["STALE_AFTER"],
+            help="running のままこの秒数更新が無いジョブを積み直す（起動時と、その半分の間隔ごと。0 で無効）",
+        )
+        parser.add_argument("--once", action="store_true", help="今走らせられるジョブが無くなったら終了する")
+
+    def _requeue_stale(self, stale_after: float) -> None:
+        n = jobs.requeue_stale(stale_after)
+        if n:
+            self.stdout.write(f"requeued {n} stale jobs")
+
+    def handle(self, *args, **opts):
+        workers = max(1, opts["workers"])
+        stale_after = opts["stale_after"]
+        if stale_after > 0:
+            self._requeue_stale(stale_after)
+        # 動いている間に他のワーカーが落ちても、そのジョブを拾い直す
+        next_sweep = time.monotonic() + stale_after / 2
+
+        done = 0
+        running: dict = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="diagnosis-job") as pool:
+            while True:
+                if stale_after > 0 and time.monotonic() >= next_sweep:
+                    self._requeue_stale(stale_after)
+                    next_sweep = time.monotonic() + stale_after / 2
+
+                free = workers - len(running)
+                if free > 0:
+                    for job_id in jobs.runnable_ids(free + len(running)):
+                        if job_id in running.values():
+                            continue
+                        running[pool.submit(_run, job_id, opts["max_attempts"], opts["retry_backoff"])] = job_id
+                        free -= 1
+                        if free == 0:
+                            break
+
+                if not running:
+                    if opts["once"]:
+                        break
+                    time.sleep(opts["poll_interval"])
+                    continue
+
+                finished, _ = wait(list(running), timeout=opts["poll_interval"], return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    running.pop(fut)
+                    fut.result()
+                    done += 1
+
+        self.stdout.write(self.style.SUCCESS(f"done: {done} job runs"))
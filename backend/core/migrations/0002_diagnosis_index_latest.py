@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_latest(apps, schema_editor):
+    DiagnosisResult = apps.get_model("core", "DiagnosisResult")
+    LatestDiagnosis = apps.get_model("core", "LatestDiagnosis")
+
+    rows = []
+    seen = set()
+    qs = DiagnosisResult.objects.order_by("user_id", "-computed_at", "-id").values_list("user_id", "id")
+    for user_id, result_id in qs.iterator():
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        rows.append(LatestDiagnosis(user_id=user_id, result_id=result_id))
+    LatestDiagnosis.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='diagnosisresult',
+            index=models.Index(fields=['user', '-computed_at'], name='diag_user_computed_idx'),
+        ),
+        migrations.CreateModel(
+            name='LatestDiagnosis',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_diagnosis', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.diagnosisresult')),
+            ],
+        ),
+        migrations.RunPython(backfill_latest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_diagnosis_index_latest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiagnosisInput',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('kind', models.CharField(max_length=16)),
+                ('n_tracks', models.PositiveIntegerField()),
+                ('features', models.BinaryField()),
+                ('track_ids', models.JSONField(default=list)),
+                ('meta', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='diagnosisresult',
+            name='input',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='results', to='core.diagnosisinput'),
+        ),
+    ]
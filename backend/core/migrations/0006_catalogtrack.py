@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_scorestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogTrack',
+            fields=[
+                ('track_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=120)),
+                ('artist', models.CharField(max_length=120)),
+                ('artwork', models.CharField(blank=True, default='', max_length=300)),
+                ('preview_url', models.CharField(blank=True, default='', max_length=300)),
+                ('external_url', models.CharField(blank=True, default='', max_length=300)),
+                ('first_seen_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
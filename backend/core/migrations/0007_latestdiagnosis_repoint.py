@@ -0,0 +1,17 @@
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_catalogtrack'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='latestdiagnosis',
+            name='result',
+            field=models.ForeignKey(on_delete=core.models.repoint_to_previous, related_name='+', to='core.diagnosisresult'),
+        ),
+    ]
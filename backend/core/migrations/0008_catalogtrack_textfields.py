@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_latestdiagnosis_repoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='catalogtrack',
+            name='title',
+            field=models.TextField(),
+        ),
+        migrations.AlterField(
+            model_name='catalogtrack',
+            name='artist',
+            field=models.TextField(),
+        ),
+    ]
@@ -1,6 +1,8 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
+from . import result_cache, score_stats, similar
+
 class SpotifyAccount(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="spotify")
     spotify_user_id = models.CharField(max_length=64, unique=True)
@@ -12,8 +14,26 @@ class SpotifyAccount(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+class DiagnosisInput(models.Model):
+    """
+    診断の生入力（再計算・分析用）。同じ内容は content_hash で1行にまとめる。
+    features は float64(little endian) を曲数×列数で詰めたバイト列（列は core.diagnosis_inputs 参照）。
+    """
+    KIND_SELECTED = "selected"  # diagnose_from_tracks のスライダー値
+    KIND_SPOTIFY = "spotify"    # top_tracks + audio_features
+
+    content_hash = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=16)
+    n_tracks = models.PositiveIntegerField()
+    features = models.BinaryField()
+    track_ids = models.JSONField(default=list)
+    meta = models.JSONField(default=dict)  # spotify: {"columns": [...], "artist_ids": [[...], ...]}
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
 class DiagnosisResult(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="diagnoses")
+    input = models.ForeignKey(DiagnosisInput, null=True, blank=True, on_delete=models.SET_NULL, related_name="results")
     computed_at = models.DateTimeField(auto_now_add=True)
 
     energy_score = models.FloatField()
@@ -24,3 +44,174 @@ class DiagnosisResult(models.Model):
     type_code = models.CharField(max_length=8)         # 例: AbcD
     sample_track_ids = models.JSONField(default=list)  # spotify track id 3つ
 
+    class Meta:
+        indexes = [
+            # user.diagnoses.order_by("-computed_at") 用
+            models.Index(fields=["user", "-computed_at"], name="diag_user_computed_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            LatestDiagnosis.point_to([self])
+
+
+def _pointers_moved(results, replaced, dropped_usernames=()):
+    """
+    ポインタが results を指すようになった（replaced はそれまで指していた結果の分布の行）。
+    dropped_usernames はポインタごと消えたユーザー。
+    """
+    result_cache.invalidate_results(results)
+    result_cache.invalidate(dropped_usernames)
+    similar.on_results(results)
+    score_stats.on_results(results, replaced)
+
+
+def repoint_to_previous(collector, field, sub_objs, using):
+    """
+    LatestDiagnosis.result の on_delete。指していた結果が消えたら、そのユーザーの残りの結果のうち
+    一番新しいものを指し直す（無ければポインタも消す）。
+    キャッシュ・分布の更新はコミット後なので、削除は transaction.atomic の中で行うこと（admin はそう）。
+    """
+    results = field.remote_field.model._base_manager.using(using)
+    deleting = {obj.pk for obj in collector.data.get(field.remote_field.model, ())}
+    ptrs = list(sub_objs)
+    replaced = list(
+        results.filter(pk__in=[p.result_id for p in ptrs]).values_list(*score_stats.SCORE_FIELDS, "type_code")
+    )
+    moved, dropped = [], []
+    for ptr in ptrs:
+        previous = results.filter(user_id=ptr.user_id).exclude(pk__in=deleting).order_by("-computed_at", "-id").first()
+        if previous is None:
+            dropped.append(ptr)
+        else:
+            collector.add_field_update(field, previous, [ptr])
+            moved.append(previous)
+    usernames = []
+    if dropped:
+        models.CASCADE(collector, field, dropped, using)
+        usernames = list(User.objects.using(using).filter(pk__in=[p.user_id for p in dropped]).values_list("username", flat=True))
+    transaction.on_commit(lambda: _pointers_moved(moved, replaced, usernames), using=using)
+
+
+class LatestDiagnosis(models.Model):
+    """
+    ユーザーごとの最新 DiagnosisResult へのポインタ（シェアページを1回の索引引きで返すため）。
+    DiagnosisResult.save() で更新される。bulk_create した場合は point_to を呼ぶこと。
+    指している結果が消えたら、そのユーザーの1つ前の結果を指し直す（repoint_to_previous）。
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="latest_diagnosis")
+    result = models.ForeignKey(DiagnosisResult, on_delete=repoint_to_previous, related_name="+")
+
+    @classmethod
+    def _locked(cls, user_ids):
+        # user_id -> (result_id, computed_at, 分布の行)。ポインタ行をロックして読む
+        fields = [f"result__{f}" for f in score_stats.SCORE_FIELDS]
+        qs = (
+            cls.objects.select_for_update(of=("self",))
+            .filter(user_id__in=user_ids)
+            .values_list("user_id", "result_id", "result__computed_at", *fields, "result__type_code")
+        )
+        return {uid: (rid, at, tuple(row)) for uid, rid, at, *row in qs}
+
+    @classmethod
+    def point_to(cls, results):
+        """
+        results（保存済み）の各ユーザーの最新をポインタに反映する。
+        今指している結果より (computed_at, id) が新しいときだけ書き換える（古い結果が後から来ても戻らない）。
+        ポインタ行をロックして読むので、同時に書かれても置き換えた結果を分布から二重に引かない。
+        """
+        latest = {}
+        for r in results:
+            cur = latest.get(r.user_id)
+            if cur is None or (r.computed_at, r.pk) >= (cur.computed_at, cur.pk):
+                latest[r.user_id] = r
+        if not latest:
+            return
+        # 失敗したら呼び出し側（結果の保存）ごと戻すので savepoint は作らない
+        with transaction.atomic(savepoint=False):
+            current = cls._locked(latest.keys())
+            missing = latest.keys() - current.keys()
+            if missing:
+                # 同時に作られていたら作らない（下で比べて書き換える）
+                cls.objects.bulk_create([cls(user_id=uid, result=latest[uid]) for uid in missing], ignore_conflicts=True)
+                current.update(cls._locked(missing))
+
+            moved, replaced, updates = [], [], []
+            for uid, (rid, computed_at, row) in current.items():
+                r = latest[uid]
+                if rid == r.pk:
+                    if uid in missing:  # 今作ったポインタ
+                        moved.append(r)
+                elif (r.computed_at, r.pk) > (computed_at, rid):
+                    moved.append(r)
+                    replaced.append(row)
+                    updates.append(cls(user_id=uid, result=r))
+            if updates:
+                cls.objects.bulk_update(updates, ["result"])
+            if moved:
+                _pointers_moved(moved, replaced)
+
+
+class DiagnosisJob(models.Model):
+    """
+    非同期で走らせる Spotify 診断（core.jobs）。POST は job を積んで id を返すだけ。
+    ワーカーは status=queued の行を UPDATE 1文で取り合う（同じジョブを2回走らせない）。
+    """
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    id = models.CharField(max_length=32, primary_key=True)  # uuid4().hex
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="diagnosis_jobs")
+
+    status = models.CharField(max_length=16, default=STATUS_QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0)  # 0-100
+    stage = models.CharField(max_length=32, blank=True, default="")
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    result = models.JSONField(null=True, blank=True)  # diagnose と同じレスポンス
+    error = models.TextField(blank=True, default="")
+
+    run_after = models.DateTimeField()  # リトライ時はバックオフ後の時刻
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # ワーカーの「次に走らせるジョブ」探し用
+            models.Index(fields=["status", "run_after"], name="diag_job_status_run_idx"),
+        ]
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+
+class ScoreStats(models.Model):
+    """
+    ユーザーごとの最新結果のスコア分布（core.score_stats）。各プロセスの差分を定期的に足し込む。
+    counts は int64(little endian) の [軸4 × bins, type_code 16] を詰めたバイト列。
+    """
+    key = models.CharField(max_length=32, primary_key=True)
+    bins = models.PositiveIntegerField()
+    counts = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class CatalogTrack(models.Model):
+    """
+    iTunes 検索で返ってきた曲（core.track_catalog のローカル検索用）。track_id は iTunes の trackId。
+    """
+    track_id = models.CharField(max_length=32, primary_key=True)
+    # 長さは upstream 次第なので制限しない（1曲が長すぎると upsert 全体が失敗する）
+    title = models.TextField()
+    artist = models.TextField()
+    artwork = models.CharField(max_length=300, blank=True, default="")
+    preview_url = models.CharField(max_length=300, blank=True, default="")
+    external_url = models.CharField(max_length=300, blank=True, default="")
+
+    first_seen_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,371 @@
+from __future__ import annotations
+
+import cProfile
+import contextvars
+import functools
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+# リクエスト単位の計測。
+# - 各リクエストに RequestTimings を contextvar で持たせ、upstream（spotify / itunes）と ORM の
+#   回数・時間を足し込む。レスポンスに Server-Timing ヘッダとして付ける
+# - エンドポイント（URL パターン）ごとの所要時間ヒストグラムを集計し、Prometheus 形式で出す
+# - SAMPLE_RATE の割合で cProfile を取り、PROFILE_DIR に .prof を書き出す（sync view のみ）
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Server-Timing / メトリクスに出す区分（この順に出す）
+COMPONENTS = ("db", "spotify", "itunes")
+
+
+def _conf() -> dict:
+    conf = {
+        "ENABLED": True,
+        "SERVER_TIMING": True,
+        "SAMPLE_RATE": 0.0,
+        "PROFILE_DIR": "",
+        "BUCKETS": DEFAULT_BUCKETS,
+        "METRICS_ALLOWED_IPS": ("127.0.0.1", "::1"),
+    }
+    conf.update(getattr(settings, "PROFILING", {}))
+    return conf
+
+
+# -------------------------
+# per-request timings
+# -------------------------
+class RequestTimings:
+    """
+    1リクエストの区分ごとの (回数, 秒)。spotify の並列取得などで別スレッドからも足される。
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.parts: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, n: int = 1) -> None:
+        with self._lock:
+            part = self.parts.get(name)
+            if part is None:
+                self.parts[name] = [n, seconds]
+            else:
+                part[0] += n
+                part[1] += seconds
+
+    def get(self, name: str) -> Tuple[int, float]:
+        with self._lock:
+            n, sec = self.parts.get(name, (0, 0.0))
+        return int(n), sec
+
+    def server_timing(self, total: float) -> str:
+        """
+        Server-Timing ヘッダの値。app は total から計測済みの区分を引いた残り（並列分は重なるので 0 で止める）。
+        """
+        items = []
+        measured = 0.0
+        for name in COMPONENTS:
+            n, sec = self.get(name)
+            if n:
+                measured += sec
+                items.append(f'{name};dur={sec * 1000:.1f};desc="{n} calls"')
+        items.append(f"app;dur={max(0.0, total - measured) * 1000:.1f}")
+        items.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(items)
+
+
+_current: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("request_timings", default=None)
+
+
+def current() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+def record(name: str, seconds: float, n: int = 1) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds, n)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """
+    with profiling.timed("spotify"): ... の所要時間を今のリクエストに足す（リクエスト外なら何もしない）。
+    """
+    if _current.get() is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+def timed_async(name: str):
+    """
+    async 関数用のデコレータ版 timed。
+    """
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with timed(name):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+def bind(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    ThreadPoolExecutor に渡す関数を、呼び出し元のリクエストの計測に紐づける
+    （contextvar はスレッドプールに引き継がれないため）。
+    """
+    timings = _current.get()
+    if timings is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current.set(timings)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return wrapper
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    """
+    connection.execute_wrappers 用。今のリクエストの db 区分にクエリ1件と時間を足す。
+    """
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add("db", time.perf_counter() - t0)
+
+
+def install_db_wrapper(sender, connection, **kwargs) -> None:
+    """
+    connection_created シグナル用。接続ごとに1回だけ db_execute_wrapper を入れる。
+    """
+    if db_execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, db_execute_wrapper)
+
+
+# -------------------------
+# aggregated metrics
+# -------------------------
+class EndpointMetrics:
+    """
+    (method, route) ごとの所要時間ヒストグラムと、区分ごとの合計（回数・秒）。
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._hist: Dict[Tuple[str, str], List[float]] = {}  # counts per bucket + [+Inf, sum]
+        self._parts: Dict[Tuple[str, str, str], List[float]] = {}
+        self._profiles = 0
+        self._lock = threading.Lock()
+
+    def observe(self, method: str, route: str, seconds: float, timings: Optional[RequestTimings] = None) -> None:
+        parts = [(name, *timings.get(name)) for name in COMPONENTS] if timings is not None else []
+        with self._lock:
+            h = self._hist.get((method, route))
+            if h is None:
+                h = self._hist[(method, route)] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    h[i] += 1
+            h[len(self.buckets)] += 1
+            h[-1] += seconds
+            for name, n, sec in parts:
+                if not n:
+                    continue
+                p = self._parts.get((method, route, name))
+                if p is None:
+                    p = self._parts[(method, route, name)] = [0, 0.0]
+                p[0] += n
+                p[1] += sec
+
+    def profiled(self) -> None:
+        with self._lock:
+            self._profiles += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._hist.clear()
+            self._parts.clear()
+            self._profiles = 0
+
+    def render(self) -> str:
+        """
+        Prometheus の text exposition format（0.0.4）。
+        """
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            parts = {k: list(v) for k, v in self._parts.items()}
+            profiles = self._profiles
+
+        lines = [
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), h in sorted(hist.items()):
+            labels = f'method="{method}",route="{_escape(route)}"'
+            for i, le in enumerate(self.buckets):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{le:g}"}} {int(h[i])}')
+            count = int(h[len(self.buckets)])
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {h[-1]:.6f}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {count}")
+
+        lines += [
+            "# HELP http_request_component_seconds_total Time spent in DB / upstream calls by route.",
+            "# TYPE http_request_component_seconds_total counter",
+        ]
+        for (method, route, name), (_, sec) in sorted(parts.items()):
+            lines.append(
+                f'http_request_component_seconds_total{{method="{method}",route="{_escape(route)}",component="{name}"}} {sec:.6f}'
+            )
+        lines += [
+            "# HELP http_request_component_calls_total Number of DB queries / upstream calls by route.",
+            "# TYPE http_request_component_calls_total counter",
+        ]
+        for (method, route, name), (n, _) in sorted(parts.items()):
+            lines.append(
+                f'http_request_component_calls_total{{method="{method}",route="{_escape(route)}",component="{name}"}} {int(n)}'
+            )
+        lines += [
+            "# HELP http_request_profiles_total Requests dumped with cProfile.",
+            "# TYPE http_request_profiles_total counter",
+            f"http_request_profiles_total {profiles}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_metrics: Optional[EndpointMetrics] = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> EndpointMetrics:
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = EndpointMetrics(tuple(_conf()["BUCKETS"]))
+    return _metrics
+
+
+# -------------------------
+# middleware
+# -------------------------
+def _route(request) -> str:
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "<unmatched>"
+    return "/" + match.route if match.route else match.view_name or "<unknown>"
+
+
+# cProfile は同時に1つだけ（別スレッドの計測が混ざらないように）
+_profile_lock = threading.Lock()
+_SAFE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _dump_profile(profiler: cProfile.Profile, directory: str, method: str, route: str, seconds: float) -> None:
+    os.makedirs(directory, exist_ok=True)
+    name = _SAFE.sub("_", route.strip("/")) or "root"
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, f"{stamp}-{method}-{name}-{seconds * 1000:.0f}ms-{os.getpid()}.prof")
+    profiler.dump_stats(path)
+
+
+class ProfilingMiddleware:
+    """
+    Server-Timing ヘッダ、エンドポイントごとのヒストグラム、サンプリングした cProfile。
+    MIDDLEWARE の先頭に置く（他の middleware の時間も total に入る）。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        conf = _conf()
+        self.enabled = bool(conf["ENABLED"])
+        self.server_timing = bool(conf["SERVER_TIMING"])
+        self.sample_rate = float(conf["SAMPLE_RATE"] or 0.0)
+        self.profile_dir = str(conf["PROFILE_DIR"] or "")
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _finish(self, request, response, timings: RequestTimings) -> float:
+        total = time.perf_counter() - timings.started
+        if self.server_timing:
+            response["Server-Timing"] = timings.server_timing(total)
+        get_metrics().observe(request.method, _route(request), total, timings)
+        return total
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        profiler = None
+        if self.profile_dir and self.sample_rate > 0 and random.random() < self.sample_rate:
+            if _profile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            total = self._finish(request, response, timings)
+            if profiler is not None:
+                try:
+                    _dump_profile(profiler, self.profile_dir, request.method, _route(request), total)
+                    get_metrics().profiled()
+                except OSError:
+                    pass
+            return response
+        finally:
+            if profiler is not None:
+                _profile_lock.release()
+            _current.reset(token)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            response = await self.get_response(request)
+            self._finish(request, response, timings)
+            return response
+        finally:
+            _current.reset(token)
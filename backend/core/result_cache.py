@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from . import fast_json, type_catalog
+
+# /api/result/<username> のレンダリング済みレスポンスキャッシュ。
+# 新しい DiagnosisResult が書かれたら LatestDiagnosis.point_to() から、表示名が変わったら
+# User の post_save（core.apps）から invalidate される。
+# invalidate は CACHE_ALIAS のキャッシュにしか届かないので、複数プロセスで動かすときは共有キャッシュ
+# （redis など）を使う。プロセス内キャッシュ（LocMem）のときは LOCAL_TIMEOUT 秒までしか持たない。
+# ETag は本文のハッシュを含む（同じ結果でも表示名や再計算で本文が変われば変わる）。
+
+
+@dataclass(frozen=True)
+class ResultEntry:
+    username: str
+    result_id: int
+    body: bytes
+    etag: str
+    last_modified: int  # epoch 秒
+
+
+def _conf() -> dict:
+    return dict(getattr(settings, "RESULT_CACHE", {}))
+
+
+def _cache():
+    return caches[_conf().get("CACHE_ALIAS", "default")]
+
+
+def _timeout(cache) -> float:
+    conf = _conf()
+    timeout = conf.get("TIMEOUT", 3600)
+    if isinstance(cache, LocMemCache):
+        timeout = min(timeout, conf.get("LOCAL_TIMEOUT", 5))
+    return timeout
+
+
+def _key(username: str) -> str:
+    return f"result_json:{username}"
+
+
+def payload_for(user: User, latest) -> dict:
+    entry = type_catalog.get(latest.type_code)
+    return {
+        "username": user.username,
+        "display_name": user.first_name or user.username,
+        "computed_at": latest.computed_at.isoformat(),
+        "type_code": latest.type_code,
+        "type_info": entry.info,
+        "scores": {
+            "energy": latest.energy_score,
+            "mood": latest.mood_score,
+            "texture": latest.texture_score,
+            "explore": latest.explore_score,
+        },
+        "sample_track_ids": latest.sample_track_ids,
+        "sample_tracks": entry.track_dicts,
+    }
+
+
+def _render(user: User, latest) -> ResultEntry:
+    payload = payload_for(user, latest)
+    ts = latest.computed_at.timestamp()
+    tag = f"r{latest.pk}" if latest.pk else "p"  # p: write-behind でまだ書いていない結果
+    body = fast_json.dumps(payload)  # type_info / sample_tracks はエンコード済みの断片を使う
+    digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+    return ResultEntry(
+        username=user.username,
+        result_id=latest.pk or 0,
+        body=body,
+        etag=f'"{tag}-{int(ts * 1_000_000)}-{digest}"',
+        last_modified=int(ts),
+    )
+
+
+def get_entry(username: str) -> Optional[ResultEntry]:
+    """
+    キャッシュ済みならDBに触らず返す。miss なら LatestDiagnosis から1クエリで作って載せる。
+    ユーザー/結果が無ければ None（この場合はキャッシュしない）。
+    write-behind でまだ書いていない結果があればそれを返す（キャッシュしない）。
+    """
+    from .models import LatestDiagnosis
+    from .write_behind import pending_for
+
+    pending = pending_for(username)
+    if pending is not None:
+        return _render(pending.user, pending)
+
+    cache = _cache()
+    entry = cache.get(_key(username))
+    if entry is not None:
+        return entry
+
+    pointer = (
+        LatestDiagnosis.objects.select_related("user", "result")
+        .filter(user__username=username)
+        .first()
+    )
+    if pointer is None:
+        return None
+
+    entry = _render(pointer.user, pointer.result)
+    cache.set(_key(username), entry, _timeout(cache))
+    return entry
+
+
+def invalidate(usernames: Iterable[str]) -> None:
+    keys = [_key(u) for u in usernames]
+    if not keys:
+        return
+    _cache().delete_many(keys)
+    # コミット前に別リクエストが古い結果を載せ直した場合に備えて、コミット後にも消す
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+
+def on_user_saved(sender, instance, created=False, update_fields=None, **kwargs) -> None:
+    """
+    User の post_save。表示名（first_name）が変わりうる保存ならキャッシュを消す（last_login だけの保存などは無視）。
+    """
+    if created or (update_fields is not None and "first_name" not in update_fields):
+        return
+    invalidate([instance.username])
+
+
+def invalidate_results(results) -> None:
+    """
+    保存された DiagnosisResult 群のユーザーのキャッシュを消す。
+    user がロード済みならクエリしない。
+    """
+    names = set()
+    missing = set()
+    for r in results:
+        user = r._state.fields_cache.get("user")
+        if user is not None:
+            names.add(user.username)
+        else:
+            missing.add(r.user_id)
+    if missing:
+        names.update(User.objects.filter(pk__in=missing).values_list("username", flat=True))
+    invalidate(names)
+
+
+def respond(request, entry: ResultEntry) -> HttpResponse:
+    """
+    If-None-Match / If-Modified-Since を見て 304 か、キャッシュ済み本文をそのまま返す。
+    CDN 向けに Cache-Control を付ける。
+    """
+    conf = _conf()
+    response = get_conditional_response(request, etag=entry.etag, last_modified=entry.last_modified)
+    if response is None:
+        response = HttpResponse(entry.body, content_type="application/json")
+    response["ETag"] = entry.etag
+    response["Last-Modified"] = http_date(entry.last_modified)
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=conf.get("MAX_AGE", 60),
+        s_maxage=conf.get("S_MAXAGE", 300),
+        stale_while_revalidate=conf.get("STALE_WHILE_REVALIDATE", 600),
+    )
+    return response
@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from .batch_scoring import TYPE_CODES
+
+# 「あなたの energy は 83% のユーザーより高い」用の、ユーザーごとの最新結果の分布。
+# 各軸を BINS 本の固定幅ヒストグラムで持ち、type_code は16種類の件数で持つ。
+# - 足し引きできる（mergeable）ので、プロセスごとに差分を溜めて定期的に ScoreStats 行へ足し込む
+# - 順位は累積和（読むときに1回だけ作る）から O(1)
+# LatestDiagnosis.point_to() が古い最新結果を引いて新しい結果を足す。
+# 16タイプ以外の type_code（壊れたデータ等）は軸のヒストグラムにだけ数える（足すときも引くときも）。
+
+AXES = ("energy", "mood", "texture", "explore")
+SCORE_FIELDS = ("energy_score", "mood_score", "texture_score", "explore_score")
+DEFAULT_BINS = 1000
+_TYPE_INDEX = {str(c): i for i, c in enumerate(TYPE_CODES.tolist())}
+
+# (energy, mood, texture, explore, type_code)
+Row = Tuple[float, float, float, float, str]
+
+
+class ScoreHistogram:
+    def __init__(self, bins: int = DEFAULT_BINS) -> None:
+        self.bins = bins
+        self.counts = np.zeros((len(AXES), bins), dtype=np.int64)
+        self.types = np.zeros(len(TYPE_CODES), dtype=np.int64)
+        self._prefix: Optional[np.ndarray] = None
+
+    @property
+    def total(self) -> int:
+        # 16タイプ以外の type_code の人も数える（軸のヒストグラムはどの人も1回ずつ数えている）
+        return int(self.counts[0].sum())
+
+    def __bool__(self) -> bool:
+        return bool(self.types.any() or self.counts.any())
+
+    def _bin(self, v: float) -> int:
+        return min(self.bins - 1, max(0, int(float(v) * self.bins)))
+
+    def add(self, row: Row, n: int = 1) -> None:
+        *scores, code = row
+        for a, v in enumerate(scores):
+            self.counts[a, self._bin(v)] += n
+        t = _TYPE_INDEX.get(code)
+        if t is not None:
+            self.types[t] += n
+        self._prefix = None
+
+    def add_many(self, rows: Sequence[Row]) -> None:
+        if not rows:
+            return
+        scores = np.clip(np.array([r[:4] for r in rows], dtype=np.float64), 0.0, 1.0)
+        b = np.minimum((scores * self.bins).astype(np.int64), self.bins - 1)
+        for a in range(len(AXES)):
+            self.counts[a] += np.bincount(b[:, a], minlength=self.bins)
+        types = [_TYPE_INDEX.get(r[4]) for r in rows]
+        self.types += np.bincount([t for t in types if t is not None], minlength=len(TYPE_CODES)).astype(np.int64)
+        self._prefix = None
+
+    def merge(self, other: "ScoreHistogram") -> None:
+        assert other.bins == self.bins
+        self.counts += other.counts
+        self.types += other.types
+        self._prefix = None
+
+    def copy(self) -> "ScoreHistogram":
+        h = ScoreHistogram(self.bins)
+        h.counts[:] = self.counts
+        h.types[:] = self.types
+        return h
+
+    # -------------------------
+    # queries
+    # -------------------------
+    def percentile(self, axis: int, value: float) -> float:
+        """
+        value より低いユーザーの割合（0-100）。同じビンの人は半分数える（mid-rank）。
+        """
+        total = self.total
+        if total <= 0:
+            return 0.0
+        if self._prefix is None:
+            prefix = np.zeros((len(AXES), self.bins + 1), dtype=np.int64)
+            np.cumsum(self.counts, axis=1, out=prefix[:, 1:])
+            self._prefix = prefix
+        b = self._bin(value)
+        below = self._prefix[axis, b] + 0.5 * self.counts[axis, b]
+        return float(100.0 * below / total)
+
+    def percentiles(self, scores: Sequence[float]) -> Dict[str, float]:
+        return {name: round(self.percentile(a, v), 1) for a, (name, v) in enumerate(zip(AXES, scores))}
+
+    def type_counts(self) -> Dict[str, int]:
+        return {str(c): int(n) for c, n in zip(TYPE_CODES.tolist(), self.types.tolist())}
+
+    # -------------------------
+    # (de)serialize
+    # -------------------------
+    def to_bytes(self) -> bytes:
+        a = np.concatenate([self.counts.ravel(), self.types]).astype("<i8")
+        return a.tobytes()
+
+    @classmethod
+    def from_bytes(cls, raw: bytes, bins: int) -> "ScoreHistogram":
+        h = cls(bins)
+        a = np.frombuffer(bytes(raw), dtype="<i8").astype(np.int64)
+        n = len(AXES) * bins
+        h.counts[:] = a[:n].reshape(len(AXES), bins)
+        h.types[:] = a[n:]
+        return h
+
+
+def _conf() -> dict:
+    conf = {"BINS": DEFAULT_BINS, "PERSIST_INTERVAL": 10.0}
+    conf.update(getattr(settings, "SCORE_STATS", {}))
+    return conf
+
+
+def _scores_of(r) -> Row:
+    return tuple(getattr(r, f) for f in SCORE_FIELDS) + (r.type_code,)
+
+
+class ScoreStatsStore:
+    """
+    ScoreStats（DB に保存された全体分布）＋このプロセスの未保存の差分。
+    PERSIST_INTERVAL 秒ごとに差分を DB 行へ足し込み、他プロセスの分も読み直す。
+    """
+
+    KEY = "global"
+
+    def __init__(self, bins: int = DEFAULT_BINS, interval: float = 10.0) -> None:
+        self.bins = bins
+        self.interval = interval
+        self._base: Optional[ScoreHistogram] = None
+        self._delta = ScoreHistogram(bins)
+        self._view: Optional[ScoreHistogram] = None
+        self._loaded_at = 0.0
+        self._lock = threading.RLock()
+
+    def record(self, added: Iterable[Row], removed: Iterable[Row] = ()) -> None:
+        with self._lock:
+            for row in added:
+                self._delta.add(row)
+            for row in removed:
+                self._delta.add(row, -1)
+            self._view = None
+        try:
+            self._maybe_sync()
+        except Exception:
+            # コミット後に呼ばれるので、保存に失敗しても差分を持ったまま次回に回す
+            pass
+
+    def snapshot(self) -> ScoreHistogram:
+        """
+        読み取り用の分布（base + 差分）。次に record / sync されるまで同じオブジェクトを返す。
+        """
+        self._maybe_sync()
+        with self._lock:
+            if self._view is None:
+                view = self._base.copy()
+                view.merge(self._delta)
+                self._view = view
+            return self._view
+
+    def _maybe_sync(self) -> None:
+        if self._base is None or time.monotonic() - self._loaded_at >= self.interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        差分を DB に足し込んで、全体を読み直す（行が無ければ LatestDiagnosis から作る）。
+        """
+        from .models import ScoreStats
+
+        with self._lock:
+            delta, self._delta = self._delta, ScoreHistogram(self.bins)
+            try:
+                with transaction.atomic():
+                    row = ScoreStats.objects.select_for_update().filter(pk=self.KEY).first()
+                    if row is None or row.bins != self.bins:
+                        # 作り直した分布には差分（コミット済みの結果）が既に入っている
+                        base = build_from_db(self.bins)
+                        ScoreStats.objects.update_or_create(
+                            pk=self.KEY, defaults={"bins": self.bins, "counts": base.to_bytes()}
+                        )
+                    else:
+                        base = ScoreHistogram.from_bytes(row.counts, self.bins)
+                        if delta:
+                            base.merge(delta)
+                            row.counts = base.to_bytes()
+                            row.save(update_fields=["counts", "updated_at"])
+            except Exception:
+                # 書けなかった差分は次回に回す
+                self._delta.merge(delta)
+                raise
+            self._base = base
+            self._view = None
+            self._loaded_at = time.monotonic()
+
+
+def build_from_db(bins: int = DEFAULT_BINS) -> ScoreHistogram:
+    """
+    LatestDiagnosis（ユーザーごとの最新結果）から分布を作り直す。
+    """
+    from .models import LatestDiagnosis
+
+    h = ScoreHistogram(bins)
+    qs = LatestDiagnosis.objects.values_list(*[f"result__{f}" for f in SCORE_FIELDS], "result__type_code")
+    chunk: List[Row] = []
+    for row in qs.iterator(chunk_size=10_000):
+        chunk.append(row)
+        if len(chunk) >= 10_000:
+            h.add_many(chunk)
+            chunk = []
+    h.add_many(chunk)
+    return h
+
+
+_store: Optional[ScoreStatsStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> ScoreStatsStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                conf = _conf()
+                _store = ScoreStatsStore(bins=conf["BINS"], interval=conf["PERSIST_INTERVAL"])
+    return _store
+
+
+def reset_store() -> None:
+    global _store
+    with _store_lock:
+        _store = None
+
+
+def rebuild() -> ScoreHistogram:
+    """
+    DB の分布を LatestDiagnosis から作り直す（bulk_update で最新結果を書き換えた後など）。
+    """
+    from .models import ScoreStats
+
+    store = get_store()
+    with store._lock:
+        hist = build_from_db(store.bins)
+        ScoreStats.objects.update_or_create(pk=store.KEY, defaults={"bins": store.bins, "counts": hist.to_bytes()})
+        store._delta = ScoreHistogram(store.bins)
+        store._base = hist
+        store._view = None
+        store._loaded_at = time.monotonic()
+    return hist
+
+
+def on_results(results: Iterable, replaced: Sequence[Row]) -> None:
+    """
+    新しい最新結果を足し、置き換えられた前の最新結果を引く（コミット後に反映）。
+    """
+    added = [_scores_of(r) for r in results]
+    if not added and not replaced:
+        return
+    transaction.on_commit(lambda: get_store().record(added, replaced))
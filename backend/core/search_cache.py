@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+
+_MISSING = object()
+
+# backend に置く値の形式を変えたら上げる（共有キャッシュに残った古い形式の値を読まないように）
+KEY_VERSION = 2
+
+
+def normalize_key(term: str, limit: int, country: str, default_term: str = "J-POP") -> str:
+    """
+    (term, limit, country) を正規化してキャッシュキーにする。
+    大文字小文字・前後/連続空白の違いは同じキーになる。
+    """
+    q = " ".join((term or "").split()) or default_term
+    q = unicodedata.normalize("NFC", q).casefold()
+    return f"itunes:v{KEY_VERSION}:{(country or '').upper()}:{int(limit)}:{q}"
+
+
+# -------------------------
+# backends
+# -------------------------
+class LocalTTLCache:
+    """
+    プロセス内の TTL + LRU キャッシュ。
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return _MISSING
+            expires_at, value = hit
+            if expires_at <= now:
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DjangoCacheBackend:
+    """
+    Django の cache framework（settings.CACHES）に載せる版。
+    LRU/最大件数は cache backend 側の設定に従う。
+    """
+
+    def __init__(self, alias: str = "default") -> None:
+        from django.core.cache import caches
+
+        self._cache = caches[alias]
+        self.evictions = 0
+
+    def get(self, key: str) -> Any:
+        return self._cache.get(key, _MISSING)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._cache.set(key, value, timeout=ttl)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+# -------------------------
+# single-flight cache
+# -------------------------
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SearchCache:
+    """
+    検索結果キャッシュ。
+    同じキーの miss が同時に来たら upstream を叩くのは1回だけ（他は待って結果を共有）。
+    失敗はキャッシュしない。
+    TTL を過ぎても STALE_TTL の間は古い値を残しておき、upstream が失敗したときや
+    ブレーカー（core.circuit_breaker）が開いているときはそれを返す。
+    ブレーカーが開いている間の再検証は、OPEN_SEC ごとにバックグラウンドで1回だけ。
+    """
+
+    def __init__(self, backend: Any, ttl: float = 300.0, stale_ttl: float = 0.0) -> None:
+        self.backend = backend
+        self.ttl = float(ttl)
+        self.stale_ttl = max(0.0, float(stale_ttl))
+        self._flights: Dict[str, _Flight] = {}
+        self._aflights: Dict[Tuple[int, str], "asyncio.Future[Any]"] = {}
+        self._probes: Set["asyncio.Task[Any]"] = set()  # 実行中の async 再検証（GC されないように持つ）
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_served = 0
+
+    # -------------------------
+    # storage: backend には (fresh_until, value) を TTL + STALE_TTL で置く
+    # -------------------------
+    def _lookup(self, key: str) -> Tuple[Any, Any]:
+        """
+        (新しい値, 古くてもよい値)。無ければ _MISSING。
+        """
+        raw = self.backend.get(key)
+        if raw is _MISSING:
+            return _MISSING, _MISSING
+        fresh_until, value = raw
+        if fresh_until > time.time():
+            return value, value
+        return _MISSING, value
+
+    def _store(self, key: str, value: Any) -> None:
+        self.backend.set(key, (time.time() + self.ttl, value), self.ttl + self.stale_ttl)
+
+    def _serve_stale(self, stale: Any, error: BaseException) -> Any:
+        if stale is _MISSING:
+            raise error
+        with self._lock:
+            self.stale_served += 1
+        return stale
+
+    @staticmethod
+    def _call(fetch: Callable[[], Any], breaker: Optional[CircuitBreaker]) -> Any:
+        t0 = time.perf_counter()
+        try:
+            value = fetch()
+        except Exception:
+            if breaker is not None:
+                breaker.record(False)
+            raise
+        except BaseException:
+            if breaker is not None:
+                breaker.abort()
+            raise
+        if breaker is not None:
+            breaker.record(True, time.perf_counter() - t0)
+        return value
+
+    def _probe(self, key: str, fetch: Callable[[], Any], breaker: CircuitBreaker) -> None:
+        def run() -> None:
+            from django.db import connections
+
+            try:
+                self._store(key, self._call(fetch, breaker))
+            except Exception:
+                pass
+            finally:
+                connections.close_all()  # fetch が DB を触った場合（このスレッドの接続だけ閉じる）
+
+        threading.Thread(target=run, name=f"{breaker.name}-probe", daemon=True).start()
+
+    # -------------------------
+    # sync
+    # -------------------------
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any], breaker: Optional[CircuitBreaker] = None) -> Any:
+        value, stale = self._lookup(key)
+        if value is not _MISSING:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        if breaker is not None and not breaker.allow():
+            if breaker.try_start_probe():
+                self._probe(key, fetch, breaker)
+            return self._serve_stale(stale, CircuitOpenError(breaker.name))
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            try:
+                flight.value = self._call(fetch, breaker)
+                self._store(key, flight.value)
+            except Exception as e:
+                flight.value = self._serve_stale(stale, e)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    # -------------------------
+    # async
+    # -------------------------
+    @staticmethod
+    async def _acall(fetch: Callable[[], Awaitable[Any]], breaker: Optional[CircuitBreaker]) -> Any:
+        t0 = time.perf_counter()
+        try:
+            value = await fetch()
+        except Exception:
+            if breaker is not None:
+                breaker.record(False)
+            raise
+        except BaseException:
+            # CancelledError: 再検証のタスクがリクエストのループと一緒に止められたときなど
+            if breaker is not None:
+                breaker.abort()
+            raise
+        if breaker is not None:
+            breaker.record(True, time.perf_counter() - t0)
+        return value
+
+    async def _aprobe(self, key: str, fetch: Callable[[], Awaitable[Any]], breaker: CircuitBreaker) -> None:
+        # ループが閉じられるとキャンセルされる（_acall が abort() して open に戻す）
+        try:
+            self._store(key, await self._acall(fetch, breaker))
+        except Exception:
+            pass
+
+    async def aget_or_fetch(
+        self, key: str, fetch: Callable[[], Awaitable[Any]], breaker: Optional[CircuitBreaker] = None
+    ) -> Any:
+        """
+        get_or_fetch の async 版。待ち合わせは asyncio.Future（ループごと）で行う。
+        backend の get/set は同期呼び出しなので、ブロックしない backend（local）前提。
+        ブレーカーが開いているときの再検証は同じループのタスクで行う（ループと一緒に
+        キャンセルされたら open に戻り、次の OPEN_SEC 後に別のリクエストがやり直す）。
+        """
+        value, stale = self._lookup(key)
+        if value is not _MISSING:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        loop = asyncio.get_running_loop()
+        if breaker is not None and not breaker.allow():
+            if breaker.try_start_probe():
+                task = loop.create_task(self._aprobe(key, fetch, breaker))
+                self._probes.add(task)
+                task.add_done_callback(self._probes.discard)
+            return self._serve_stale(stale, CircuitOpenError(breaker.name))
+
+        fkey = (id(loop), key)
+        fut = self._aflights.get(fkey)
+        if fut is not None:
+            with self._lock:
+                self.coalesced += 1
+            return await asyncio.shield(fut)
+
+        fut = self._aflights[fkey] = loop.create_future()
+        with self._lock:
+            self.misses += 1
+        try:
+            try:
+                value = await self._acall(fetch, breaker)
+                self._store(key, value)
+            except Exception as e:
+                value = self._serve_stale(stale, e)
+            fut.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # 待っている人がいなくても "exception was never retrieved" を出さない
+            fut.exception()
+            raise
+        finally:
+            self._aflights.pop(fkey, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "stale_served": self.stale_served,
+                "in_flight": len(self._flights) + len(self._aflights),
+            }
+        out["evictions"] = getattr(self.backend, "evictions", 0)
+        if hasattr(self.backend, "__len__"):
+            out["entries"] = len(self.backend)
+        return out
+
+
+_cache: Optional[SearchCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    """
+    settings.SEARCH_CACHE から共有キャッシュを作る（初回だけ）。
+      BACKEND: "local"（既定）または "django"
+      TTL: 秒, STALE_TTL: TTL 後も失敗時の代わりに返してよい秒数
+      MAX_ENTRIES: local のみ, CACHE_ALIAS: django のみ
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = _build_from_settings()
+    return _cache
+
+
+def _build_from_settings() -> SearchCache:
+    from django.conf import settings
+
+    conf = dict(getattr(settings, "SEARCH_CACHE", {}))
+    if conf.get("BACKEND", "local") == "django":
+        backend: Any = DjangoCacheBackend(conf.get("CACHE_ALIAS", "default"))
+    else:
+        backend = LocalTTLCache(conf.get("MAX_ENTRIES", 1024))
+    return SearchCache(backend, ttl=conf.get("TTL", 300), stale_ttl=conf.get("STALE_TTL", 0))
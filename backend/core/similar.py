@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import math
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+# 「音楽の双子」検索用の、最新診断スコア（4次元）のメモリ内インデックス。
+# [0, 1]^4 を一様グリッド（各軸 cells 分割）に切り、セル -> slot のバケットを持つ。
+# 近傍探索は自分のセルからチェビシェフ距離 r のシェルを k 人見つかるまで広げ、
+# そのあと k 番目の距離の球に掛かる残りのセルだけを見る（厳密な k-NN）。
+# LatestDiagnosis.point_to() からコミット後に更新される（プロセスごとのインデックス）。
+# プロセス起動時（core.warmup）に DB から作る。CELLS を固定していなければ、人数が前回のセル分け時の
+# REBUILD_GROWTH 倍になるたびに auto_cells で分割数を見直し、セル分けだけやり直す（DB は読まない）。
+
+DIM = 4
+SCORE_FIELDS = ("energy_score", "mood_score", "texture_score", "explore_score")
+
+
+@dataclass(frozen=True)
+class Neighbor:
+    username: str
+    type_code: str
+    scores: tuple  # energy, mood, texture, explore
+    distance: float
+
+
+def auto_cells(n: int, per_cell: int = 8) -> int:
+    """
+    1セルあたり per_cell 人くらいになる分割数（一様分布なら r=1 のシェルで k=10 が埋まる）。
+    """
+    return int(min(64, max(1, round((max(n, 1) / per_cell) ** (1 / DIM)))))
+
+
+class SimilarityIndex:
+    def __init__(self, cells: int = 16, capacity: int = 1024) -> None:
+        self._set_cells(cells)
+        self.celled_at = 0  # 最後にセル分けしたときの人数
+        self._pts = np.zeros((capacity, DIM), dtype=np.float64)
+        self._uids = np.zeros(capacity, dtype=np.int64)
+        self._names: List[str] = []
+        self._codes: List[str] = []
+        self._cell_of: List[int] = []
+        self._slot_by_name: Dict[str, int] = {}
+        self._slot_by_uid: Dict[int, int] = {}
+        self._buckets: Dict[int, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slot_by_uid)
+
+    # -------------------------
+    # build / update
+    # -------------------------
+    def _set_cells(self, cells: int) -> None:
+        self.cells = max(1, int(cells))
+        self.width = 1.0 / self.cells
+        self._mult = np.array([self.cells**3, self.cells**2, self.cells, 1], dtype=np.int64)
+        self._cubes: Dict[int, tuple] = {}
+
+    def _bucketize(self, n: int) -> None:
+        """
+        先頭 n 人をセルに分け直す（argsort 1回）。ロックを持って呼ぶ。
+        """
+        cell_ids = self._coords(self._pts[:n]) @ self._mult
+        self._cell_of = cell_ids.tolist()
+        order = np.argsort(cell_ids, kind="stable")
+        sorted_ids = cell_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if n else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], n]
+        slots = order.tolist()
+        self._buckets = {int(sorted_ids[s]): slots[s:e] for s, e in zip(starts.tolist(), ends.tolist())}
+        self.celled_at = n
+
+    def recell(self, cells: int) -> None:
+        """
+        分割数を変えてセル分けだけやり直す（点はそのまま）。
+        """
+        with self._lock:
+            self._set_cells(cells)
+            self._bucketize(len(self._names))
+
+    def maybe_recell(self, growth: float = 2.0) -> bool:
+        """
+        前回のセル分けから人数が growth 倍以上になっていて、auto_cells の分割数が変わるならやり直す。
+        """
+        n = len(self)
+        if n < max(1, self.celled_at) * growth:
+            return False
+        cells = auto_cells(n)
+        if cells == self.cells:
+            self.celled_at = n  # 次の判定は今の人数から
+            return False
+        self.recell(cells)
+        return True
+
+    def _coords(self, pts: np.ndarray) -> np.ndarray:
+        return np.minimum((np.clip(pts, 0.0, 1.0) * self.cells).astype(np.int64), self.cells - 1)
+
+    def _grow(self, need: int) -> None:
+        cap = self._pts.shape[0]
+        if need <= cap:
+            return
+        cap = max(need, cap * 2)
+        pts = np.zeros((cap, DIM), dtype=np.float64)
+        pts[: len(self._names)] = self._pts[: len(self._names)]
+        uids = np.zeros(cap, dtype=np.int64)
+        uids[: len(self._names)] = self._uids[: len(self._names)]
+        self._pts, self._uids = pts, uids
+
+    def bulk_load(
+        self,
+        user_ids: Sequence[int],
+        usernames: Sequence[str],
+        scores: np.ndarray,
+        type_codes: Sequence[str],
+    ) -> None:
+        """
+        空のインデックスにまとめて詰める（セル分けは argsort 1回）。
+        """
+        n = len(usernames)
+        with self._lock:
+            assert not self._names, "bulk_load は空のインデックスにだけ使う"
+            self._grow(n)
+            pts = np.asarray(scores, dtype=np.float64).reshape(n, DIM)
+            self._pts[:n] = pts
+            self._uids[:n] = np.asarray(user_ids, dtype=np.int64)
+            self._names = list(usernames)
+            self._codes = list(type_codes)
+            self._slot_by_name = {name: i for i, name in enumerate(self._names)}
+            self._slot_by_uid = {int(u): i for i, u in enumerate(self._uids[:n].tolist())}
+            self._bucketize(n)
+
+    def upsert(self, user_id: int, username: str, scores: Sequence[float], type_code: str) -> None:
+        pt = np.asarray(scores, dtype=np.float64)
+        cell = int(self._coords(pt[None, :])[0] @ self._mult)
+        with self._lock:
+            slot = self._slot_by_uid.get(user_id)
+            if slot is None:
+                slot = len(self._names)
+                self._grow(slot + 1)
+                self._names.append(username)
+                self._codes.append(type_code)
+                self._cell_of.append(-1)
+                self._uids[slot] = user_id
+                self._slot_by_uid[user_id] = slot
+            else:
+                self._slot_by_name.pop(self._names[slot], None)
+                self._names[slot] = username
+                self._codes[slot] = type_code
+
+            old = self._cell_of[slot]
+            if old != cell:
+                if old >= 0:
+                    self._buckets[old].remove(slot)
+                    if not self._buckets[old]:
+                        del self._buckets[old]
+                self._buckets.setdefault(cell, []).append(slot)
+                self._cell_of[slot] = cell
+            self._pts[slot] = pt
+            self._slot_by_name[username] = slot
+
+    # -------------------------
+    # query
+    # -------------------------
+    def _cube(self, r: int):
+        """
+        チェビシェフ距離 r 以内のセルオフセット（(n, 4) int64）と、それぞれのチェビシェフ距離。
+        """
+        cube = self._cubes.get(r)
+        if cube is None:
+            rng = np.arange(-r, r + 1, dtype=np.int64)
+            offs = np.stack(np.meshgrid(rng, rng, rng, rng, indexing="ij"), axis=-1).reshape(-1, DIM)
+            cube = self._cubes[r] = (offs, np.abs(offs).max(axis=1))
+        return cube
+
+    def _gather(self, cc: np.ndarray, slot: int, q: np.ndarray):
+        """
+        セル座標 cc（グリッド外は捨てる）に入っている slot（自分以外）と、q との距離の2乗。
+        """
+        cc = cc[((cc >= 0) & (cc < self.cells)).all(axis=1)]
+        cand: List[int] = []
+        buckets = self._buckets
+        for cid in (cc @ self._mult).tolist():
+            b = buckets.get(cid)
+            if b:
+                cand.extend(b)
+        idx = np.array(cand, dtype=np.int64)
+        idx = idx[idx != slot]
+        diff = self._pts[idx] - q
+        return idx, np.einsum("ij,ij->i", diff, diff), len(cc)
+
+    def nearest(self, username: str, k: int = 10) -> Optional[List[Neighbor]]:
+        """
+        username の最新スコアに近い順に k 人（自分以外）。インデックスに居なければ None。
+        距離が同じなら user_id の小さい順。
+        """
+        with self._lock:
+            slot = self._slot_by_name.get(username)
+            if slot is None:
+                return None
+            q = self._pts[slot].copy()
+            qc = self._coords(q[None, :])[0]
+            found_slots: List[np.ndarray] = []
+            found_d2: List[np.ndarray] = []
+            n_found = 0
+
+            # 1) k 人見つかるまでシェルを広げる
+            r = 0
+            while True:
+                offs, cheb = self._cube(r)
+                idx, d2, n_cells = self._gather(qc + offs[cheb == r], slot, q)
+                found_slots.append(idx)
+                found_d2.append(d2)
+                n_found += len(idx)
+                if n_found >= k or n_cells == 0:
+                    break  # n_cells == 0: グリッド全体を見終わった
+                r += 1
+
+            # 2) k 番目の距離の球に掛かる、まだ見ていないセルだけ追加で見る（これで厳密になる）
+            if n_found >= k:
+                kth = float(np.partition(np.concatenate(found_d2), k - 1)[k - 1])
+                R = min(self.cells - 1, int(np.ceil(np.sqrt(kth) / self.width)))
+                if R > r:
+                    offs, cheb = self._cube(R)
+                    cc = qc + offs[cheb > r]
+                    lo = cc * self.width
+                    gap = np.maximum(np.maximum(lo - q, q - (lo + self.width)), 0.0)
+                    cc = cc[np.einsum("ij,ij->i", gap, gap) <= kth + 1e-12]
+                    if len(cc):
+                        idx, d2, _ = self._gather(cc, slot, q)
+                        found_slots.append(idx)
+                        found_d2.append(d2)
+
+            if not found_slots:
+                return []
+            idx = np.concatenate(found_slots)
+            d2 = np.concatenate(found_d2)
+            order = np.lexsort((self._uids[idx], d2))[:k]
+            top = idx[order]
+            return [
+                Neighbor(
+                    username=self._names[s],
+                    type_code=self._codes[s],
+                    scores=tuple(self._pts[s].tolist()),
+                    distance=math.sqrt(d),
+                )
+                for s, d in zip(top.tolist(), d2[order].tolist())
+            ]
+
+    def brute_force(self, username: str, k: int = 10) -> Optional[List[Neighbor]]:
+        """
+        全件スキャン版（ベンチ・検証用）。並びは nearest と同じ規則。
+        """
+        with self._lock:
+            slot = self._slot_by_name.get(username)
+            if slot is None:
+                return None
+            n = len(self._names)
+            diff = self._pts[:n] - self._pts[slot]
+            d2 = np.einsum("ij,ij->i", diff, diff)
+            d2[slot] = np.inf
+            k = min(k, n - 1)
+            if k <= 0:
+                return []
+            part = np.argpartition(d2, k - 1)[:k]
+            kth = d2[part].max()
+            idx = np.flatnonzero(d2 <= kth)  # 同距離の取りこぼしを防ぐ
+            order = np.lexsort((self._uids[idx], d2[idx]))[:k]
+            top = idx[order]
+            return [
+                Neighbor(self._names[s], self._codes[s], tuple(self._pts[s].tolist()), math.sqrt(d2[s]))
+                for s in top.tolist()
+            ]
+
+
+# -------------------------
+# process-wide index
+# -------------------------
+_index: Optional[SimilarityIndex] = None
+_index_lock = threading.Lock()
+
+
+def _conf() -> dict:
+    conf = {"CELLS": None, "REBUILD_GROWTH": 2.0, "BUILD_AT_STARTUP": True}
+    conf.update(getattr(settings, "SIMILAR_INDEX", {}))
+    return conf
+
+
+def build_from_db() -> SimilarityIndex:
+    """
+    LatestDiagnosis（ユーザーごとの最新結果）から1クエリで作る。
+    """
+    from .models import LatestDiagnosis
+
+    user_ids: List[int] = []
+    names: List[str] = []
+    codes: List[str] = []
+    flat: List[float] = []
+    qs = LatestDiagnosis.objects.values_list(
+        "user_id",
+        "user__username",
+        "result__type_code",
+        *[f"result__{f}" for f in SCORE_FIELDS],
+    )
+    for uid, name, code, e, m, t, x in qs.iterator(chunk_size=10_000):
+        user_ids.append(uid)
+        names.append(name)
+        codes.append(code)
+        flat.extend((e, m, t, x))
+
+    cells = _conf().get("CELLS") or auto_cells(len(names))
+    index = SimilarityIndex(cells=cells, capacity=max(1024, len(names)))
+    index.bulk_load(user_ids, names, np.asarray(flat, dtype=np.float64).reshape(-1, DIM), codes)
+    return index
+
+
+def get_index() -> SimilarityIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = build_from_db()
+    return _index
+
+
+def reset_index() -> None:
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def on_results(results: Iterable) -> None:
+    """
+    新しい最新結果をインデックスに反映する（まだ作っていなければ何もしない。初回 get_index で DB から作る）。
+    """
+    if _index is None:
+        return
+    results = list(results)
+    names: Dict[int, str] = {}
+    missing = set()
+    for r in results:
+        user = r._state.fields_cache.get("user")
+        if user is not None:
+            names[r.user_id] = user.username
+        else:
+            missing.add(r.user_id)
+    if missing:
+        names.update(User.objects.filter(pk__in=missing).values_list("pk", "username"))
+    updates = [
+        (r.user_id, names[r.user_id], tuple(getattr(r, f) for f in SCORE_FIELDS), r.type_code)
+        for r in results
+        if r.user_id in names
+    ]
+
+    conf = _conf()
+
+    def apply() -> None:
+        index = _index
+        if index is None:
+            return
+        for args in updates:
+            index.upsert(*args)
+        if not conf["CELLS"]:
+            index.maybe_recell(conf["REBUILD_GROWTH"])
+
+    transaction.on_commit(apply)
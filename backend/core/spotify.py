@@ -1,12 +1,18 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterable, List, Optional, Sequence, Tuple
+import asyncio
 import base64
-import requests
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
 
-SPOTIFY_ACCOUNTS_BASE = "https://accounts.spotify.com"
-SPOTIFY_API_BASE = "https://api.spotify.com/v1"
+from . import profiling
+from .http_client import get_async_client, get_client
+
+# ローカルのスタブサーバに向けられるよう環境変数で上書き可能
+SPOTIFY_ACCOUNTS_BASE = os.environ.get("SPOTIFY_ACCOUNTS_BASE", "https://accounts.spotify.com")
+SPOTIFY_API_BASE = os.environ.get("SPOTIFY_API_BASE", "https://api.spotify.com/v1")
 
 @dataclass
 class SpotifyTokens:
@@ -22,7 +28,7 @@ def exchange_code_for_tokens(client_id: str, client_secret: str, redirect_uri: s
     url = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
     headers = {"Authorization": _basic_auth_header(client_id, client_secret)}
     data = {"grant_type": "authorization_code", "code": code, "redirect_uri": redirect_uri}
-    r = requests.post(url, headers=headers, data=data, timeout=15)
+    r = get_client().post(url, headers=headers, data=data, timeout=15)
     r.raise_for_status()
     j = r.json()
 
@@ -39,7 +45,7 @@ def refresh_access_token(client_id: str, client_secret: str, refresh_token: str)
     url = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
     headers = {"Authorization": _basic_auth_header(client_id, client_secret)}
     data = {"grant_type": "refresh_token", "refresh_token": refresh_token}
-    r = requests.post(url, headers=headers, data=data, timeout=15)
+    r = get_client().post(url, headers=headers, data=data, timeout=15)
     r.raise_for_status()
     j = r.json()
 
@@ -55,9 +61,10 @@ def refresh_access_token(client_id: str, client_secret: str, refresh_token: str)
 def api_get(access_token: str, path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     url = f"{SPOTIFY_API_BASE}{path}"
     headers = {"Authorization": f"Bearer {access_token}"}
-    r = requests.get(url, headers=headers, params=params, timeout=15)
-    r.raise_for_status()
-    return r.json()
+    with profiling.timed("spotify"):
+        r = get_client().get(url, headers=headers, params=params, timeout=15)
+        r.raise_for_status()
+        return r.json()
 
 def get_me(access_token: str) -> Dict[str, Any]:
     return api_get(access_token, "/me")
@@ -69,3 +76,146 @@ def get_audio_features(access_token: str, track_ids: List[str]) -> Dict[str, Any
     ids = ",".join(track_ids)  # 最大100
     return api_get(access_token, "/audio-features", params={"ids": ids})
 
+
+# -------------------------
+# まとめて取得（100件制限の分割 + 並列）
+# -------------------------
+AUDIO_FEATURES_MAX_IDS = 100  # Spotify の /audio-features は1回100件まで
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+
+def _unique(ids: Iterable[str]) -> List[str]:
+    seen = set()
+    out = []
+    for i in ids:
+        if i and i not in seen:
+            seen.add(i)
+            out.append(i)
+    return out
+
+def _chunks(ids: List[str], size: int = AUDIO_FEATURES_MAX_IDS) -> List[List[str]]:
+    return [ids[i : i + size] for i in range(0, len(ids), size)]
+
+def _merge_top_items(pages: Sequence[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    # time_range の順に並べ、同じ曲は最初に出た方だけ残す
+    seen = set()
+    items = []
+    for page in pages:
+        for t in page:
+            tid = t.get("id")
+            if tid and tid in seen:
+                continue
+            if tid:
+                seen.add(tid)
+            items.append(t)
+    return items
+
+def fetch_top_tracks_and_features(
+    access_token: str,
+    time_ranges: Sequence[str] = TIME_RANGES,
+    limit: int = 50,
+    max_workers: int = 4,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    複数 time_range の top_tracks を並列に取り、返ってきた range から順に
+    まだ取っていない曲の audio_features を100件ずつ投げる（全 range を待たない）。
+    -> (重複を除いた items, audio_features)
+    """
+    pages: Dict[str, List[Dict[str, Any]]] = {}
+    get_top, get_feats = profiling.bind(get_top_tracks), profiling.bind(get_audio_features)
+    feats: List[Dict[str, Any]] = []
+    requested = set()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+        top_futs = {
+            ex.submit(get_top, access_token, limit, r): r for r in time_ranges
+        }
+        feat_futs = []
+        for fut in as_completed(top_futs):
+            items = fut.result().get("items", [])
+            pages[top_futs[fut]] = items
+            new_ids = [i for i in _unique(t.get("id") for t in items) if i not in requested]
+            requested.update(new_ids)
+            for c in _chunks(new_ids):
+                feat_futs.append(ex.submit(get_feats, access_token, c))
+        for fut in feat_futs:
+            feats.extend(fut.result().get("audio_features", []))
+
+    items = _merge_top_items([pages[r] for r in time_ranges])
+    return items, feats
+
+
+
+# -------------------------
+# async 版（ASGI の async view 用）
+# -------------------------
+async def arefresh_access_token(client_id: str, client_secret: str, refresh_token: str) -> SpotifyTokens:
+    url = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
+    headers = {"Authorization": _basic_auth_header(client_id, client_secret)}
+    data = {"grant_type": "refresh_token", "refresh_token": refresh_token}
+    r = await get_async_client().post(url, headers=headers, data=data, timeout=15)
+    r.raise_for_status()
+    j = r.json()
+
+    expires_in = int(j["expires_in"])
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in - 30)
+
+    return SpotifyTokens(
+        access_token=j["access_token"],
+        refresh_token=refresh_token,
+        expires_at=expires_at,
+    )
+
+@profiling.timed_async("spotify")
+async def aapi_get(access_token: str, path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    url = f"{SPOTIFY_API_BASE}{path}"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    r = await get_async_client().get(url, headers=headers, params=params, timeout=15)
+    r.raise_for_status()
+    return r.json()
+
+async def aget_top_tracks(access_token: str, limit: int = 50, time_range: str = "medium_term") -> Dict[str, Any]:
+    return await aapi_get(access_token, "/me/top/tracks", params={"limit": limit, "time_range": time_range})
+
+async def aget_audio_features(access_token: str, track_ids: List[str]) -> Dict[str, Any]:
+    ids = ",".join(track_ids)  # 最大100
+    return await aapi_get(access_token, "/audio-features", params={"ids": ids})
+
+async def afetch_top_tracks_and_features(
+    access_token: str,
+    time_ranges: Sequence[str] = TIME_RANGES,
+    limit: int = 50,
+    max_workers: int = 4,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    fetch_top_tracks_and_features の async 版。
+    """
+    sem = asyncio.Semaphore(max(1, max_workers))
+    requested = set()
+    feat_tasks = []
+
+    async def top(r: str) -> List[Dict[str, Any]]:
+        async with sem:
+            items = (await aget_top_tracks(access_token, limit=limit, time_range=r)).get("items", [])
+        new_ids = [i for i in _unique(t.get("id") for t in items) if i not in requested]
+        requested.update(new_ids)
+        for c in _chunks(new_ids):
+            feat_tasks.append(asyncio.ensure_future(feats_chunk(c)))
+        return items
+
+    async def feats_chunk(c: List[str]) -> List[Dict[str, Any]]:
+        async with sem:
+            return (await aget_audio_features(access_token, c)).get("audio_features", [])
+
+    top_tasks = [asyncio.ensure_future(top(r)) for r in time_ranges]
+    try:
+        pages = await asyncio.gather(*top_tasks)
+        feat_pages = await asyncio.gather(*feat_tasks)
+    except BaseException:
+        # どれかが失敗（またはキャンセル）したら残りを止め、終わるまで待ってから投げる
+        # （投げっぱなしのタスクを残さない）
+        for t in top_tasks + feat_tasks:
+            t.cancel()
+        await asyncio.gather(*top_tasks, *feat_tasks, return_exceptions=True)
+        raise
+    items = _merge_top_items(pages)
+    return items, [f for page in feat_pages for f in page]
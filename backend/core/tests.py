@@ -1,3 +1,1481 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+from array import array
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from config.db import database_from_env
+from config.sessions import SESSION_ENGINES, session_engine
+
+from . import compact, compression, diagnosis_inputs, fast_json, http_client, jobs, profiling, score_stats, search_cache, similar, spotify, track_catalog, track_views, type_catalog, views, warmup, write_behind
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .batch_scoring import TYPE_CODES, concat_inputs, pack_inputs, score_batch
+from .diagnosis import (
+    compute_scores,
+    compute_scores_from_selected_tracks,
+    describe_type,
+    pick_sample_tracks,
+    pick_sample_tracks_fake,
+    scores_to_type_code,
+)
+from .management.commands.bench_scoring import synth_user
+from .management.commands.rediagnose import _fake_ids
+from .models import CatalogTrack, DiagnosisInput, DiagnosisJob, DiagnosisResult, LatestDiagnosis, ScoreStats, SpotifyAccount
+from .search_cache import LocalTTLCache, SearchCache
+from .spotify import SpotifyTokens
+from .tokens import TokenManager
+from .upstream_stubs import StubServer
+
+
+def _result(user, i=0, type_code="AbcD"):
+    return DiagnosisResult(
+        user=user,
+        energy_score=0.1 * (i % 10),
+        mood_score=0.5,
+        texture_score=0.5,
+        explore_score=0.5,
+        type_code=type_code,
+        sample_track_ids=[],
+    )
+
+
+class ResultJsonLatestPointerTests(TestCase):
+    """
+    再診断を繰り返したユーザー（1万件以上）でも /api/result/<username> が1クエリで返ること。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="heavy", first_name="Heavy")
+        DiagnosisResult.objects.bulk_create([_result(cls.user, i) for i in range(10_000)], batch_size=1000)
+        cls.latest = DiagnosisResult.objects.create(
+            user=cls.user,
+            energy_score=0.9,
+            mood_score=0.9,
+            texture_score=0.1,
+            explore_score=0.1,
+            type_code="ABcd",
+            sample_track_ids=["x"],
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_pointer_tracks_latest_create(self):
+        self.assertEqual(LatestDiagnosis.objects.get(user=self.user).result_id, self.latest.pk)
+
+    def test_result_json_single_query(self):
+        with self.assertNumQueries(1):
+            r = self.client.get("/api/result/heavy")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["type_code"], "ABcd")
+
+        # 2回目以降はレンダリング済みキャッシュから返る
+        with self.assertNumQueries(0):
+            r = self.client.get("/api/result/heavy")
+        self.assertEqual(r.json()["type_code"], "ABcd")
+
+    def test_older_result_does_not_move_pointer_back(self):
+        older = DiagnosisResult.objects.bulk_create([_result(self.user, 3)])[0]
+        older.computed_at = self.latest.computed_at - timedelta(days=1)
+        LatestDiagnosis.point_to([older])
+        self.assertEqual(LatestDiagnosis.objects.get(user=self.user).result_id, self.latest.pk)
+
+    def test_delete_repoints_to_previous(self):
+        other = User.objects.create(username="single")
+        only = DiagnosisResult.objects.create(user=other, **{f: 0.5 for f in score_stats.SCORE_FIELDS}, type_code="abcd")
+        previous = self.user.diagnoses.exclude(pk=self.latest.pk).order_by("-computed_at", "-id").first()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                DiagnosisResult.objects.filter(pk__in=[self.latest.pk, only.pk]).delete()
+        self.assertEqual(LatestDiagnosis.objects.get(user=self.user).result_id, previous.pk)
+        self.assertFalse(LatestDiagnosis.objects.filter(user=other).exists())
+        self.assertEqual(self.client.get("/api/result/single").json()["error"], "no_result")
+
+    def test_history_query_uses_composite_index(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("EXPLAIN QUERY PLAN is sqlite-specific")
+        qs = self.user.diagnoses.order_by("-computed_at")[:1]
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as c:
+            c.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(row) for row in c.fetchall())
+        self.assertIn("diag_user_computed_idx", plan)
+
+    def test_not_found_and_no_result(self):
+        User.objects.create(username="fresh")
+        self.assertEqual(self.client.get("/api/result/nobody").json()["error"], "not_found")
+        self.assertEqual(self.client.get("/api/result/fresh").json()["error"], "no_result")
+
+
+class ResultJsonHttpCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="viral")
+        cls.first = DiagnosisResult.objects.create(
+            user=cls.user,
+            energy_score=0.2,
+            mood_score=0.2,
+            texture_score=0.2,
+            explore_score=0.2,
+            type_code="abcd",
+            sample_track_ids=[],
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_etag_304(self):
+        r = self.client.get("/api/result/viral")
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("public", r["Cache-Control"])
+        self.assertIn("Last-Modified", r)
+
+        with self.assertNumQueries(0):
+            r2 = self.client.get("/api/result/viral", HTTP_IF_NONE_MATCH=r["ETag"])
+        self.assertEqual(r2.status_code, 304)
+        self.assertEqual(r2.content, b"")
+
+    def test_new_result_invalidates(self):
+        r = self.client.get("/api/result/viral")
+        self.assertEqual(r.json()["type_code"], "abcd")
+
+        DiagnosisResult.objects.create(
+            user=self.user,
+            energy_score=0.9,
+            mood_score=0.9,
+            texture_score=0.9,
+            explore_score=0.9,
+            type_code="ABCD",
+            sample_track_ids=[],
+        )
+        r2 = self.client.get("/api/result/viral", HTTP_IF_NONE_MATCH=r["ETag"])
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.json()["type_code"], "ABCD")
+        self.assertNotEqual(r2["ETag"], r["ETag"])
+
+    def test_display_name_change_invalidates(self):
+        r = self.client.get("/api/result/viral")
+        self.assertEqual(r.json()["display_name"], "viral")
+
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=["last_login"])  # 表示名に関係ない保存では消さない
+        with self.assertNumQueries(0):
+            self.client.get("/api/result/viral")
+
+        self.user.first_name = "Viral"
+        self.user.save()
+        r2 = self.client.get("/api/result/viral", HTTP_IF_NONE_MATCH=r["ETag"])
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.json()["display_name"], "Viral")
+        self.assertNotEqual(r2["ETag"], r["ETag"])
+
+    def test_local_cache_timeout_is_short(self):
+        with mock.patch.object(cache, "set", wraps=cache.set) as cache_set:
+            self.client.get("/api/result/viral")
+        self.assertEqual(cache_set.call_args.args[2], 5)
+
+
+@override_settings(DIAGNOSIS_JOBS={"MODE": "db"})
+class DiagnosisJobTests(TestCase):
+    """
+    POST は job を積んで 202 を返すだけで、診断はワーカー（run_job）が進めること。
+    """
+
+    def setUp(self):
+        self.client.get("/api/dev/login")
+
+    def test_enqueue_then_run(self):
+        r = self.client.post("/api/diagnose/jobs")
+        self.assertEqual(r.status_code, 202)
+        url = r.json()["status_url"]
+        self.assertEqual(self.client.get(url).json()["status"], "queued")
+
+        job_id = r.json()["job_id"]
+        self.assertEqual(jobs.runnable_ids(10), [job_id])
+        jobs.run_job(job_id, max_attempts=3, retry_backoff=0)
+        # 2回目は claim できないので何もしない
+        self.assertIsNone(jobs.run_job(job_id, max_attempts=3, retry_backoff=0))
+
+        body = self.client.get(url).json()
+        self.assertEqual((body["status"], body["progress"], body["attempts"]), ("done", 100, 1))
+        self.assertEqual(body["result"]["type_code"], LatestDiagnosis.objects.get().result.type_code)
+
+        events = b"".join(self.client.get(f"{url}/events").streaming_content).decode()
+        self.assertTrue(events.startswith("event: done\n"))
+
+    def test_retry_then_fail(self):
+        job_id = self.client.post("/api/diagnose/jobs").json()["job_id"]
+        with mock.patch("core.views.run_diagnosis", side_effect=RuntimeError("upstream down")):
+            self.assertEqual(jobs.run_job(job_id, max_attempts=2, retry_backoff=0), 0)
+            self.assertEqual(DiagnosisJob.objects.get(pk=job_id).status, "queued")
+            self.assertIsNone(jobs.run_job(job_id, max_attempts=2, retry_backoff=0))
+
+        job = DiagnosisJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+        self.assertFalse(DiagnosisResult.objects.exists())
+        self.assertEqual(self.client.get(f"/api/diagnose/jobs/{job_id}").json()["error"], "RuntimeError: upstream down")
+
+    def test_failed_write_is_retried_once(self):
+        job_id = self.client.post("/api/diagnose/jobs").json()["job_id"]
+        with mock.patch.object(LatestDiagnosis, "point_to", side_effect=RuntimeError("db down")):
+            self.assertEqual(jobs.run_job(job_id, max_attempts=3, retry_backoff=0), 0)
+        self.assertFalse(DiagnosisResult.objects.exists())  # 結果の保存ごと取り消される
+
+        jobs.run_job(job_id, max_attempts=3, retry_backoff=0)
+        self.assertEqual(DiagnosisJob.objects.get(pk=job_id).status, "done")
+        self.assertEqual(DiagnosisResult.objects.count(), 1)
+
+    def test_requeued_run_does_not_duplicate_result(self):
+        from core.views import run_diagnosis
+
+        job_id = self.client.post("/api/diagnose/jobs").json()["job_id"]
+
+        calls = []
+
+        def slow(user, **kwargs):
+            # 1回目の実行中に止まったと見なされ、積み直された2回目が先に終わる
+            calls.append(user)
+            if len(calls) == 1:
+                jobs.requeue_stale(-1)
+                jobs.run_job(job_id, max_attempts=3, retry_backoff=0)
+            return run_diagnosis(user, **kwargs)
+
+        with mock.patch("core.views.run_diagnosis", side_effect=slow):
+            self.assertIsNone(jobs.run_job(job_id, max_attempts=3, retry_backoff=0))
+        job = DiagnosisJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), ("done", 2))
+        self.assertEqual(DiagnosisResult.objects.count(), 1)
+
+    def test_worker_requeues_stale_jobs_while_running(self):
+        from core.management.commands import run_diagnosis_jobs
+
+        user = User.objects.get(username="dev_user")
+        # 起動時にはまだ他のワーカーが動かしている（更新が新しい）
+        DiagnosisJob.objects.create(id="r" * 32, user=user, run_after=timezone.now(), status="running")
+        clock = [0.0]
+        ran = []
+
+        def monotonic():
+            if ran:
+                raise KeyboardInterrupt  # 拾い直して実行したら止める
+            return clock[0]
+
+        def sleep(seconds):
+            if clock[0] > 600:
+                self.fail("stale job was not requeued")
+            # そのワーカーが落ちて、claim から2時間経った
+            DiagnosisJob.objects.filter(pk="r" * 32).update(updated_at=timezone.now() - timedelta(hours=2))
+            clock[0] += 31
+
+        fake_time = mock.Mock(monotonic=monotonic, sleep=sleep)
+        with mock.patch.object(run_diagnosis_jobs, "time", fake_time), \
+                mock.patch.object(jobs, "run_job", side_effect=lambda job_id, *a: ran.append(job_id)):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command("run_diagnosis_jobs", stale_after=60, stdout=StringIO())
+        self.assertEqual(ran, ["r" * 32])
+        self.assertEqual(DiagnosisJob.objects.get(pk="r" * 32).status, "queued")
+
+    def test_sweep_resubmits_lost_jobs(self):
+        user = User.objects.get(username="dev_user")
+        past = timezone.now() - timedelta(hours=1)
+        DiagnosisJob.objects.create(id="q" * 32, user=user, run_after=past)
+        DiagnosisJob.objects.create(id="r" * 32, user=user, run_after=past, status="running")
+        DiagnosisJob.objects.filter(pk="r" * 32).update(updated_at=past)
+        DiagnosisJob.objects.create(id="d" * 32, user=user, run_after=past, status="done")
+
+        queue = jobs.LocalJobQueue(workers=1)
+        with mock.patch.object(queue, "submit") as submit:
+            self.assertEqual(queue.sweep(stale_after=60), 2)
+        self.assertEqual(sorted(c.args[0] for c in submit.call_args_list), ["q" * 32, "r" * 32])
+        self.assertEqual(DiagnosisJob.objects.get(pk="r" * 32).status, "queued")
+
+    def test_sweep_only_in_local_mode(self):
+        with mock.patch.object(jobs, "get_local_queue") as get_queue:
+            self.assertEqual(jobs.sweep(), 0)
+        get_queue.assert_not_called()
+
+    def test_other_users_job_is_not_found(self):
+        other = User.objects.create(username="other")
+        job = DiagnosisJob.objects.create(id="x" * 32, user=other, run_after="2000-01-01T00:00Z")
+        self.assertEqual(self.client.get(f"/api/diagnose/jobs/{job.pk}").status_code, 404)
+
+
+class ResultSimilarTests(TestCase):
+    """
+    /api/result/<username>/similar が近い順に返し、新しい診断がインデックスに反映されること。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f"u{i}") for i in range(5)]
+        for i, u in enumerate(cls.users):
+            r = _result(u)
+            r.energy_score = 0.1 * i
+            r.save()
+
+    def setUp(self):
+        similar.reset_index()
+        self.addCleanup(similar.reset_index)
+
+    def test_nearest_order_and_incremental_update(self):
+        body = self.client.get("/api/result/u0/similar?k=2").json()
+        self.assertEqual([n["username"] for n in body["similar"]], ["u1", "u2"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            r = _result(self.users[4])
+            r.energy_score = 0.01
+            r.save()
+        body = self.client.get("/api/result/u0/similar?k=2").json()
+        self.assertEqual([n["username"] for n in body["similar"]], ["u4", "u1"])
+
+    def test_matches_brute_force(self):
+        index = similar.get_index()
+        for u in self.users:
+            self.assertEqual(index.nearest(u.username, 3), index.brute_force(u.username, 3))
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get("/api/result/nobody/similar").json()["error"], "not_found")
+
+    def test_recells_as_users_are_added(self):
+        index = similar.get_index()
+        self.assertEqual((index.cells, index.celled_at), (1, 5))
+        rng = random.Random(0)
+        for i in range(2000):
+            index.upsert(1000 + i, f"n{i}", [rng.random() for _ in range(4)], "AbcD")
+            index.maybe_recell()
+        self.assertEqual(index.cells, similar.auto_cells(len(index)))
+        self.assertGreater(index.cells, 1)
+        for name in ("u0", "n0", "n1999"):
+            self.assertEqual(index.nearest(name, 10), index.brute_force(name, 10))
+
+    def test_warm_up_builds_index(self):
+        with mock.patch.object(track_catalog, "get_catalog"):
+            warmup.warm_up(background=False)
+        self.assertIsNotNone(similar._index)
+        self.assertEqual(len(similar._index), 5)
+
+
+class BatchScoringTests(SimpleTestCase):
+    """
+    NumPy 一括版（batch_scoring）が scalar 版（diagnosis）とビット単位で同じ結果を出すこと。
+    """
+
+    def test_matches_scalar(self):
+        rng = random.Random(0)
+        users = [synth_user(rng, n) for n in (50, 50, 3, 0, 50, 17) * 20]
+        res = score_batch(concat_inputs([pack_inputs(users[:60]), pack_inputs(users[60:])]))
+        dicts = res.score_dicts()
+        for u, (items, feats) in enumerate(users):
+            s = compute_scores(items, feats)
+            code = scores_to_type_code(s)
+            self.assertEqual(dicts[u], s)
+            self.assertEqual(res.type_codes[u], code)
+            self.assertEqual(res.sample_track_ids[u], pick_sample_tracks(items, feats, code))
+
+    def test_artist_ratio_is_per_50_tracks(self):
+        # 人気 100 の曲だけなら explore は 0.2 * artist_ratio。曲数では割らない（既存のスコアを変えない）
+        def user(n_artists):
+            items = [{"id": f"t{i}", "popularity": 100, "artists": [{"id": f"a{i}"}]} for i in range(n_artists)]
+            return items, [{"id": f"t{i}", "tempo": 120} for i in range(n_artists)]
+
+        for n_artists, ratio in ((3, 3 / 50), (50, 1.0), (150, 1.0)):
+            with self.subTest(n_artists=n_artists):
+                items, feats = user(n_artists)
+                self.assertAlmostEqual(compute_scores(items, feats)["explore_score"], 0.2 * ratio)
+                self.assertEqual(score_batch(pack_inputs([(items, feats)])).score_dicts()[0], compute_scores(items, feats))
+
+    def test_shared_thresholds(self):
+        self.assertEqual(scores_to_type_code({"energy_score": 0.55, "mood_score": 0.5199, "texture_score": 0.5}), "AbCd")
+        self.assertEqual(sorted(TYPE_CODES.tolist()), sorted(type_catalog.TYPE_CODES))
+
+
+class SpotifyFetchTests(SimpleTestCase):
+    """
+    複数 time_range の top_tracks を重複なしにまとめ、audio_features は100件ずつ1回だけ取る。
+    """
+
+    PAGES = {"short_term": range(0, 70), "medium_term": range(40, 110), "long_term": range(100, 180)}
+
+    def _top(self, access_token, limit=50, time_range="medium_term"):
+        return {"items": [{"id": f"t{i}", "artists": [{"id": f"a{i % 30}"}]} for i in self.PAGES[time_range]]}
+
+    def _feats(self, access_token, ids):
+        self.requested.append(list(ids))
+        return {"audio_features": [{"id": i} for i in ids]}
+
+    def _check(self, items, feats):
+        self.assertEqual([t["id"] for t in items], [f"t{i}" for i in range(180)])
+        self.assertTrue(all(len(c) <= spotify.AUDIO_FEATURES_MAX_IDS for c in self.requested))
+        flat = [i for c in self.requested for i in c]
+        self.assertEqual(sorted(flat), sorted(t["id"] for t in items))  # 重複なし・漏れなし
+        self.assertEqual(len(feats), 180)
+
+    def test_chunking_and_dedup(self):
+        self.requested = []
+        with mock.patch.object(spotify, "get_top_tracks", self._top), mock.patch.object(spotify, "get_audio_features", self._feats):
+            self._check(*spotify.fetch_top_tracks_and_features("tok", time_ranges=tuple(self.PAGES)))
+
+    def test_chunking_and_dedup_async(self):
+        self.requested = []
+
+        async def top(*args, **kwargs):
+            return self._top(*args, **kwargs)
+
+        async def feats(*args):
+            return self._feats(*args)
+
+        with mock.patch.object(spotify, "aget_top_tracks", top), mock.patch.object(spotify, "aget_audio_features", feats):
+            self._check(*async_to_sync(spotify.afetch_top_tracks_and_features)("tok", time_ranges=tuple(self.PAGES)))
+
+    def test_async_failure_leaves_no_tasks(self):
+        async def top(access_token, limit=50, time_range="medium_term"):
+            if time_range == "long_term":
+                await asyncio.sleep(0.01)
+                raise OSError("top failed")
+            return self._top(access_token, limit, time_range)
+
+        async def feats(access_token, ids):
+            await asyncio.sleep(1)
+            return {"audio_features": []}
+
+        async def run():
+            with self.assertRaises(OSError):
+                await spotify.afetch_top_tracks_and_features("tok", time_ranges=tuple(self.PAGES))
+            return [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and not t.done()]
+
+        with mock.patch.object(spotify, "aget_top_tracks", top), mock.patch.object(spotify, "aget_audio_features", feats):
+            self.assertEqual(async_to_sync(run)(), [])
+
+
+class DiagnosisInputTests(SimpleTestCase):
+    """
+    保存する診断入力は受け取った値そのまま（丸めない・捨てない）で、再計算すると元のスコアになる。
+    """
+
+    def test_selected_is_stored_unclamped(self):
+        tracks = [{"id": "x", "tempo": 1.7, "bright": -0.2, "electro": "0.3"}, {"id": "y", "tempo": None, "explore": "bad"}]
+        blob, ids, _ = diagnosis_inputs.pack_selected(tracks)
+        self.assertEqual(diagnosis_inputs.rows(DiagnosisInput.KIND_SELECTED, blob), [[1.7, -0.2, 0.3, 0.5], [0.0, 0.5, 0.5, 0.0]])
+        self.assertEqual(ids, ["x", "y"])
+        self.assertEqual(diagnosis_inputs.replay_selected(blob), compute_scores_from_selected_tracks(tracks))
+
+    def test_spotify_keeps_all_features_and_artist_ids(self):
+        items = [
+            {"id": "t1", "popularity": 80, "artists": [{"id": "a1"}, {"id": "a2"}]},
+            {"id": "t2", "popularity": 10, "artists": [{"id": "a1"}]},
+            {"id": "t3", "popularity": 50, "artists": []},  # feature なし -> 入れない
+        ]
+        feats = [
+            {"id": "t1", "energy": 0.9, "tempo": 250.0, "loudness": -5.5, "key": 7, "duration_ms": 201000},
+            {"id": "t2", "energy": 0.1, "tempo": 40.0, "mode": 1},
+        ]
+        blob, ids, meta = diagnosis_inputs.pack_spotify(items, feats)
+        self.assertEqual(ids, ["t1", "t2"])
+        self.assertEqual(meta["artist_ids"], [["a1", "a2"], ["a1"]])
+        rows = [dict(zip(meta["columns"], r)) for r in diagnosis_inputs.rows(DiagnosisInput.KIND_SPOTIFY, blob, meta)]
+        self.assertEqual((rows[0]["tempo"], rows[0]["loudness"], rows[0]["key"], rows[0]["duration_ms"]), (250.0, -5.5, 7.0, 201000.0))
+        self.assertEqual((rows[1]["tempo"], rows[1]["mode"], rows[1]["popularity"]), (40.0, 1.0, 10.0))
+
+    def test_spotify_replay_matches_new_and_legacy_rows(self):
+        rng = random.Random(1)
+        users = [synth_user(rng, n) for n in (50, 7, 0)]
+        packed = [diagnosis_inputs.pack_spotify(items, feats) for items, feats in users]
+        # 古い形式: 先頭7列だけ + ユニークアーティスト数
+        legacy = []
+        for blob, ids, meta in packed:
+            rows = diagnosis_inputs.rows(DiagnosisInput.KIND_SPOTIFY, blob, meta)
+            values = [v for r in rows for v in r[:7]]
+            legacy.append((array("d", values).tobytes(), ids, {"unique_artists": diagnosis_inputs.unique_artists(meta)}))
+        expected = [compute_scores(items, feats) for items, feats in users]
+        for inputs in (packed, legacy):
+            self.assertEqual(score_batch(diagnosis_inputs.spotify_batch(inputs)).score_dicts(), expected)
+
+
+class ScoreStatsTests(TestCase):
+    """
+    percentile / タイプ分布がユーザーごとの最新結果で数えられ、再診断で古い結果が引かれること。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(4):
+            r = _result(User.objects.create(username=f"s{i}"), i * 2, type_code="AbcD" if i else "abcd")
+            r.save()
+
+    def setUp(self):
+        score_stats.reset_store()
+        self.addCleanup(score_stats.reset_store)
+
+    def test_percentiles_and_rediagnose(self):
+        body = self.client.get("/api/result/s3/percentiles").json()
+        self.assertEqual(body["total_users"], 4)
+        self.assertEqual(body["percentiles"]["energy"], 87.5)  # 3人より上 + 自分の半分
+        self.assertEqual(body["percentiles"]["mood"], 50.0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            _result(User.objects.get(username="s0"), 9, type_code="AbcD").save()
+        score_stats.get_store().sync()
+
+        body = self.client.get("/api/result/s3/percentiles").json()
+        self.assertEqual((body["total_users"], body["percentiles"]["energy"]), (4, 62.5))
+        types = {t["type_code"]: t["count"] for t in self.client.get("/api/stats/types").json()["types"]}
+        self.assertEqual((types["AbcD"], types["abcd"]), (4, 0))
+
+        # 保存された分布は作り直したものと一致する
+        saved = ScoreStats.objects.get().counts
+        self.assertEqual(bytes(saved), score_stats.build_from_db(1000).to_bytes())
+
+    def test_repeated_and_unknown_type_code(self):
+        s1 = User.objects.get(username="s1")
+        with self.captureOnCommitCallbacks(execute=True):
+            r = _result(s1, 5, type_code="??")
+            r.save()
+            LatestDiagnosis.point_to([r])  # 同じ結果をもう一度指しても二重に足し引きしない
+            old = DiagnosisResult.objects.bulk_create([_result(s1, 1)])[0]
+            old.computed_at = r.computed_at - timedelta(days=1)
+            LatestDiagnosis.point_to([old])  # 古い結果は反映しない
+        score_stats.get_store().sync()
+        self.assertEqual(bytes(ScoreStats.objects.get().counts), score_stats.build_from_db(1000).to_bytes())
+        body = self.client.get("/api/result/s1/percentiles").json()
+        self.assertEqual((body["total_users"], body["type_share"]), (4, 0.0))
+
+
+class RediagnoseTests(TestCase):
+    """
+    manage.py rediagnose: user_id の keyset で全員を回り、update は同じ行を、append は新しい行を最新にする。
+    """
+
+    LEGACY_IDS = ["Daydream Pop", "Stereo Breeze", "Afterglow"]  # カタログより前のダミー代表曲
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f"rd{i}") for i in range(5)]
+        for u in cls.users:
+            # 今のしきい値だと ABCD（保存は古いしきい値での abcd）
+            DiagnosisResult.objects.create(
+                user=u, **{f: 0.9 for f in score_stats.SCORE_FIELDS}, type_code="abcd", sample_track_ids=cls.LEGACY_IDS
+            )
+
+    def setUp(self):
+        cache.clear()
+        score_stats.reset_store()
+        similar.reset_index()
+        self.addCleanup(score_stats.reset_store)
+        self.addCleanup(similar.reset_index)
+
+    def _run(self, **opts):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("rediagnose", workers=0, chunk_size=2, stdout=out, **opts)
+        return out.getvalue()
+
+    def test_update_in_place(self):
+        before = self.client.get("/api/result/rd0")
+        similar.get_index()
+        score_stats.get_store().sync()
+
+        out = self._run(mode="update")
+        self.assertEqual(out.count("user_id<="), 3)  # 5人を2人ずつ
+        self.assertEqual(DiagnosisResult.objects.count(), 5)
+        latest = LatestDiagnosis.objects.select_related("result").get(user=self.users[0]).result
+        self.assertEqual((latest.type_code, latest.sample_track_ids), ("ABCD", _fake_ids("ABCD")))
+
+        after = self.client.get("/api/result/rd0", HTTP_IF_NONE_MATCH=before["ETag"])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(after.json()["type_code"], "ABCD")
+        self.assertEqual(similar.get_index().nearest("rd0", k=1)[0].type_code, "ABCD")
+        score_stats.get_store().sync()
+        self.assertEqual(bytes(ScoreStats.objects.get().counts), score_stats.build_from_db(1000).to_bytes())
+
+        self.assertIn("0 changed", self._run(mode="update", reset=True).splitlines()[-2])
+
+    def test_append_moves_pointer(self):
+        self._run(mode="append")
+        self.assertEqual(DiagnosisResult.objects.count(), 10)
+        for u in self.users:
+            self.assertEqual(u.latest_diagnosis.result.type_code, "ABCD")
+
+    def test_checkpoint_resume(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "ckpt.json")
+            with open(path, "w") as f:
+                json.dump({"last_user_id": self.users[2].pk, "rows": 3, "changed": 3}, f)
+            out = self._run(mode="update", checkpoint=path)
+            with open(path) as f:
+                state = json.load(f)
+        self.assertIn(f"resume after user_id={self.users[2].pk}", out)
+        self.assertEqual(state, {"last_user_id": self.users[4].pk, "rows": 5, "changed": 5})
+        codes = dict(LatestDiagnosis.objects.values_list("user__username", "result__type_code"))
+        self.assertEqual([codes[u.username] for u in self.users], ["abcd"] * 3 + ["ABCD"] * 2)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    """
+    Server-Timing ヘッダ、/api/metrics（ローカルのみ）、サンプリングした cProfile の書き出し。
+    """
+
+    def setUp(self):
+        _result(User.objects.create(username="p1"), 5).save()
+        profiling.get_metrics().reset()
+
+    def test_server_timing_and_metrics(self):
+        cache.clear()
+        r = self.client.get("/api/result/p1")
+        timing = r["Server-Timing"]
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* calls"')
+        self.assertIn("total;dur=", timing)
+
+        body = self.client.get("/api/metrics").content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/api/result/<str:username>"} 1', body)
+        self.assertIn('component="db"', body)
+
+        remote = self.client.get("/api/metrics", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(remote.status_code, 403)
+
+    def test_itunes_timing_only_for_upstream_calls(self):
+        stub = StubServer().start()
+        self.addCleanup(stub.stop)
+        track_catalog.reset_catalog()
+        self.addCleanup(track_catalog.reset_catalog)
+        q = f"timing {time.time()}"
+        with mock.patch.object(track_views, "ITUNES_SEARCH_URL", f"{stub.base_url}/search"):
+            first = self.client.get("/api/tracks/search", {"q": q})
+            again = self.client.get("/api/tracks/search", {"q": q})  # キャッシュかローカルカタログ
+        self.assertEqual(stub.requests, 1)
+        self.assertIn("itunes;dur=", first["Server-Timing"])
+        self.assertNotIn("itunes", again["Server-Timing"])
+
+    def test_sampled_profile_is_dumped(self):
+        with tempfile.TemporaryDirectory() as d:
+            with override_settings(PROFILING={"SAMPLE_RATE": 1.0, "PROFILE_DIR": d}):
+                Client().get("/api/result/p1")
+            files = os.listdir(d)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(".prof") and "api_result_str_username" in files[0])
+
+
+class DatabaseFromEnvTests(SimpleTestCase):
+    """
+    DB_ENGINE / SQLITE_PROFILE / POSTGRES_POOL から DATABASES["default"] を組み立てる。
+    """
+
+    def test_sqlite_profiles(self):
+        tuned = database_from_env(Path("/tmp"), {})
+        self.assertEqual(tuned["OPTIONS"]["transaction_mode"], "IMMEDIATE")
+        self.assertIn("PRAGMA journal_mode=WAL", tuned["OPTIONS"]["init_command"].split(";"))
+        self.assertEqual(database_from_env(Path("/tmp"), {"SQLITE_PROFILE": "default"})["OPTIONS"], {})
+
+    def test_postgres_pool_or_persistent(self):
+        pooled = database_from_env(Path("/tmp"), {"DB_ENGINE": "postgres", "POSTGRES_POOL": "1"})
+        self.assertEqual(pooled["OPTIONS"]["pool"]["max_size"], 10)
+        self.assertNotIn("CONN_MAX_AGE", pooled)
+        persistent = database_from_env(Path("/tmp"), {"DB_ENGINE": "postgres"})
+        self.assertEqual((persistent["CONN_MAX_AGE"], persistent["CONN_HEALTH_CHECKS"]), (60, True))
+
+
+class WriteBehindTests(TestCase):
+    """
+    write-behind: 書く前の結果も結果ページから読め、flush で bulk_create + 最新ポインタが付くこと。
+    """
+
+    def setUp(self):
+        self.buffer = write_behind.WriteBehindBuffer(max_rows=10, max_delay_ms=60_000, start=False)
+        write_behind.set_buffer(self.buffer)
+        self.addCleanup(write_behind.set_buffer, None)
+        self.addCleanup(score_stats.reset_store)
+        cache.clear()
+
+    def test_read_your_writes_then_flush(self):
+        users = [User.objects.create(username=f"w{i}") for i in range(3)]
+        for i, u in enumerate(users):
+            write_behind.save_result(_result(u, i))
+        write_behind.save_result(_result(users[0], 9))  # 同じユーザーの2回目は新しい方が見える
+        self.assertEqual(DiagnosisResult.objects.count(), 0)
+
+        r = self.client.get("/api/result/w0")
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r["ETag"].startswith('"p-'))
+        self.assertAlmostEqual(r.json()["scores"]["energy"], 0.9)
+
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(6):
+            # savepoint / bulk_create / 今のポインタ（ロック） / 無い分の insert / 読み直し / release
+            self.assertEqual(self.buffer.flush(), 4)
+        self.assertEqual(DiagnosisResult.objects.count(), 4)
+        self.assertEqual(self.buffer.pending_for("w0"), None)
+
+        r = self.client.get("/api/result/w0")
+        self.assertTrue(r["ETag"].startswith('"r'))
+        self.assertAlmostEqual(r.json()["scores"]["energy"], 0.9)
+
+        stats = self.client.get("/api/diagnose/write_behind/stats").json()
+        self.assertEqual((stats["flushes"], stats["rows_flushed"], stats["pending"]), (1, 4, 0))
+
+    def test_falls_back_to_sync_save_when_full(self):
+        self.buffer.max_pending = 1
+        u = User.objects.create(username="full")
+        write_behind.save_result(_result(u, 1))
+        write_behind.save_result(_result(u, 2))
+        self.assertEqual(DiagnosisResult.objects.count(), 1)
+        self.assertEqual(self.buffer.stats()["sync_fallbacks"], 1)
+
+    def test_bad_row_is_dropped_not_retried_forever(self):
+        users = [User.objects.create(username=f"b{i}") for i in range(3)]
+        for i, u in enumerate(users):
+            write_behind.save_result(_result(u, i, type_code=None if i == 1 else "AbcD"))  # b1 は NOT NULL 違反
+
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("core.write_behind", "ERROR"):
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(sorted(DiagnosisResult.objects.values_list("user__username", flat=True)), ["b0", "b2"])
+        stats = self.buffer.stats()
+        self.assertEqual((stats["pending"], stats["rows_dropped"], stats["flush_errors"]), (0, 1, 1))
+        self.assertEqual(stats["dead_letters"][0]["username"], "b1")
+        self.assertIsNone(self.buffer.pending_for("b1"))
+
+    def test_transient_failure_requeues(self):
+        u = User.objects.create(username="flaky")
+        write_behind.save_result(_result(u, 1))
+        with mock.patch.object(DiagnosisResult.objects, "bulk_create", side_effect=OperationalError("down")):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.stats()["rows_dropped"], 0)
+
+
+class LoginWriteTests(TestCase):
+    """
+    fake_login / spotify_callback は変わった行しか書かない（既存ユーザーのパスワードや他のセッションを壊さない）。
+    """
+
+    def _writes(self, queries):
+        return [q["sql"] for q in queries if q["sql"].split()[0] in ("INSERT", "UPDATE", "DELETE")]
+
+    def test_fake_login_is_idempotent(self):
+        first = Client()
+        first.get("/api/dev/login")
+        password = User.objects.get(username="dev_user").password
+
+        with self.assertNumQueries(2):  # session + user の読み取りだけ
+            self.assertTrue(first.get("/api/dev/login").json()["ok"])
+
+        with CaptureQueriesContext(connection) as ctx:
+            Client().get("/api/dev/login")
+        self.assertFalse([w for w in self._writes(ctx.captured_queries) if '"password"' in w])
+        self.assertEqual(User.objects.get(username="dev_user").password, password)
+        # 別クライアントのログインで最初のセッションが無効にならない
+        with self.assertNumQueries(2):
+            first.get("/api/dev/login")
+
+    def test_spotify_callback_upserts_account_in_one_statement(self):
+        def callback(user, token, refresh=""):
+            request = RequestFactory().get("/api/spotify/callback", {"code": "c", "state": "s"})
+            request.session = SessionStore()
+            request.session["spotify_oauth_state"] = "s"
+            request.user = user
+            tokens = SpotifyTokens(token, refresh, timezone.now() + timedelta(hours=1))
+            with mock.patch.object(views, "exchange_code_for_tokens", return_value=tokens), mock.patch.object(
+                views, "get_me", return_value={"id": "abc", "display_name": "ABC"}
+            ):
+                return views.spotify_callback(request)
+
+        callback(mock.Mock(is_authenticated=False), "t1", "r1")
+        user = User.objects.get(username="sp_abc")
+        self.assertFalse(user.has_usable_password())
+
+        # 2回目: ユーザーの SELECT と アカウントの upsert だけ
+        with self.assertNumQueries(2):
+            callback(user, "t2")
+        acc = SpotifyAccount.objects.get(spotify_user_id="abc")
+        self.assertEqual((acc.access_token, acc.refresh_token, acc.user_id), ("t2", "r1", user.pk))
+
+
+class TokenManagerTests(TransactionTestCase):
+    """
+    access token の更新はユーザーごとに1回だけで、他のワーカーが更新した行があればそれを使う。
+    （別スレッドから DB を読むので TransactionTestCase）
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="tok")
+        self.acc = SpotifyAccount.objects.create(
+            user=self.user, spotify_user_id="tok", access_token="old", refresh_token="r0",
+            token_expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        self.manager = TokenManager(refresh_ahead=300)
+        self.addCleanup(self.manager._executor.shutdown)
+
+    def _refresh(self, token, refresh="r1", delay=0.0):
+        def refresh_access_token(client_id, client_secret, refresh_token):
+            self.sent.append(refresh_token)
+            time.sleep(delay)
+            return SpotifyTokens(token, refresh, timezone.now() + timedelta(hours=1))
+
+        self.sent = []
+        return mock.patch("core.tokens.refresh_access_token", side_effect=refresh_access_token)
+
+    def test_single_refresh_under_concurrency(self):
+        self.manager.put(self.acc)
+        results = []
+
+        def run():
+            try:
+                results.append(self.manager.access_token(self.user.pk))
+            finally:
+                connections.close_all()
+
+        with self._refresh("new", delay=0.1):
+            threads = [threading.Thread(target=run) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(5)
+        self.assertEqual(self.sent, ["r0"])
+        self.assertEqual(results, ["new"] * 8)
+        acc = SpotifyAccount.objects.get(pk=self.acc.pk)
+        self.assertEqual((acc.access_token, acc.refresh_token), ("new", "r1"))
+
+    def test_uses_row_refreshed_by_another_worker(self):
+        self.manager.put(self.acc)  # このプロセスのキャッシュは期限切れのまま
+        SpotifyAccount.objects.filter(pk=self.acc.pk).update(
+            access_token="other", refresh_token="r2", token_expires_at=timezone.now() + timedelta(hours=1)
+        )
+        with self._refresh("new"):
+            self.assertEqual(self.manager.access_token(self.user.pk), "other")
+        self.assertEqual(self.sent, [])
+
+    def test_refreshes_with_rotated_refresh_token(self):
+        self.manager.put(self.acc)
+        # 他のワーカーが r0 を使って更新し、その access token も期限が来た
+        SpotifyAccount.objects.filter(pk=self.acc.pk).update(refresh_token="r2")
+        with self._refresh("new"):
+            self.assertEqual(self.manager.access_token(self.user.pk), "new")
+        self.assertEqual(self.sent, ["r2"])
+
+    def test_refresh_outside_transaction(self):
+        self.manager.put(self.acc)
+        in_atomic = []
+
+        def refresh_access_token(client_id, client_secret, refresh_token):
+            in_atomic.append(connection.in_atomic_block)
+            return SpotifyTokens("new", "r1", timezone.now() + timedelta(hours=1))
+
+        with mock.patch("core.tokens.refresh_access_token", side_effect=refresh_access_token):
+            self.assertEqual(self.manager.access_token(self.user.pk), "new")
+        self.assertEqual(in_atomic, [False])
+
+    def test_other_worker_wins_while_refreshing(self):
+        self.manager.put(self.acc)
+
+        def refresh_access_token(client_id, client_secret, refresh_token):
+            # 問い合わせている間に他のワーカーが r0 で更新して書いた
+            SpotifyAccount.objects.filter(pk=self.acc.pk).update(
+                access_token="other", refresh_token="r2", token_expires_at=timezone.now() + timedelta(hours=1)
+            )
+            return SpotifyTokens("new", "r1", timezone.now() + timedelta(hours=1))
+
+        with mock.patch("core.tokens.refresh_access_token", side_effect=refresh_access_token):
+            self.assertEqual(self.manager.access_token(self.user.pk), "other")
+        acc = SpotifyAccount.objects.get(pk=self.acc.pk)
+        self.assertEqual((acc.access_token, acc.refresh_token), ("other", "r2"))
+
+    def test_expiry_skew(self):
+        soon = timezone.now() + timedelta(seconds=60)  # refresh_ahead（300秒）の内側
+        SpotifyAccount.objects.filter(pk=self.acc.pk).update(token_expires_at=soon)
+        with self._refresh("new"):
+            # 期限前なので今のトークンを返し、更新はバックグラウンドで
+            self.assertEqual(self.manager.access_token(self.user.pk), "old")
+            for _ in range(500):
+                if not self.manager._scheduled:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(self.sent, ["r0"])
+        self.assertEqual(self.manager.access_token(self.user.pk), "new")
+
+    def test_invalidate(self):
+        SpotifyAccount.objects.filter(pk=self.acc.pk).update(token_expires_at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.manager.access_token(self.user.pk), "old")
+        SpotifyAccount.objects.filter(pk=self.acc.pk).update(access_token="relinked")
+        self.assertEqual(self.manager.access_token(self.user.pk), "old")  # キャッシュから
+        self.manager.invalidate(self.user.pk)
+        self.assertEqual(self.manager.access_token(self.user.pk), "relinked")
+        self.assertIsNone(self.manager.access_token(self.user.pk + 1))
+
+
+class SessionModeTests(TestCase):
+    """
+    SESSION_MODE: cache / signed_cookies ならログイン済みリクエストで django_session に触らない。
+    """
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            session_engine("redis")
+
+    def test_no_session_queries(self):
+        for mode in ("cached_db", "cache", "signed_cookies"):
+            with self.subTest(mode=mode), override_settings(SESSION_ENGINE=SESSION_ENGINES[mode]):
+                client = Client()
+                client.get("/api/dev/login")
+                with CaptureQueriesContext(connection) as ctx:
+                    self.assertTrue(client.get("/api/dev/login").json()["ok"])
+                self.assertEqual([q["sql"] for q in ctx.captured_queries if "django_session" in q["sql"]], [])
+                self.assertEqual(len(ctx.captured_queries), 1)  # user だけ
+
+
+class TrackCatalogTests(TestCase):
+    """
+    /api/tracks/search はローカルの曲カタログで足りれば upstream に行かない。
+    """
+
+    def setUp(self):
+        track_catalog.reset_catalog()
+        self.addCleanup(track_catalog.reset_catalog)
+
+    def _items(self, n, title="ヨルノウタ"):
+        return [{"id": str(i), "title": f"{title} {i}", "artist": "Night Drive", "artwork": "", "preview_url": "", "external_url": ""} for i in range(n)]
+
+    def test_normalize_width_and_kana(self):
+        self.assertEqual(track_catalog.normalize("ﾖﾙﾉｳﾀ"), track_catalog.normalize("よるのうた"))
+        self.assertEqual(track_catalog.normalize("ＮＩＧＨＴ-Drive!"), "night drive")
+
+    def test_ranking(self):
+        catalog = track_catalog.TrackCatalog()
+        catalog.add(
+            [
+                {"id": "1", "title": "Blue Night", "artist": "x"},
+                {"id": "2", "title": "Nightfall", "artist": "y"},
+                {"id": "3", "title": "Moon", "artist": "Nightingale"},
+                {"id": "4", "title": "Midnight", "artist": "z"},
+                {"id": "2", "title": "Nightfall (Remix)", "artist": "y"},  # 同じ id は上書き
+            ]
+        )
+        self.assertEqual([it["id"] for it in catalog.search("ＮＩＧＨＴ")], ["2", "3", "1", "4"])
+        self.assertEqual([it["id"] for it in catalog.search("night remix")], ["2"])
+        self.assertEqual(len(catalog), 4)
+
+    def test_local_first_then_upstream(self):
+        track_catalog.remember(self._items(12))
+        self.assertEqual(CatalogTrack.objects.count(), 12)
+        with mock.patch.object(track_views, "_itunes_search") as upstream:
+            items = Client().get("/api/tracks/search", {"q": "ﾖﾙﾉ"}).json()["items"]
+            upstream.assert_not_called()
+        self.assertEqual(len(items), 12)
+
+        with mock.patch.object(track_views, "_itunes_search", return_value=[]) as upstream:
+            Client().get("/api/tracks/search", {"q": "unknown"})
+            upstream.assert_called_once()
+
+    def test_reload_reads_tracks_added_by_other_workers(self):
+        self.assertEqual(len(track_catalog.get_catalog()), 0)
+        # 他のワーカーが書いた行（このプロセスの索引には入っていない）
+        CatalogTrack.objects.bulk_create(
+            [CatalogTrack(track_id=it["id"], title=it["title"], artist=it["artist"]) for it in self._items(3)]
+        )
+        self.assertEqual(len(track_catalog.get_catalog()), 0)
+        with override_settings(TRACK_CATALOG={"RELOAD_SEC": 0}):
+            self.assertEqual(len(track_catalog.get_catalog()), 3)
+            CatalogTrack.objects.filter(track_id="1").update(title="Renamed", updated_at=timezone.now())
+            self.assertEqual([it["id"] for it in track_catalog.get_catalog().search("renamed")], ["1"])
+
+    def test_warm_up_builds_catalog(self):
+        track_catalog.remember(self._items(2))
+        track_catalog.reset_catalog()
+        warmup.warm_up(background=False)
+        self.assertIsNotNone(track_catalog._catalog)
+        self.assertEqual(len(track_catalog._catalog), 2)
+
+    def test_long_fields_and_failures_are_logged(self):
+        long = self._items(1)[0] | {"title": "あ" * 500, "artwork": "https://x/" + "a" * 500}
+        track_catalog.remember([long])
+        row = CatalogTrack.objects.get()
+        self.assertEqual((len(row.title), len(row.artwork)), (500, 300))
+        with mock.patch.object(track_catalog, "remember", side_effect=OperationalError("down")):
+            with self.assertLogs("core.track_views", "ERROR"):
+                track_views._remember(self._items(1))
+
+
+    def test_catalog_write_is_outside_the_timed_fetch(self):
+        cache = SearchCache(LocalTTLCache())
+        breaker = mock.Mock(allow=mock.Mock(return_value=True))
+        seen = []
+
+        def remember(items):
+            # single-flight は終わっていて、ブレーカーにも記録済み
+            seen.append((len(items), dict(cache._flights), breaker.record.call_count))
+
+        with mock.patch.object(track_views, "_itunes_fetch", return_value=self._items(2)), \
+                mock.patch.object(track_views, "get_search_cache", return_value=cache), \
+                mock.patch.object(track_views, "get_breaker", return_value=breaker), \
+                mock.patch.object(track_catalog, "remember", side_effect=remember):
+            track_views._itunes_search("outside-timed")
+            track_views._itunes_search("outside-timed")  # キャッシュから: 書かない
+        self.assertEqual(seen, [(2, {}, 1)])
+
+class HttpClientTests(SimpleTestCase):
+    """
+    スタブサーバ相手に、リトライ（冪等なメソッドだけ）・Retry-After の上限・keep-alive を確かめる。
+    """
+
+    def setUp(self):
+        self.stub = StubServer(error_rate=1.0).start()
+        self.addCleanup(self.stub.stop)
+
+    def _client(self, **kwargs):
+        client = http_client.HttpClient(retries=2, backoff_factor=0, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_get_is_retried(self):
+        r = self._client().get(f"{self.stub.base_url}/search?term=a")
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.stub.requests, 3)
+
+    def test_post_is_not_replayed(self):
+        # 一度きりの認可コードを2回送らない
+        r = self._client().post(f"{self.stub.base_url}/api/token", data={"grant_type": "authorization_code", "code": "c"})
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_retry_after_is_capped(self):
+        self.stub.retry_after = "3600"
+        t0 = time.perf_counter()
+        self._client(max_retry_after=0.05).get(f"{self.stub.base_url}/search?term=a")
+        self.assertLess(time.perf_counter() - t0, 5)
+        self.assertEqual(self.stub.requests, 3)
+
+    def test_backoff(self):
+        client = http_client.HttpClient(retries=2, backoff_factor=0.1)
+        self.addCleanup(client.close)
+        t0 = time.perf_counter()
+        client.get(f"{self.stub.base_url}/search?term=a")
+        # urllib3 は2回目のリトライから待つ: 0.1 * 2 = 0.2 秒
+        self.assertGreaterEqual(time.perf_counter() - t0, 0.2)
+        self.assertEqual(self.stub.requests, 3)
+
+    def test_connections_are_reused(self):
+        self.stub.error_rate = 0.0
+        client = self._client()
+        for i in range(5):
+            self.assertEqual(client.get(f"{self.stub.base_url}/search?term={i}").status_code, 200)
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_async_retries(self):
+        self.stub.retry_after = "3600"
+        client = http_client.AsyncHttpClient(retries=2, backoff_factor=0, max_retry_after=0.01)
+
+        async def run():
+            try:
+                get = await client.get(f"{self.stub.base_url}/search?term=a")
+                post = await client.post(f"{self.stub.base_url}/api/token", data={"grant_type": "refresh_token"})
+                return get.status_code, post.status_code
+            finally:
+                await client.aclose()
+
+        self.assertEqual(async_to_sync(run)(), (503, 503))
+        self.assertEqual(self.stub.requests, 3 + 1)
+
+
+class AsyncHttpClientTests(TestCase):
+    """
+    async view の upstream 呼び出し: クライアントはループごとに1つで、ループが終わると閉じる。
+    """
+
+    def test_one_client_per_loop_closed_with_loop(self):
+        async def run():
+            return http_client.get_async_client(), http_client.get_async_client()
+
+        a, b = async_to_sync(run)()
+        self.assertIs(a, b)
+        self.assertTrue(a.client.is_closed)
+        c, _ = async_to_sync(run)()
+        self.assertIsNot(c, a)
+        self.assertTrue(c.client.is_closed)
+
+    def test_async_search_against_stub(self):
+        stub = StubServer().start()
+        self.addCleanup(stub.stop)
+        track_catalog.reset_catalog()
+        self.addCleanup(track_catalog.reset_catalog)
+
+        with mock.patch.object(track_views, "ITUNES_SEARCH_URL", f"{stub.base_url}/search"):
+            r = Client().get("/api/async/tracks/search", {"q": f"async stub {time.time()}"})
+        self.assertEqual(r.status_code, 200)
+        items = r.json()["items"]
+        self.assertEqual(len(items), 20)
+        self.assertEqual(set(items[0]), set(compact.TRACK_FIELDS))
+        self.assertEqual(stub.requests, 1)
+        self.assertEqual(CatalogTrack.objects.count(), 20)
+
+
+class SearchCacheTests(SimpleTestCase):
+    """
+    検索結果キャッシュの TTL・LRU と、同じキーの同時 miss を1回の upstream 呼び出しにまとめること。
+    """
+
+    def test_ttl_expiry(self):
+        backend = LocalTTLCache()
+        backend.set("a", 1, ttl=60)
+        backend.set("b", 2, ttl=0)
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIs(backend.get("b"), search_cache._MISSING)
+        self.assertEqual(len(backend), 1)  # 期限切れは読んだときに消える
+
+        cache = SearchCache(backend, ttl=60)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return ["v"]
+
+        cache.get_or_fetch("k", fetch)
+        cache.get_or_fetch("k", fetch)
+        self.assertEqual(len(calls), 1)
+        with mock.patch.object(search_cache.time, "time", return_value=time.time() + 61):
+            cache.get_or_fetch("k", fetch)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_lru_eviction(self):
+        backend = LocalTTLCache(max_entries=2)
+        backend.set("a", 1, ttl=60)
+        backend.set("b", 2, ttl=60)
+        backend.get("a")  # a を新しくする -> 次に追い出されるのは b
+        backend.set("c", 3, ttl=60)
+        self.assertIs(backend.get("b"), search_cache._MISSING)
+        self.assertEqual((backend.get("a"), backend.get("c")), (1, 3))
+        self.assertEqual(backend.evictions, 1)
+
+    def test_single_flight(self):
+        cache = SearchCache(LocalTTLCache(), ttl=60)
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+            return ["v"]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch("k", slow))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for _ in range(200):
+            if cache.stats()["coalesced"] == 7:
+                break
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["v"]] * 8)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["coalesced"], 7)
+
+    def test_single_flight_async(self):
+        cache = SearchCache(LocalTTLCache(), ttl=60)
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return ["v"]
+
+        async def many():
+            return await asyncio.gather(*(cache.aget_or_fetch("k", slow) for _ in range(8)))
+
+        self.assertEqual(async_to_sync(many)(), [["v"]] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()["coalesced"], 7)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    """
+    upstream が続けて失敗したら呼ばずに古いキャッシュを返し、再検証はバックグラウンドで1回だけ。
+    """
+
+    def test_transitions(self):
+        b = CircuitBreaker("t", failure_threshold=2, slow_call_sec=1.0, open_sec=0)
+        b.record(False)
+        self.assertTrue(b.allow())
+        b.record(True, 5.0)  # 成功でも遅ければ失敗扱い
+        self.assertEqual(b.state, "open")
+        self.assertFalse(b.allow())
+        self.assertTrue(b.try_start_probe())
+        self.assertFalse(b.try_start_probe())
+        b.record(True, 0.1)
+        self.assertEqual(b.state, "closed")
+        self.assertEqual(b.stats()["transitions"], {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1})
+
+    def test_stale_while_open(self):
+        cache = SearchCache(LocalTTLCache(), ttl=0, stale_ttl=60)  # TTL 0: 入れたそばから古い
+        b = CircuitBreaker("t", failure_threshold=1, open_sec=60)
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise OSError("down")
+
+        self.assertEqual(cache.get_or_fetch("k", lambda: ["old"], b), ["old"])
+        self.assertEqual(cache.get_or_fetch("k", down, b), ["old"])
+        self.assertEqual(b.state, "open")
+        self.assertEqual(cache.get_or_fetch("k", down, b), ["old"])
+        self.assertEqual(len(calls), 1)  # 開いている間は呼ばない
+        with self.assertRaises(CircuitOpenError):
+            cache.get_or_fetch("other", down, b)
+
+        b.open_sec = 0
+        probed = threading.Event()
+
+        def up():
+            probed.set()
+            return ["new"]
+
+        self.assertEqual(cache.get_or_fetch("k", up, b), ["old"])  # 待たずに古い値、再検証は裏で
+        self.assertTrue(probed.wait(5))
+        for _ in range(100):
+            if b.state == "closed":
+                break
+            time.sleep(0.01)
+        self.assertEqual(b.state, "closed")
+        self.assertEqual(cache._lookup("k")[1], ["new"])
+        self.assertEqual(cache.stats()["stale_served"], 3)
+
+    def test_cancelled_async_probe_reopens(self):
+        cache = SearchCache(LocalTTLCache(), ttl=0, stale_ttl=60)
+        b = CircuitBreaker("t", failure_threshold=1, open_sec=0)
+        started = []
+
+        async def hang():
+            started.append(1)
+            await asyncio.sleep(60)
+
+        async def down():
+            raise OSError("down")
+
+        async def request(fetch):
+            value = await cache.aget_or_fetch("k", fetch, b)
+            await asyncio.sleep(0)  # 再検証のタスクを1回走らせてから返る
+            return value
+
+        cache._store("k", ["old"])
+        self.assertEqual(async_to_sync(request)(down), ["old"])
+        self.assertEqual(b.state, "open")
+        # 再検証はこのリクエストのループで始まり、ループの終わりにキャンセルされる
+        self.assertEqual(async_to_sync(request)(hang), ["old"])
+        self.assertEqual(started, [1])
+        self.assertEqual(b.state, "open")
+        self.assertEqual(b.stats()["transitions"].get("half_open->open"), 1)
+
+    def test_lost_probe_is_retried(self):
+        b = CircuitBreaker("t", failure_threshold=1, open_sec=0, probe_timeout_sec=60)
+        b.record(False)
+        self.assertTrue(b.try_start_probe())  # この試しは報告されずに消えたとする
+        self.assertFalse(b.try_start_probe())
+        b._probe_at -= 61
+        self.assertTrue(b.try_start_probe())
+        b.record(True)
+        self.assertEqual(b.state, "closed")
+
+
+class TypeCatalogTests(SimpleTestCase):
+    """
+    タイプの表示情報・代表曲は共有オブジェクト（断片として登録済み）なので書き換えられない。
+    """
+
+    def test_shared_objects_are_read_only(self):
+        info = describe_type("ABCD")
+        tracks = pick_sample_tracks_fake("ABCD")
+        self.assertIs(info, type_catalog.get("ABCD").info)
+        for mutate in (
+            lambda: info.__setitem__("name", "x"),
+            lambda: info.update(name="x"),
+            lambda: info["axes"].pop("axis1"),
+            lambda: tracks.append({}),
+            lambda: tracks[0].__setitem__("title", "x"),
+            lambda: tracks.sort(key=str),
+        ):
+            with self.assertRaises(TypeError):
+                mutate()
+        self.assertEqual(json.loads(type_catalog.get("ABCD").info_json), info)
+
+        copy = dict(info)
+        copy["name"] = "x"  # コピーは普通の dict
+        self.assertNotEqual(describe_type("ABCD")["name"], "x")
+
+    def test_encodes_like_plain_objects(self):
+        for code in ("ABCD", "zzzz"):
+            entry = type_catalog.get(code)
+            for backend in fast_json.BACKENDS:
+                with self.subTest(code=code, backend=backend):
+                    self.assertEqual(fast_json.dumps(entry.info, backend=backend), entry.info_json)
+                    self.assertEqual(fast_json.dumps(entry.track_dicts, backend=backend), entry.tracks_json)
+            self.assertEqual(pickle.loads(pickle.dumps(entry.info)), entry.info)
+
+
+class FastJsonTests(SimpleTestCase):
+    """
+    API の JSON は UTF-8 のまま（\\uXXXX にしない）。断片を差し込んでも同じ文書になる。
+    """
+
+    def test_utf8_and_fragments(self):
+        entry = type_catalog.get("ABCD")
+        payload = {"type_code": "ABCD", "type_info": entry.info, "sample_tracks": entry.track_dicts, "n": 1}
+        expected = json.loads(json.dumps(payload))
+        for backend in fast_json.BACKENDS:
+            for fragments in (False, True):
+                with self.subTest(backend=backend, fragments=fragments):
+                    body = fast_json.dumps(payload, backend=backend, fragments=fragments)
+                    self.assertIn(entry.name.encode("utf-8"), body)
+                    self.assertEqual(json.loads(body), expected)
+                    self.assertEqual(list(json.loads(body)), list(payload))  # キーの順番も同じ
+
+    def test_response(self):
+        r = fast_json.FastJsonResponse({"name": "夜"}, status=201)
+        self.assertEqual((r.status_code, r["Content-Type"], r.content), (201, "application/json", '{"name":"夜"}'.encode()))
+        with self.assertRaises(TypeError):
+            fast_json.FastJsonResponse([1])
+
+
+class CompressionAndCompactTests(TestCase):
+    """
+    /api の JSON は Accept-Encoding に応じて圧縮。検索結果は fields= / compact=1 で軽くできる。
+    """
+
+    def setUp(self):
+        self.items = [
+            {
+                "id": str(i),
+                "title": f"夜に駆ける {i}",
+                "artist": "YOASOBI",
+                "artwork": f"https://is{i % 3 + 1}-ssl.mzstatic.com/image/thumb/Music{i}/v4/{i:02x}/100x100bb.jpg",
+                "preview_url": f"https://audio-ssl.itunes.apple.com/itunes-assets/AudioPreview/{i}.m4a",
+                "external_url": f"https://music.apple.com/jp/album/{i}?i={i}",
+            }
+            for i in range(20)
+        ]
+        patcher = mock.patch.object(track_views, "_search_tracks", return_value=self.items)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_choose_encoding(self):
+        self.assertEqual(compression.choose_encoding("gzip, deflate, br", ["br", "gzip"]), "br")
+        self.assertEqual(compression.choose_encoding("br;q=0.5, gzip", ["br", "gzip"]), "gzip")
+        self.assertIsNone(compression.choose_encoding("gzip;q=0", ["gzip"]))
+        self.assertIsNone(compression.choose_encoding("", ["gzip"]))
+
+    def test_gzip_negotiation(self):
+        plain = Client().get("/api/tracks/search", {"q": "x"})
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertIn("Accept-Encoding", plain["Vary"])
+
+        r = Client().get("/api/tracks/search", {"q": "x"}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(r["Content-Encoding"], "gzip")
+        self.assertLess(len(r.content), len(plain.content))
+        self.assertEqual(gzip.decompress(r.content), plain.content)
+
+        small = Client().get("/api/tracks/search", {"q": "x", "fields": "id"}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(small.has_header("Content-Encoding"))  # MIN_SIZE 未満
+
+    def test_fields_and_compact(self):
+        body = Client().get("/api/tracks/search", {"q": "x", "fields": "id,artwork,nope", "compact": "1"}).json()
+        self.assertEqual(set(body["items"][0]), {"id", "artwork"})
+        self.assertTrue(all(p.startswith("https://") for p in body["prefixes"]))
+        restored = compact.expand_urls(body["items"], body["prefixes"])
+        self.assertEqual(restored, compact.select_fields(self.items, ("id", "artwork")))
+        self.assertEqual(Client().get("/api/tracks/search", {"q": "x"}).json(), {"items": self.items})
+
+
+@override_settings(BATCH_DIAGNOSIS={"TOKENS": {"secret": "partner"}})
+class BatchDiagnosisTests(TestCase):
+    """
+    POST /api/diagnose/batch: 1件1行の NDJSON、保存は件数によらず同じクエリ数（bulk_create 1回）。
+    """
+
+    def _post(self, entries, token="secret"):
+        r = Client().post(
+            "/api/diagnose/batch",
+            json.dumps({"entries": entries}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+        if r.status_code != 200:
+            return r, None
+        return r, [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+
+    def _entries(self, n, offset=0):
+        return [
+            {"user": f"partner.{i}", "tracks": [{"id": f"t{i}", "tempo": i / n, "bright": 0.7, "electro": 0.2, "explore": 0.9}]}
+            for i in range(offset, offset + n)
+        ]
+
+    def test_auth(self):
+        r, _ = self._post(self._entries(1), token="nope")
+        self.assertEqual(r.status_code, 401)
+
+    def test_stream_and_save(self):
+        entries = self._entries(2) + [{"user": "partner.x", "tracks": []}]
+        r, lines = self._post(entries)
+        self.assertEqual(r["Content-Type"], "application/x-ndjson")
+        self.assertEqual([line.get("error") for line in lines[:3]], [None, None, "no_tracks"])
+        for entry, line in zip(entries, lines):
+            if "error" not in line:
+                self.assertEqual(line["scores"], compute_scores_from_selected_tracks(entry["tracks"]))
+        self.assertEqual(lines[-1], {"done": True, "entries": 3, "saved": 2, "errors": 1})
+        latest = LatestDiagnosis.objects.select_related("result", "user").get(user__username="partner.1")
+        self.assertEqual(latest.result.type_code, lines[1]["type_code"])
+        self.assertFalse(latest.user.has_usable_password())
+
+    def test_cannot_overwrite_accounts_it_does_not_own(self):
+        sp = User.objects.create(username="sp_abc", password=make_password(None))
+        SpotifyAccount.objects.create(
+            user=sp, spotify_user_id="abc", access_token="a", refresh_token="r", token_expires_at=timezone.now()
+        )
+        original = DiagnosisResult.objects.create(user=sp, **{f: 0.5 for f in score_stats.SCORE_FIELDS}, type_code="abcd")
+        User.objects.create(username="partner.admin", is_staff=True)
+        tracks = self._entries(1)[0]["tracks"]
+        entries = [{"user": name, "tracks": tracks} for name in ("sp_abc", "dev_user", "partner.admin", "other.1", "partner.ok")]
+
+        _, lines = self._post(entries)
+        self.assertEqual([line.get("error") for line in lines[:5]], ["not_owned"] * 4 + [None])
+        self.assertEqual(lines[-1]["saved"], 1)
+        self.assertEqual(LatestDiagnosis.objects.get(user=sp).result_id, original.pk)
+        self.assertFalse(User.objects.filter(username__in=["dev_user", "other.1"]).exists())
+
+        # staff のセッションでも Spotify 連携済みのアカウントは書き換えない
+        staff = User.objects.create(username="ops", is_staff=True)
+        client = Client()
+        client.force_login(staff)
+        r = client.post("/api/diagnose/batch", json.dumps({"entries": entries[:1]}), content_type="application/json")
+        self.assertEqual(json.loads(b"".join(r.streaming_content).splitlines()[0])["error"], "not_owned")
+        self.assertEqual(LatestDiagnosis.objects.get(user=sp).result_id, original.pk)
+
+    def test_queries_do_not_grow_with_entries(self):
+        counts = []
+        for n, offset in ((2, 0), (20, 100)):
+            executed = []
+            with connection.execute_wrapper(lambda execute, sql, *args: executed.append(sql) or execute(sql, *args)):
+                self._post(self._entries(n, offset))
+            counts.append(len(executed))
+        self.assertEqual(counts[0], counts[1])
+        self.assertLess(counts[0], 15)
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone as dj_timezone
+
+from .models import SpotifyAccount
+from .spotify import refresh_access_token
+
+
+@dataclass(frozen=True)
+class _Entry:
+    account_id: int
+    access_token: str
+    refresh_token: str
+    expires_at: datetime  # UTC
+
+
+class TokenManager:
+    """
+    Spotify access token のプロセス内キャッシュ。
+    - 有効なトークンはメモリから返す（SpotifyAccount を読み書きしない）
+    - 期限が refresh_ahead 秒以内ならバックグラウンドで先に更新する（今のトークンはそのまま返す）
+    - 期限切れならその場で更新する
+    - 更新はプロセス内ではユーザー単位のロック（LOCK_STRIPES 本を user_id で分ける）で1本だけ。
+      ロックを取ったら DB の行を読み直し、他のワーカーが更新済みならそれを使う
+      （ローテーションされた refresh_token を古いキャッシュから送らない）
+    - Spotify への問い合わせはトランザクションの外。DB には送った refresh_token のままの行にだけ
+      UPDATE 1文で書き（compare-and-set）、先に他のワーカーが書いていればそちらを使う
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, refresh_ahead: float = 300.0, workers: int = 2) -> None:
+        self.refresh_ahead = timedelta(seconds=refresh_ahead)
+        self._entries: Dict[int, _Entry] = {}  # user_id -> entry
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._guard = threading.Lock()
+        self._scheduled: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="spotify-token")
+
+    # -------------------------
+    # cache
+    # -------------------------
+    def put(self, acc: SpotifyAccount) -> _Entry:
+        entry = _Entry(acc.pk, acc.access_token, acc.refresh_token, acc.token_expires_at)
+        with self._guard:
+            # 別ユーザーに付け替えられたアカウントの古い entry は捨てる
+            for uid in [u for u, e in self._entries.items() if e.account_id == acc.pk and u != acc.user_id]:
+                del self._entries[uid]
+            self._entries[acc.user_id] = entry
+        return entry
+
+    def invalidate(self, user_id: int) -> None:
+        with self._guard:
+            self._entries.pop(user_id, None)
+
+    def _lock_for(self, user_id: int) -> threading.Lock:
+        return self._locks[user_id % len(self._locks)]
+
+    def _fresh(self, expires_at: datetime) -> bool:
+        return expires_at - datetime.now(timezone.utc) > self.refresh_ahead
+
+    # -------------------------
+    # hot path
+    # -------------------------
+    def access_token(self, user_id: int) -> Optional[str]:
+        """
+        user の有効な access token を返す。Spotify 未接続なら None。
+        """
+        entry = self._entries.get(user_id)
+        if entry is None:
+            acc = SpotifyAccount.objects.filter(user_id=user_id).first()
+            if acc is None:
+                return None
+            entry = self.put(acc)
+
+        now = datetime.now(timezone.utc)
+        if entry.expires_at <= now:
+            entry = self._refresh(user_id)
+        elif entry.expires_at - now <= self.refresh_ahead:
+            self._schedule(user_id)
+        return entry.access_token
+
+    def _schedule(self, user_id: int) -> None:
+        with self._guard:
+            if user_id in self._scheduled:
+                return
+            self._scheduled.add(user_id)
+        self._executor.submit(self._background_refresh, user_id)
+
+    def _background_refresh(self, user_id: int) -> None:
+        try:
+            self._refresh(user_id)
+        except Exception:
+            # 失敗しても期限切れ時にリクエスト内で再試行される
+            pass
+        finally:
+            with self._guard:
+                self._scheduled.discard(user_id)
+            close_old_connections()
+
+    def _refresh(self, user_id: int) -> _Entry:
+        with self._lock_for(user_id):
+            cur = self._entries.get(user_id)
+            if cur is not None and self._fresh(cur.expires_at):
+                # 待っている間に同じプロセスの他のスレッドが更新した
+                return cur
+
+            # 他のワーカーが済ませていればその結果を使う
+            acc = SpotifyAccount.objects.get(user_id=user_id)
+            if self._fresh(acc.token_expires_at):
+                return self.put(acc)
+
+            # Spotify への問い合わせはトランザクションの外で（行ロックや SQLite の書き込みロックを
+            # 持ったまま待たない）。書くのは読んだ refresh_token のままの行だけ
+            sent = acc.refresh_token
+            tokens = refresh_access_token(
+                os.environ.get("SPOTIFY_CLIENT_ID", ""),
+                os.environ.get("SPOTIFY_CLIENT_SECRET", ""),
+                sent,
+            )
+            acc.access_token = tokens.access_token
+            acc.refresh_token = tokens.refresh_token or sent
+            acc.token_expires_at = tokens.expires_at
+            n = SpotifyAccount.objects.filter(pk=acc.pk, refresh_token=sent).update(
+                access_token=acc.access_token,
+                refresh_token=acc.refresh_token,
+                token_expires_at=acc.token_expires_at,
+                updated_at=dj_timezone.now(),
+            )
+            if n == 0:
+                # 問い合わせている間に他のワーカーが更新した。そちらのトークンを使う
+                acc = SpotifyAccount.objects.get(user_id=user_id)
+            return self.put(acc)
+
+
+_manager: Optional[TokenManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_token_manager() -> TokenManager:
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = TokenManager(refresh_ahead=getattr(settings, "SPOTIFY_TOKEN_REFRESH_AHEAD", 300))
+    return _manager
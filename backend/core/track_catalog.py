@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+
+# /api/tracks/search 用のローカル曲カタログ。
+# iTunes から返ってきた曲を CatalogTrack に貯め、タイトル+アーティストの正規化文字列に
+# メモリ内の n-gram 索引を張る。検索はまずここで答え、足りないときだけ upstream に行く。
+# - 正規化: NFKC（全角英数→半角、半角カナ→全角）+ casefold + カタカナ→ひらがな + 記号を空白に
+# - 索引キー: 単語の先頭1文字（"^" + 文字）と、2-gram（空白をまたがない）
+#   1文字の語は単語の先頭一致、2文字以上は部分一致（2-gram の積集合を取ってから文字列で確認）
+# - 1語の問い合わせ（打鍵中のオートコンプリート）は、まずタイトル/アーティストの辞書順配列を
+#   二分探索して先頭一致を取り、limit 件に届かなかったときだけ n-gram の候補を順位付けする
+# 漢字とかなの読みの対応（「夜」と「よる」）は辞書が無いので扱わない。
+# 索引はプロセス起動時（core.warmup）に DB から作り、RELOAD_SEC ごとに他のワーカーが足した曲
+# （updated_at がそれ以降の行）を読み足す。作っている間の検索は upstream に任せる。
+
+logger = logging.getLogger(__name__)
+
+_KATAKANA = str.maketrans({chr(c): chr(c - 0x60) for c in range(0x30A1, 0x30F7)})  # ァ..ヶ -> ぁ..ゖ
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(s: Any) -> str:
+    """
+    検索用の正規化（索引と問い合わせの両方に使う）。
+    """
+    s = unicodedata.normalize("NFKC", str(s or "")).casefold().translate(_KATAKANA)
+    return " ".join(_SEPARATORS.sub(" ", s).split())
+
+
+def _keys(text: str) -> Set[str]:
+    keys: Set[str] = set()
+    for word in text.split():
+        keys.add("^" + word[0])
+        for i in range(len(word) - 1):
+            keys.add(word[i : i + 2])
+    return keys
+
+
+def _query_keys(term: str) -> List[str]:
+    if len(term) == 1:
+        return ["^" + term]
+    return list({term[i : i + 2] for i in range(len(term) - 1)})
+
+
+class TrackCatalog:
+    """
+    曲 dict（itunes_items と同じ形）のメモリ内索引。add は同じ id なら上書き。
+    """
+
+    def __init__(self, max_tracks: int = 200_000) -> None:
+        self.max_tracks = max_tracks
+        self.synced_until: Optional[datetime] = None  # DB から読んだ行の updated_at の最大
+        self._items: List[Dict[str, str]] = []
+        self._title: List[str] = []
+        self._artist: List[str] = []
+        self._slot: Dict[str, int] = {}
+        self._postings: Dict[str, Set[int]] = {}
+        self._by_title: List[Tuple[str, int]] = []  # (正規化タイトル, slot) の辞書順
+        self._by_artist: List[Tuple[str, int]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, items: Iterable[Dict[str, str]]) -> int:
+        """
+        索引に足す（または更新する）。追加・更新した件数を返す。
+        """
+        n = 0
+        new_titles: List[Tuple[str, int]] = []
+        new_artists: List[Tuple[str, int]] = []
+        with self._lock:
+            for it in items:
+                tid = str(it.get("id") or "")
+                if not tid or not it.get("title"):
+                    continue
+                title, artist = normalize(it.get("title")), normalize(it.get("artist"))
+                slot = self._slot.get(tid)
+                if slot is None:
+                    if len(self._items) >= self.max_tracks:
+                        continue
+                    slot = len(self._items)
+                    self._items.append(it)
+                    self._title.append(title)
+                    self._artist.append(artist)
+                    self._slot[tid] = slot
+                else:
+                    old = _keys(self._title[slot]) | _keys(self._artist[slot])
+                    for k in old:
+                        self._postings[k].discard(slot)
+                    _remove(self._by_title, (self._title[slot], slot))
+                    _remove(self._by_artist, (self._artist[slot], slot))
+                    self._items[slot] = it
+                    self._title[slot] = title
+                    self._artist[slot] = artist
+                for k in _keys(title) | _keys(artist):
+                    self._postings.setdefault(k, set()).add(slot)
+                new_titles.append((title, slot))
+                new_artists.append((artist, slot))
+                n += 1
+            _merge(self._by_title, new_titles)
+            _merge(self._by_artist, new_artists)
+        return n
+
+    def _rank(self, slot: int, terms: List[str]) -> Optional[int]:
+        """
+        小さいほど良い。どれかの語が含まれなければ None。
+        タイトル先頭一致 0 / アーティスト先頭一致 1 / 単語の先頭一致 2 / 部分一致 3 の合計。
+        """
+        title, artist = self._title[slot], self._artist[slot]
+        total = 0
+        for t in terms:
+            if title.startswith(t):
+                total += 0
+            elif artist.startswith(t):
+                total += 1
+            elif (" " + t) in (" " + title) or (" " + t) in (" " + artist):
+                total += 2
+            elif t in title or t in artist:
+                total += 3 if len(t) > 1 else 99  # 1文字は先頭一致だけ
+            else:
+                return None
+            if total >= 99:
+                return None
+        return total
+
+    @staticmethod
+    def _prefixed(sorted_pairs: List[Tuple[str, int]], t: str, limit: int, out: List[int], seen: Set[int]) -> None:
+        i = bisect_left(sorted_pairs, (t,))
+        while i < len(sorted_pairs) and len(out) < limit:
+            text, slot = sorted_pairs[i]
+            if not text.startswith(t):
+                break
+            if slot not in seen:
+                seen.add(slot)
+                out.append(slot)
+            i += 1
+
+    def search(self, q: str, limit: int = 20) -> List[Dict[str, str]]:
+        """
+        タイトル先頭一致 → アーティスト先頭一致 → 単語の先頭一致 → 部分一致 の順（同順位は辞書順）。
+        """
+        terms = normalize(q).split()
+        if not terms or limit <= 0:
+            return []
+        with self._lock:
+            head: List[int] = []
+            seen: Set[int] = set()
+            if len(terms) == 1:
+                self._prefixed(self._by_title, terms[0], limit, head, seen)
+                self._prefixed(self._by_artist, terms[0], limit, head, seen)
+                if len(head) >= limit:
+                    return [self._items[s] for s in head]
+            rest = self._ranked(terms, limit - len(head), seen)
+            return [self._items[s] for s in head + rest]
+
+    def _ranked(self, terms: List[str], limit: int, skip: Set[int]) -> List[int]:
+        """
+        n-gram の候補を順位付けして上位 limit 件（skip に入っている slot は除く）。
+        """
+        if limit <= 0:
+            return []
+        postings = []
+        for t in terms:
+            for k in _query_keys(t):
+                p = self._postings.get(k)
+                if not p:
+                    return []
+                postings.append(p)
+        postings.sort(key=len)
+        cand = postings[0]
+        if len(postings) > 1:
+            cand = cand.intersection(*postings[1:])
+        ranked: List[Tuple[int, str, int]] = []
+        for slot in cand:
+            if slot in skip:
+                continue
+            r = self._rank(slot, terms)
+            if r is not None:
+                ranked.append((r, self._title[slot], slot))
+        return [s for _, _, s in heapq.nsmallest(limit, ranked)]
+
+
+def _merge(sorted_pairs: List[Tuple[str, int]], new: List[Tuple[str, int]]) -> None:
+    # 少しなら挿入、まとめて（DB からの構築など）なら末尾に足して並べ直す
+    if len(new) <= 64:
+        for pair in new:
+            insort(sorted_pairs, pair)
+    else:
+        sorted_pairs.extend(new)
+        sorted_pairs.sort()
+
+
+def _remove(sorted_pairs: List[Tuple[str, int]], pair: Tuple[str, int]) -> None:
+    i = bisect_left(sorted_pairs, pair)
+    if i < len(sorted_pairs) and sorted_pairs[i] == pair:
+        del sorted_pairs[i]
+
+
+def _conf() -> dict:
+    conf = {"ENABLED": True, "MIN_RESULTS": 10, "MAX_TRACKS": 200_000, "RELOAD_SEC": 60, "BUILD_AT_STARTUP": True}
+    conf.update(getattr(settings, "TRACK_CATALOG", {}))
+    return conf
+
+
+def _row_to_item(row) -> Dict[str, str]:
+    return {
+        "id": row.track_id,
+        "title": row.title,
+        "artist": row.artist,
+        "artwork": row.artwork,
+        "preview_url": row.preview_url,
+        "external_url": row.external_url,
+    }
+
+
+def _load(catalog: TrackCatalog, qs) -> None:
+    chunk: List[Dict[str, str]] = []
+    for row in qs.iterator(chunk_size=10_000):
+        chunk.append(_row_to_item(row))
+        if catalog.synced_until is None or row.updated_at > catalog.synced_until:
+            catalog.synced_until = row.updated_at
+        if len(chunk) >= 10_000:
+            catalog.add(chunk)
+            chunk = []
+    catalog.add(chunk)
+
+
+def build_from_db(max_tracks: int = 200_000) -> TrackCatalog:
+    from .models import CatalogTrack
+
+    catalog = TrackCatalog(max_tracks=max_tracks)
+    _load(catalog, CatalogTrack.objects.order_by("first_seen_at"))
+    return catalog
+
+
+def refresh_from_db(catalog: TrackCatalog) -> None:
+    """
+    前回読んだ後に（他のワーカーが）足した・更新した行を読み足す。
+    """
+    from .models import CatalogTrack
+
+    qs = CatalogTrack.objects.order_by("first_seen_at")
+    if catalog.synced_until is not None:
+        # 同じ時刻の行を取りこぼさないよう >=（読み直した行は同じ slot を上書きするだけ）
+        qs = qs.filter(updated_at__gte=catalog.synced_until)
+    _load(catalog, qs)
+
+
+_catalog: Optional[TrackCatalog] = None
+_catalog_lock = threading.Lock()
+_loaded_at = 0.0  # time.monotonic()
+
+
+def get_catalog(block: bool = True) -> Optional[TrackCatalog]:
+    """
+    共有の索引。初回は DB から作る（block=False なら、他のスレッドが作っている間は None）。
+    RELOAD_SEC を過ぎていたら、1つのスレッドだけが他のワーカーの分を読み足す（他は待たない）。
+    """
+    global _catalog, _loaded_at
+    catalog = _catalog
+    if catalog is not None:
+        if time.monotonic() - _loaded_at >= _conf()["RELOAD_SEC"] and _catalog_lock.acquire(blocking=False):
+            try:
+                if _catalog is catalog:
+                    _loaded_at = time.monotonic()
+                    refresh_from_db(catalog)
+            except Exception:
+                logger.exception("track catalog: reload failed")
+            finally:
+                _catalog_lock.release()
+        return catalog
+    if not _catalog_lock.acquire(blocking=block):
+        return None
+    try:
+        if _catalog is None:
+            _catalog = build_from_db(_conf()["MAX_TRACKS"])
+            _loaded_at = time.monotonic()
+        return _catalog
+    finally:
+        _catalog_lock.release()
+
+
+def reset_catalog() -> None:
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+def _fit(value: Any, field: str) -> str:
+    from .models import CatalogTrack
+
+    max_length = CatalogTrack._meta.get_field(field).max_length
+    value = str(value or "")
+    return value[:max_length] if max_length else value
+
+
+def remember(items: List[Dict[str, str]]) -> None:
+    """
+    upstream から返ってきた曲を CatalogTrack に upsert（1文）して索引に足す。
+    """
+    from .models import CatalogTrack
+
+    # 同じ文の中で同じ行を2回更新できない（Postgres）ので id で重複を除く
+    items = list({it["id"]: it for it in items if it.get("id") and it.get("title")}.values())
+    if not items or not _conf()["ENABLED"]:
+        return
+    CatalogTrack.objects.bulk_create(
+        [
+            CatalogTrack(
+                track_id=_fit(it["id"], "track_id"),
+                title=it["title"],
+                artist=it.get("artist", ""),
+                artwork=_fit(it.get("artwork"), "artwork"),
+                preview_url=_fit(it.get("preview_url"), "preview_url"),
+                external_url=_fit(it.get("external_url"), "external_url"),
+            )
+            for it in items
+        ],
+        update_conflicts=True,
+        unique_fields=["track_id"],
+        update_fields=["title", "artist", "artwork", "preview_url", "external_url", "updated_at"],
+    )
+    if _catalog is not None:
+        _catalog.add(items)
+
+
+def search_local(q: str, limit: int = 20) -> Optional[List[Dict[str, str]]]:
+    """
+    ローカルで MIN_RESULTS 件（limit がそれより小さければ limit 件）以上見つかればそれを返す。足りなければ None。
+    空の問い合わせ（おすすめ表示）と、索引を作っている間は upstream に任せる。
+    """
+    conf = _conf()
+    if not conf["ENABLED"] or not (q or "").strip():
+        return None
+    catalog = get_catalog(block=False)
+    if catalog is None:
+        return None
+    items = catalog.search(q, limit)
+    if len(items) >= min(limit, conf["MIN_RESULTS"]):
+        return items
+    return None
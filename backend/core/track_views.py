@@ -1,16 +1,28 @@
 from __future__ import annotations
 
 import json
+import logging
+import os
 import urllib.parse
 import urllib.request
 from typing import Any, Dict, List
 
-from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
 
 from .diagnosis import compute_scores_from_selected_tracks, scores_to_type_code, describe_type, pick_sample_tracks_fake
+from . import compact, profiling, track_catalog, type_catalog, write_behind
+from .circuit_breaker import CircuitOpenError, get_breaker
+from .diagnosis_inputs import store_selected
+from .fast_json import FastJsonResponse
 from .models import DiagnosisResult
+from .search_cache import get_search_cache, normalize_key
+
+
+logger = logging.getLogger(__name__)
+
+# ローカルのスタブサーバに向けられるよう環境変数で上書き可能
+ITUNES_SEARCH_URL = os.environ.get("ITUNES_SEARCH_URL", "https://itunes.apple.com/search")
 
 
 def _clamp_str(s: Any, max_len: int = 200) -> str:
@@ -23,6 +35,60 @@ def _clamp_str(s: Any, max_len: int = 200) -> str:
 def _itunes_search(term: str, limit: int = 20, country: str = "JP") -> List[Dict[str, Any]]:
     """
     iTunes Search API で楽曲検索して、フロントで使う形に整形して返す。
+    結果は (term, limit, country) ごとにキャッシュし、同時の同一 miss は1回だけ取りに行く。
+    upstream が続けて落ちている（ブレーカーが開いている）間は待たずに古いキャッシュを返す。
+    新しく取ってきた曲はカタログに書くが、それは get_or_fetch の外で（ブレーカーの計測にも、
+    同じ検索を待っているリクエストの待ち時間にも入れない）。
+    """
+    fetched: List[List[Dict[str, Any]]] = []
+
+    def fetch() -> List[Dict[str, Any]]:
+        items = _itunes_fetch(term, limit, country)
+        fetched.append(items)
+        return items
+
+    key = normalize_key(term, limit, country)
+    items = get_search_cache().get_or_fetch(key, fetch, get_breaker("itunes"))
+    if fetched:
+        _remember(fetched[0])
+    return items
+
+
+def _search_tracks(term: str, limit: int = 20, country: str = "JP") -> List[Dict[str, Any]]:
+    """
+    ローカルの曲カタログ（core.track_catalog）で足りればそれを返し、足りなければ iTunes に聞く。
+    """
+    local = track_catalog.search_local(term, limit)
+    if local is not None:
+        return local
+    return _itunes_search(term, limit, country)
+
+
+def _remember(items: List[Dict[str, Any]]) -> None:
+    try:
+        track_catalog.remember(items)
+    except Exception:
+        # カタログに書けなくても検索結果は返す
+        logger.exception("track catalog: failed to remember %d tracks", len(items))
+
+
+def _search_payload(request, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    fields = compact.parse_fields(request.GET.get("fields"))
+    return compact.search_payload(items, fields, compact=request.GET.get("compact") in ("1", "true"))
+
+
+def _upstream_unavailable() -> FastJsonResponse:
+    # ブレーカーが開いていて、この検索語の古いキャッシュも無い
+    resp = FastJsonResponse({"error": "upstream_unavailable"}, status=503)
+    breaker = get_breaker("itunes")
+    if breaker is not None:
+        resp["Retry-After"] = str(max(1, int(breaker.open_sec)))
+    return resp
+
+
+def itunes_url(term: str, limit: int, country: str) -> str:
+    """
+    iTunes Search API の URL（sync / async 両方の検索で使う）。
     """
     q = (term or "").strip()
     if not q:
@@ -35,12 +101,13 @@ def _itunes_search(term: str, limit: int = 20, country: str = "JP") -> List[Dict
         "country": country,
         "media": "music",
     }
-    url = "https://itunes.apple.com/search?" + urllib.parse.urlencode(params)
+    return ITUNES_SEARCH_URL + "?" + urllib.parse.urlencode(params)
 
-    with urllib.request.urlopen(url, timeout=10) as r:
-        raw = r.read().decode("utf-8", errors="ignore")
-    data = json.loads(raw)
 
+def itunes_items(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    iTunes Search API のレスポンスを検索結果の曲 dict のリストにする（必須項目が無い曲は除く）。
+    """
     items: List[Dict[str, Any]] = []
     for it in data.get("results", []):
         track_id = it.get("trackId")
@@ -66,18 +133,41 @@ def _itunes_search(term: str, limit: int = 20, country: str = "JP") -> List[Dict
     return items
 
 
+def _itunes_fetch(term: str, limit: int = 20, country: str = "JP") -> List[Dict[str, Any]]:
+    url = itunes_url(term, limit, country)
+    # 計測は upstream を実際に呼んだ分だけ（キャッシュ・ローカルカタログで済んだ検索は入れない）
+    with profiling.timed("itunes"), urllib.request.urlopen(url, timeout=10) as r:
+        raw = r.read().decode("utf-8", errors="ignore")
+    return itunes_items(json.loads(raw))
+
+
 @require_GET
 def tracks_search(request):
     """
-    GET /api/tracks/search?q=...
-    -> { items: Track[] }
+    GET /api/tracks/search?q=...[&fields=id,title,...][&compact=1]
+    -> { items: Track[], prefixes?: string[] }（fields / compact は core.compact）
     """
     q = request.GET.get("q", "")
     try:
-        items = _itunes_search(q, limit=20, country="JP")
-        return JsonResponse({"items": items})
+        items = _search_tracks(q, limit=20, country="JP")
+        return FastJsonResponse(_search_payload(request, items))
+    except CircuitOpenError:
+        return _upstream_unavailable()
     except Exception as e:
-        return JsonResponse({"error": "search_failed", "detail": str(e)}, status=500)
+        return FastJsonResponse({"error": "search_failed", "detail": str(e)}, status=500)
+
+
+@require_GET
+def tracks_search_cache_stats(request):
+    """
+    GET /api/tracks/search/cache_stats
+    -> { hits, misses, coalesced, stale_served, in_flight, evictions, entries?, breaker? }
+    """
+    out = get_search_cache().stats()
+    breaker = get_breaker("itunes")
+    if breaker is not None:
+        out["breaker"] = breaker.stats()
+    return FastJsonResponse(out)
 
 
 @csrf_exempt
@@ -88,16 +178,16 @@ def diagnose_from_tracks(request):
     body: { tracks: [{id,title,artist,tempo,bright,electro,explore}, ...] }
     """
     if not request.user.is_authenticated:
-        return JsonResponse({"error": "unauthorized"}, status=401)
+        return FastJsonResponse({"error": "unauthorized"}, status=401)
 
     try:
         payload = json.loads(request.body.decode("utf-8"))
     except Exception:
-        return JsonResponse({"error": "bad_json"}, status=400)
+        return FastJsonResponse({"error": "bad_json"}, status=400)
 
     tracks = payload.get("tracks")
     if not isinstance(tracks, list) or len(tracks) == 0:
-        return JsonResponse({"error": "no_tracks"}, status=400)
+        return FastJsonResponse({"error": "no_tracks"}, status=400)
 
     # 0..1 の特徴量を平均してスコア算出
     scores = compute_scores_from_selected_tracks(tracks)
@@ -106,20 +196,23 @@ def diagnose_from_tracks(request):
 
     # 代表曲（ダミーでもOK。将来 Spotify の track id に差し替えられる）
     sample_tracks = pick_sample_tracks_fake(type_code)
-    sample_ids = [t["title"] for t in sample_tracks]
-
-    # DB保存
-    DiagnosisResult.objects.create(
-        user=request.user,
-        energy_score=scores["energy_score"],
-        mood_score=scores["mood_score"],
-        texture_score=scores["texture_score"],
-        explore_score=scores["explore_score"],
-        type_code=type_code,
-        sample_track_ids=sample_ids,
+    sample_ids = list(type_catalog.get(type_code).track_titles)
+
+    # DB保存（入力も再計算用に残す）
+    write_behind.save_result(
+        DiagnosisResult(
+            user=request.user,
+            input=store_selected(tracks),
+            energy_score=scores["energy_score"],
+            mood_score=scores["mood_score"],
+            texture_score=scores["texture_score"],
+            explore_score=scores["explore_score"],
+            type_code=type_code,
+            sample_track_ids=sample_ids,
+        )
     )
 
-    return JsonResponse(
+    return FastJsonResponse(
         {
             "username": request.user.username,
             "type_code": type_code,
@@ -1,24 +1,21 @@
 from __future__ import annotations
-from typing import Dict, Any
 
-TYPE_META: Dict[str, Dict[str, Any]] = {
-    "ABCD": {"name": "フェス先頭列タイプ", "tagline": "明るく速くて生音も好き。しかも新規開拓派。"},
-    "ABcD": {"name": "ネオン疾走タイプ", "tagline": "明るく速くて電子寄り。新しい曲を探すのが好き。"},
-    "AbcD": {"name": "夜更かしドライブタイプ", "tagline": "暗めで速い。電子寄りで探索好き。"},
-    "abCd": {"name": "部屋で浸るタイプ", "tagline": "静かで暗め。生音寄りで定番を大事にする。"},
-}
+import json
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, NoReturn, Sequence, Tuple
 
-def _axis_labels(type_code: str) -> Dict[str, str]:
-    return {
-        "energy": "動" if type_code[0] == "A" else "静",
-        "mood": "明" if type_code[1] == "B" else "影",
-        "texture": "生" if type_code[2] == "C" else "電",
-        "explore": "探索" if type_code[3] == "D" else "定番",
-    }
+from . import fast_json
+
+# 16タイプの表示情報と代表曲（仮）のカタログ。import 時に1回だけ組み立てる。
+# describe_type / pick_sample_tracks_fake / 結果ビューは、ここで作った共有オブジェクトをそのまま返す
+# （呼び出しごとに dict を作らない）。共有オブジェクトはエンコード済みの断片（core.fast_json）と
+# ずれないよう書き換えできない dict/list（_FrozenDict / _FrozenList。JSON からは普通の dict/list）にしてある。
+# 手を加えたいときは dict(x) / list(x) でコピーしてから。
 
 # --- 16タイプの表示プリセット（A/a, B/b, C/c, D/d の大小で16通り） ---
 
-TYPE_PRESETS: dict[str, dict] = {
+TYPE_PRESETS: Dict[str, Dict[str, str]] = {
     # 動(高Energy) × 光(明るめ) × 生(オーガニック) × 探索
     "ABCD": {"name": "フェス日和タイプ", "tagline": "明るく前のめり。歌と熱量で押し切る。"},
     # 動 × 光 × 生 × 安定
@@ -37,7 +34,6 @@ TYPE_PRESETS: dict[str, dict] = {
     # 動 × 影 × 電 × 安定
     "Abcd": {"name": "ダークグルーヴタイプ", "tagline": "低音で整う。お気に入りを深掘りする。"},
 
-
     # 静(低Energy) × 光 × 生 × 探索
     "aBCD": {"name": "昼下がり散歩タイプ", "tagline": "やさしく軽やか。気分転換に新しい道。"},
     # 静 × 光 × 生 × 安定
@@ -47,7 +43,6 @@ TYPE_PRESETS: dict[str, dict] = {
     # 静 × 光 × 電 × 安定
     "aBcd": {"name": "チルポップタイプ", "tagline": "明るいチル。気分を軽く保つ名人。"},
 
-
     # 静 × 影 × 生 × 探索
     "abCD": {"name": "読書の余韻タイプ", "tagline": "静かに沁みる。アルバムで旅する。"},
     # 静 × 影 × 生 × 安定
@@ -58,33 +53,9 @@ TYPE_PRESETS: dict[str, dict] = {
     "abcd": {"name": "深呼吸アンビエントタイプ", "tagline": "静寂と低音。空間ごと落ち着く。"},
 }
 
-def _axes_from_code(type_code: str) -> dict:
-    """
-    小文字/大文字で4軸のラベルを作る（フロントのチップ表示用）
-    A/a: 動/静, B/b: 光/影, C/c: 生/電, D/d: 探索/安定
-    """
-    return {
-        "energy": "動" if type_code[:1].isupper() else "静",
-        "mood": "光" if len(type_code) > 1 and type_code[1:2].isupper() else "影",
-        "texture": "生" if len(type_code) > 2 and type_code[2:3].isupper() else "電",
-        "explore": "探索" if len(type_code) > 3 and type_code[3:4].isupper() else "安定",
-    }
-
-def describe_type(type_code: str) -> dict:
-    preset = TYPE_PRESETS.get(type_code)
-    if not preset:
-        # 未定義でも落とさない（保険）
-        preset = {"name": f"Type {type_code}", "tagline": "あなたの音楽の傾向を表すタイプ。"}
-    return {
-        "name": preset["name"],
-        "tagline": preset["tagline"],
-        "axes": _axes_from_code(type_code),
-    }
-
-
 # --- 代表曲（仮）3曲：タイプごとに固定（シェアでブレない） ---
 
-TYPE_TRACKS: dict[str, list[dict]] = {
+TYPE_TRACKS: Dict[str, List[Dict[str, str]]] = {
     "ABCD": [
         {"title": "Sunburst Chorus", "artist": "Bright Parade", "note": "サビで勝つ。熱量が上がる。"},
         {"title": "Open Air", "artist": "Weekend Bloom", "note": "屋外が似合うポップ。"},
@@ -170,81 +141,121 @@ TYPE_TRACKS: dict[str, list[dict]] = {
     ],
 }
 
-def pick_sample_tracks_fake(type_code: str) -> list[dict]:
-    # 未定義でも落とさない保険（どのタイプでも3曲返す）
-    fallback = [
-        {"title": "Daydream Pop", "artist": "Paper Sun", "note": "軽くて聴きやすい"},
-        {"title": "Stereo Breeze", "artist": "Room Radio", "note": "作業BGMにちょうどいい"},
-        {"title": "Afterglow", "artist": "Glass Hour", "note": "余韻が残る、落ち着く"},
-    ]
-    return TYPE_TRACKS.get(type_code, fallback)
 
+FALLBACK_PRESET: Dict[str, str] = {"name": "", "tagline": "あなたの音楽の傾向を表すタイプ。"}
+
+# 未定義でも落とさない保険（どのタイプでも3曲返す）
+FALLBACK_TRACKS: List[Dict[str, str]] = [
+    {"title": "Daydream Pop", "artist": "Paper Sun", "note": "軽くて聴きやすい"},
+    {"title": "Stereo Breeze", "artist": "Room Radio", "note": "作業BGMにちょうどいい"},
+    {"title": "Afterglow", "artist": "Glass Hour", "note": "余韻が残る、落ち着く"},
+]
+
+
+def _readonly(self: Any, *args: Any, **kwargs: Any) -> NoReturn:
+    raise TypeError(f"{type(self).__name__} is shared by type_catalog; copy it before modifying")
 
-def pick_sample_tracks_fake(type_code: str) -> list[dict]:
+
+class _FrozenDict(dict):
     """
-    Spotifyが無い時の“それっぽい代表曲”を返す。
-    type_codeごとに固定なので、シェアしてもブレない。
+    書き換えできない dict。json / orjson からは dict としてそのままエンコードされる。
     """
-    catalog = {
-        "AbCD": [
-            {"title": "Midnight Loop", "artist": "Neon Taxi", "note": "夜の高速、低音が気持ちいい"},
-            {"title": "Shadow Sprint", "artist": "City Pulse", "note": "暗め×速め、集中スイッチ"},
-            {"title": "Analog Rain", "artist": "Blue Static", "note": "冷たい空気、ドライブ向け"},
-        ],
-        "AbcD": [
-            {"title": "Late Night Drive", "artist": "Pastel FM", "note": "暗め電子、探索モード"},
-            {"title": "Tunnel Lights", "artist": "Noon Runner", "note": "一定のビートが心地いい"},
-            {"title": "Quiet Accel", "artist": "Soda Wave", "note": "静かに加速する感じ"},
-        ],
-    }
 
-    # 未定義タイプは共通の3曲（仮）
-    fallback = [
-        {"title": "Daydream Pop", "artist": "Paper Sun", "note": "軽くて聴きやすい"},
-        {"title": "Stereo Breeze", "artist": "Room Radio", "note": "作業BGMにちょうどいい"},
-        {"title": "Afterglow", "artist": "Glass Hour", "note": "余韻が残る、落ち着く"},
-    ]
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (dict(self),))
+
+
+class _FrozenList(list):
+    """
+    書き換えできない list（_FrozenDict の list 版）。
+    """
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (list(self),))
 
-    return catalog.get(type_code, fallback)
 
-def _clamp01(x: float) -> float:
-    try:
-        v = float(x)
-    except Exception:
-        return 0.0
-    if v < 0:
-        return 0.0
-    if v > 1:
-        return 1.0
-    return v
+@dataclass(frozen=True, slots=True)
+class SampleTrack:
+    title: str
+    artist: str
+    note: str
 
 
-def compute_scores_from_selected_tracks(tracks: list[dict]) -> dict:
+@dataclass(frozen=True, slots=True)
+class TypeEntry:
     """
-    フロントから送られる各曲の特徴量(0..1)を平均して、4スコアにする。
-    入力例：
-      {"tempo":0.8,"bright":0.2,"electro":0.7,"explore":0.6}
+    1タイプ分。info / track_dicts は API にそのまま載せる共有の（書き換えできない）dict/list、
+    *_json はそれを UTF-8 の JSON にした断片（core.fast_json がレスポンスに差し込む）。
     """
-    if not tracks:
-        return {"energy_score": 0.5, "mood_score": 0.5, "texture_score": 0.5, "explore_score": 0.5}
 
-    tempos = []
-    brights = []
-    electros = []
-    explores = []
+    code: str
+    name: str
+    tagline: str
+    axes: Mapping[str, str]
+    tracks: Tuple[SampleTrack, ...]
+    track_titles: Tuple[str, ...]
+    info: Mapping[str, Any]
+    track_dicts: Sequence[Mapping[str, str]]
+    info_json: bytes
+    tracks_json: bytes
 
-    for t in tracks:
-        tempos.append(_clamp01(t.get("tempo", 0.5)))
-        brights.append(_clamp01(t.get("bright", 0.5)))
-        electros.append(_clamp01(t.get("electro", 0.5)))
-        explores.append(_clamp01(t.get("explore", 0.5)))
 
-    n = max(1, len(tracks))
+def _axes(type_code: str) -> Dict[str, str]:
     return {
-        "energy_score": sum(tempos) / n,     # tempo → energy
-        "mood_score": sum(brights) / n,     # bright → mood
-        "texture_score": sum(electros) / n, # electro → texture（生↔電）
-        "explore_score": sum(explores) / n, # explore → explore
+        "axis1": "動" if type_code[0] == "A" else "静",
+        "axis2": "光" if type_code[1] == "B" else "影",
+        "axis3": "生" if type_code[2] == "C" else "電",
+        "axis4": "探索" if type_code[3] == "D" else "定番",
     }
 
 
+def _encode(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def build_entry(type_code: str) -> TypeEntry:
+    preset = TYPE_PRESETS.get(type_code) or {**FALLBACK_PRESET, "name": f"Type {type_code}"}
+    raw_tracks = TYPE_TRACKS.get(type_code, FALLBACK_TRACKS)
+    axes = _FrozenDict(_axes(type_code) if len(type_code) >= 4 else {})
+    info = _FrozenDict(name=preset["name"], tagline=preset["tagline"], axes=axes)
+    track_dicts = _FrozenList(_FrozenDict(t) for t in raw_tracks)
+    return TypeEntry(
+        code=type_code,
+        name=preset["name"],
+        tagline=preset["tagline"],
+        axes=axes,
+        tracks=tuple(SampleTrack(**t) for t in raw_tracks),
+        track_titles=tuple(t["title"] for t in raw_tracks),
+        info=info,
+        track_dicts=track_dicts,
+        info_json=_encode(info),
+        tracks_json=_encode(track_dicts),
+    )
+
+
+TYPE_CODES: Tuple[str, ...] = tuple(
+    ("A" if i & 8 else "a") + ("B" if i & 4 else "b") + ("C" if i & 2 else "c") + ("D" if i & 1 else "d")
+    for i in range(16)
+)
+
+CATALOG: Mapping[str, TypeEntry] = MappingProxyType({code: build_entry(code) for code in TYPE_CODES})
+for _entry in CATALOG.values():
+    fast_json.register_fragment(_entry.info, _entry.info_json)
+    fast_json.register_fragment(_entry.track_dicts, _entry.tracks_json)
+
+
+def get(type_code: str) -> TypeEntry:
+    """
+    16タイプなら共有の TypeEntry。未定義コード（壊れたデータ等）はその場で作る。
+    """
+    entry = CATALOG.get(type_code)
+    if entry is None:
+        entry = build_entry(type_code)
+    return entry
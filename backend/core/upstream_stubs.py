@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+STUB_SPOTIFY_USER_ID = "stub_user"
+
+# ベンチマーク用のローカル upstream（iTunes Search と Spotify accounts / Web API の代わり）。
+# レイテンシとエラー率を指定できる。本番コードからは使わない。
+#   iTunes : GET /search
+#   Spotify: POST /api/token（SPOTIFY_ACCOUNTS_BASE）, GET /v1/me, /v1/me/top/tracks, /v1/audio-features
+#            （SPOTIFY_API_BASE は f"{base_url}/v1" にする）
+
+
+def fake_itunes_results(term: str, limit: int) -> Dict[str, Any]:
+    results = []
+    for i in range(limit):
+        tid = 1000000 + (zlib.crc32(f"{term}:{i}".encode("utf-8")) & 0xFFFFFF)
+        results.append(
+            {
+                "trackId": tid,
+                "trackName": f"{term} {i}",
+                "artistName": f"Artist {i % 7}",
+                "artworkUrl100": f"https://is1-ssl.mzstatic.com/image/thumb/Music/v4/{tid}/100x100bb.jpg",
+                "previewUrl": f"https://audio-ssl.itunes.apple.com/itunes-assets/AudioPreview/{tid}.m4a",
+                "trackViewUrl": f"https://music.apple.com/jp/album/{tid}?i={tid}&uo=4",
+            }
+        )
+    return {"resultCount": len(results), "results": results}
+
+
+def _unit(key: str) -> float:
+    return (zlib.crc32(key.encode("utf-8")) & 0xFFFF) / 0xFFFF
+
+
+def fake_spotify_top_tracks(limit: int, time_range: str) -> Dict[str, Any]:
+    # time_range ごとに半分くらい重なるようにして、重複除去も通す
+    offset = {"short_term": 0, "medium_term": limit // 2, "long_term": limit}.get(time_range, 0)
+    items = []
+    for i in range(offset, offset + limit):
+        tid = f"stub{zlib.crc32(f'track:{i}'.encode('utf-8')):08x}"
+        items.append(
+            {
+                "id": tid,
+                "name": f"Stub Track {i}",
+                "popularity": int(_unit(f"pop:{tid}") * 100),
+                "artists": [{"id": f"artist{i % 23}", "name": f"Stub Artist {i % 23}"}],
+            }
+        )
+    return {"items": items, "total": len(items), "limit": limit}
+
+
+def fake_spotify_audio_features(ids: List[str]) -> Dict[str, Any]:
+    feats = []
+    for tid in ids:
+        feats.append(
+            {
+                "id": tid,
+                "energy": _unit(f"energy:{tid}"),
+                "danceability": _unit(f"dance:{tid}"),
+                "tempo": 60.0 + 140.0 * _unit(f"tempo:{tid}"),
+                "valence": _unit(f"valence:{tid}"),
+                "acousticness": _unit(f"acoustic:{tid}"),
+                "instrumentalness": _unit(f"instr:{tid}"),
+            }
+        )
+    return {"audio_features": feats}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+    def _send_json(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        raw = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _delay_or_fail(self) -> bool:
+        """
+        設定どおりに待ち、エラー率に当たったら 503 を返して True。
+        """
+        self.server.count_request()
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if self.server.error_rate > 0 and random.random() < self.server.error_rate:
+            headers = {"Retry-After": self.server.retry_after} if self.server.retry_after else None
+            self._send_json(503, {"error": "stub_error"}, headers)
+            return True
+        return False
+
+    def do_GET(self) -> None:
+        if self._delay_or_fail():
+            return
+
+        parts = urlsplit(self.path)
+        qs = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if parts.path == "/search":
+            self._send_json(200, fake_itunes_results(qs.get("term", ""), int(qs.get("limit", "20"))))
+            return
+        if parts.path == "/v1/me":
+            self._send_json(200, {"id": STUB_SPOTIFY_USER_ID, "display_name": "Stub User"})
+            return
+        if parts.path == "/v1/me/top/tracks":
+            limit = int(qs.get("limit", "20"))
+            self._send_json(200, fake_spotify_top_tracks(limit, qs.get("time_range", "medium_term")))
+            return
+        if parts.path == "/v1/audio-features":
+            ids = [i for i in qs.get("ids", "").split(",") if i]
+            self._send_json(200, fake_spotify_audio_features(ids[:100]))
+            return
+        self._send_json(404, {"error": "not_found"})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+        if self._delay_or_fail():
+            return
+
+        if urlsplit(self.path).path == "/api/token":
+            self.server.count_token()
+            body = {
+                "access_token": f"stub-access-{self.server.tokens_issued}",
+                "token_type": "Bearer",
+                "expires_in": 3600,
+            }
+            if form.get("grant_type") == "authorization_code":
+                body["refresh_token"] = "stub-refresh"
+            self._send_json(200, body)
+            return
+        self._send_json(404, {"error": "not_found"})
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self, latency: float = 0.0, error_rate: float = 0.0, port: int = 0, retry_after: Optional[str] = None
+    ) -> None:
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after  # エラー応答に付ける Retry-After
+        self.requests = 0
+        self.connections = 0  # 受け付けた TCP 接続の数（keep-alive の確認用）
+        self.tokens_issued = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def count_token(self) -> None:
+        with self._lock:
+            self.tokens_issued += 1
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
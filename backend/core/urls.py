@@ -1,10 +1,30 @@
 from django.urls import path
+from . import async_views
+from . import batch_views
+from . import job_views
 from . import track_views
 from . import views
 
 urlpatterns = [
     path("dev/login", views.fake_login),
     path("tracks/search", track_views.tracks_search),
+    path("tracks/search/cache_stats", track_views.tracks_search_cache_stats),
     path("diagnose_from_tracks", track_views.diagnose_from_tracks),
     path("result/<str:username>", views.result_json),
+    path("result/<str:username>/similar", views.result_similar),
+    path("result/<str:username>/percentiles", views.result_percentiles),
+    path("stats/types", views.type_distribution),
+    path("metrics", views.metrics),
+    # 診断をバックグラウンドジョブで（core.jobs）
+    path("diagnose/jobs", job_views.create_job),
+    path("diagnose/jobs/<str:job_id>", job_views.job_status),
+    path("diagnose/jobs/<str:job_id>/events", job_views.job_events),
+    path("diagnose/write_behind/stats", views.write_behind_stats),
+    # 提携先向けのまとめ診断（NDJSON で1件ずつ返す）
+    path("diagnose/batch", batch_views.diagnose_batch),
+    # ASGI 向け async 版（レスポンスは同じ）
+    path("async/tracks/search", async_views.tracks_search),
+    path("async/diagnose_from_tracks", async_views.diagnose_from_tracks),
+    path("async/diagnose", async_views.diagnose),
+    path("async/result/<str:username>", async_views.result_json),
 ]
@@ -3,22 +3,27 @@ from __future__ import annotations
 import os
 import secrets
 import hashlib
-from datetime import datetime, timezone
+from typing import Callable, Optional
 
+from django.conf import settings
 from django.contrib.auth import login
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
 
-from .models import SpotifyAccount, DiagnosisResult
+from . import circuit_breaker, profiling, result_cache, score_stats, similar, type_catalog, write_behind
+from .diagnosis_inputs import store_spotify
+from .fast_json import FastJsonResponse
+from .models import SpotifyAccount, DiagnosisResult, LatestDiagnosis
+from .tokens import get_token_manager
 from .spotify import (
     exchange_code_for_tokens,
-    refresh_access_token,
     get_me,
-    get_top_tracks,
-    get_audio_features,
+    fetch_top_tracks_and_features,
 )
 from .diagnosis import (
     compute_scores,
@@ -71,7 +76,7 @@ def spotify_connect_url(request):
         f"&redirect_uri={redirect_uri}"
         f"&state={state}"
     )
-    return JsonResponse({"auth_url": auth_url})
+    return FastJsonResponse({"auth_url": auth_url})
 
 
 @require_GET
@@ -94,47 +99,57 @@ def spotify_callback(request):
     username = f"sp_{spotify_user_id}"
     display_name = me.get("display_name") or username
 
-    user, _ = User.objects.get_or_create(
-        username=username,
-        defaults={"first_name": display_name},
-    )
-    user.set_unusable_password()
-    user.save()
+    user = _login_user(username, display_name)
 
-    acc, created = SpotifyAccount.objects.get_or_create(
+    # アカウントは INSERT ... ON CONFLICT DO UPDATE の1文で upsert する
+    acc = SpotifyAccount(
+        user=user,
         spotify_user_id=spotify_user_id,
-        defaults={
-            "user": user,
-            "access_token": tokens.access_token,
-            "refresh_token": tokens.refresh_token,
-            "token_expires_at": tokens.expires_at,
-        },
+        access_token=tokens.access_token,
+        refresh_token=tokens.refresh_token,
+        token_expires_at=tokens.expires_at,
+    )
+    update_fields = ["user", "access_token", "token_expires_at", "updated_at"]
+    if tokens.refresh_token:
+        update_fields.append("refresh_token")
+    SpotifyAccount.objects.bulk_create(
+        [acc],
+        update_conflicts=True,
+        unique_fields=["spotify_user_id"],
+        update_fields=update_fields,
     )
 
-    if not created:
-        acc.user = user
-        acc.access_token = tokens.access_token
-        if tokens.refresh_token:
-            acc.refresh_token = tokens.refresh_token
-        acc.token_expires_at = tokens.expires_at
-        acc.save()
-
-    login(request, user)
+    if tokens.refresh_token:
+        get_token_manager().put(acc)
+    else:
+        # refresh_token は DB の既存値のままなので、次に使うときに読み直させる
+        get_token_manager().invalidate(user.pk)
+    _login_once(request, user)
     return redirect(f"{frontend_origin}/diagnosis")
 
 
-def _ensure_fresh_token(acc: SpotifyAccount) -> SpotifyAccount:
-    now = datetime.now(timezone.utc)
-    if acc.token_expires_at <= now:
-        tokens = refresh_access_token(
-            _env("SPOTIFY_CLIENT_ID"),
-            _env("SPOTIFY_CLIENT_SECRET"),
-            acc.refresh_token,
-        )
-        acc.access_token = tokens.access_token
-        acc.token_expires_at = tokens.expires_at
-        acc.save()
-    return acc
+def _login_user(username: str, first_name: str) -> User:
+    """
+    ログイン用ユーザーを取る（無ければ使えないパスワードで作る）。
+    既存ユーザーは書き換えない（パスワードハッシュを毎回変えると他のセッションが無効になる）。
+    """
+    user, created = User.objects.get_or_create(
+        username=username,
+        defaults={"first_name": first_name, "password": make_password(None)},
+    )
+    if not created and user.has_usable_password():
+        user.set_unusable_password()
+        user.save(update_fields=["password"])
+    return user
+
+
+def _login_once(request, user: User) -> None:
+    """
+    既に同じユーザーでログイン済みなら何もしない（セッションの作り直しや last_login の更新をしない）。
+    """
+    if request.user.is_authenticated and request.user.pk == user.pk:
+        return
+    login(request, user)
 
 
 # -------------------------
@@ -143,72 +158,79 @@ def _ensure_fresh_token(acc: SpotifyAccount) -> SpotifyAccount:
 @csrf_exempt
 @require_GET
 def fake_login(request):
-    user, _ = User.objects.get_or_create(
-        username="dev_user",
-        defaults={"first_name": "Dev User"},
-    )
-    user.set_unusable_password()
-    user.save()
-    login(request, user)
-    return JsonResponse({"ok": True, "username": user.username})
+    if request.user.is_authenticated and request.user.username == "dev_user":
+        # ログイン済みならユーザーもセッションも書かない
+        return FastJsonResponse({"ok": True, "username": request.user.username})
+    user = _login_user("dev_user", "Dev User")
+    _login_once(request, user)
+    return FastJsonResponse({"ok": True, "username": user.username})
 
 
 # -------------------------
 # Diagnose (Spotifyが無い時はseedダミーで進める)
 # -------------------------
-@csrf_exempt
-@require_POST
-def diagnose(request):
-    if not request.user.is_authenticated:
-        return JsonResponse({"error": "unauthorized"}, status=401)
+def _noop_progress(percent: int, stage: str) -> None:
+    pass
+
 
+def run_diagnosis(
+    user: User,
+    progress: Callable[[int, str], None] = _noop_progress,
+    save: Optional[Callable[[DiagnosisResult], None]] = None,
+) -> dict:
+    """
+    診断して DiagnosisResult を保存し、レスポンス用 dict を返す。
+    diagnose（同期）とジョブワーカー（core.jobs）の両方から使う。
+    progress(percent, stage) で途中経過を通知する。
+    save を渡すと結果の保存をそれに任せる（既定は write_behind.save_result）。
+    """
+    save = save or write_behind.save_result
     # Spotify未接続（または停止中）は seed でダミー診断
-    try:
-        # ※ related_name が "spotify" の前提
-        acc = request.user.spotify
-        spotify_connected = True
-    except SpotifyAccount.DoesNotExist:
-        spotify_connected = False
-        acc = None
-
-    if not spotify_connected:
-        scores = seeded_scores(request.user.username)
+    # トークンはメモリキャッシュから（期限が近ければ裏で先に更新される）
+    progress(10, "token")
+    access_token = get_token_manager().access_token(user.id)
+
+    if access_token is None:
+        scores = seeded_scores(user.username)
         type_code = scores_to_type_code(scores)
         type_info = describe_type(type_code)
         sample_tracks = pick_sample_tracks_fake(type_code)
-        sample_ids = [t["title"] for t in sample_tracks]  # DBはとりあえずタイトル
-
-        DiagnosisResult.objects.create(
-            user=request.user,
-            energy_score=scores["energy_score"],
-            mood_score=scores["mood_score"],
-            texture_score=scores["texture_score"],
-            explore_score=scores["explore_score"],
-            type_code=type_code,
-            sample_track_ids=sample_ids,
+        sample_ids = list(type_catalog.get(type_code).track_titles)  # DBはとりあえずタイトル
+
+        progress(90, "saving")
+        save(
+            DiagnosisResult(
+                user=user,
+                energy_score=scores["energy_score"],
+                mood_score=scores["mood_score"],
+                texture_score=scores["texture_score"],
+                explore_score=scores["explore_score"],
+                type_code=type_code,
+                sample_track_ids=sample_ids,
+            )
         )
 
-        return JsonResponse(
-            {
-                "username": request.user.username,
-                "type_code": type_code,
-                "type_info": type_info,
-                "scores": scores,
-                "sample_track_ids": sample_ids,
-                "sample_tracks": sample_tracks,
-                "result_path": f"/result/{request.user.username}",
-            }
-        )
+        return {
+            "username": user.username,
+            "type_code": type_code,
+            "type_info": type_info,
+            "scores": scores,
+            "sample_track_ids": sample_ids,
+            "sample_tracks": sample_tracks,
+            "result_path": f"/result/{user.username}",
+        }
 
     # --- ここからSpotify本番（復活したら自動で使われる） ---
-    acc = _ensure_fresh_token(acc)
-
-    top = get_top_tracks(acc.access_token, limit=50, time_range="medium_term")
-    items = top.get("items", [])
-    track_ids = [t["id"] for t in items if t.get("id")]
-
-    feats = get_audio_features(acc.access_token, track_ids).get("audio_features", [])
+    # 複数 time_range の top_tracks と audio_features（100件ずつ）を並列に取る
+    progress(20, "fetching")
+    items, feats = fetch_top_tracks_and_features(
+        access_token,
+        time_ranges=settings.SPOTIFY_TOP_TIME_RANGES,
+        limit=50,
+        max_workers=settings.SPOTIFY_FETCH_WORKERS,
+    )
 
+    progress(70, "scoring")
     scores = compute_scores(items, feats)
     type_code = scores_to_type_code(scores)
     type_info = describe_type(type_code)
@@ -216,28 +238,39 @@ def diagnose(request):
     # sample_track_ids は Spotify の track id
     sample_ids = pick_sample_tracks(items, feats, type_code)
 
-    DiagnosisResult.objects.create(
-        user=request.user,
-        energy_score=scores["energy_score"],
-        mood_score=scores["mood_score"],
-        texture_score=scores["texture_score"],
-        explore_score=scores["explore_score"],
-        type_code=type_code,
-        sample_track_ids=sample_ids,
+    progress(90, "saving")
+    save(
+        DiagnosisResult(
+            user=user,
+            input=store_spotify(items, feats),
+            energy_score=scores["energy_score"],
+            mood_score=scores["mood_score"],
+            texture_score=scores["texture_score"],
+            explore_score=scores["explore_score"],
+            type_code=type_code,
+            sample_track_ids=sample_ids,
+        )
     )
 
     # ここでは “曲詳細” までは返さない（将来拡張）
-    return JsonResponse(
-        {
-            "username": request.user.username,
-            "type_code": type_code,
-            "type_info": type_info,
-            "scores": scores,
-            "sample_track_ids": sample_ids,
-            "sample_tracks": [],  # 後で Spotify track detail を引いて埋められる
-            "result_path": f"/result/{request.user.username}",
-        }
-    )
+    return {
+        "username": user.username,
+        "type_code": type_code,
+        "type_info": type_info,
+        "scores": scores,
+        "sample_track_ids": sample_ids,
+        "sample_tracks": [],  # 後で Spotify track detail を引いて埋められる
+        "result_path": f"/result/{user.username}",
+    }
+
+
+@csrf_exempt
+@require_POST
+def diagnose(request):
+    if not request.user.is_authenticated:
+        return FastJsonResponse({"error": "unauthorized"}, status=401)
+
+    return FastJsonResponse(run_diagnosis(request.user))
 
 
 # -------------------------
@@ -245,28 +278,123 @@ def diagnose(request):
 # -------------------------
 @require_GET
 def result_json(request, username: str):
-    user = User.objects.filter(username=username).first()
-    if not user:
-        return JsonResponse({"error": "not_found"}, status=404)
+    # レンダリング済みレスポンスがキャッシュにあればDBに触らない（ETag/304 対応）
+    entry = result_cache.get_entry(username)
+    if entry is None:
+        if not User.objects.filter(username=username).exists():
+            return FastJsonResponse({"error": "not_found"}, status=404)
+        return FastJsonResponse({"error": "no_result"}, status=404)
+    return result_cache.respond(request, entry)
 
-    latest = user.diagnoses.order_by("-computed_at").first()
-    if not latest:
-        return JsonResponse({"error": "no_result"}, status=404)
 
-    return JsonResponse(
+@require_GET
+def result_similar(request, username: str):
+    """
+    スコアが近いユーザー（音楽の双子）を近い順に返す。?k= で件数（最大 SIMILAR_INDEX.MAX_K）。
+    """
+    conf = getattr(settings, "SIMILAR_INDEX", {})
+    try:
+        k = int(request.GET.get("k", conf.get("DEFAULT_K", 10)))
+    except ValueError:
+        return HttpResponseBadRequest("k must be int")
+    k = max(1, min(k, conf.get("MAX_K", 50)))
+
+    neighbors = similar.get_index().nearest(username, k)
+    if neighbors is None:
+        if not User.objects.filter(username=username).exists():
+            return FastJsonResponse({"error": "not_found"}, status=404)
+        return FastJsonResponse({"error": "no_result"}, status=404)
+
+    return FastJsonResponse(
         {
-            "username": user.username,
-            "display_name": user.first_name or user.username,
-            "computed_at": latest.computed_at.isoformat(),
-            "type_code": latest.type_code,
-            "type_info": describe_type(latest.type_code),
-            "scores": {
-                "energy": latest.energy_score,
-                "mood": latest.mood_score,
-                "texture": latest.texture_score,
-                "explore": latest.explore_score,
-            },
-            "sample_track_ids": latest.sample_track_ids,
-            "sample_tracks": pick_sample_tracks_fake(latest.type_code),
+            "username": username,
+            "similar": [
+                {
+                    "username": n.username,
+                    "type_code": n.type_code,
+                    "scores": dict(zip(("energy", "mood", "texture", "explore"), n.scores)),
+                    "distance": round(n.distance, 6),
+                    "result_path": f"/result/{n.username}",
+                }
+                for n in neighbors
+            ],
         }
     )
+
+
+@require_GET
+def result_percentiles(request, username: str):
+    """
+    各スコアが全ユーザー（それぞれの最新結果）の何%より高いか。分布は core.score_stats から O(1) で引く。
+    """
+    scores = (
+        LatestDiagnosis.objects.filter(user__username=username)
+        .values_list(*[f"result__{f}" for f in score_stats.SCORE_FIELDS], "result__type_code")
+        .first()
+    )
+    if scores is None:
+        if not User.objects.filter(username=username).exists():
+            return FastJsonResponse({"error": "not_found"}, status=404)
+        return FastJsonResponse({"error": "no_result"}, status=404)
+
+    hist = score_stats.get_store().snapshot()
+    total = hist.total
+    type_code = scores[4]
+    response = FastJsonResponse(
+        {
+            "username": username,
+            "total_users": total,
+            "percentiles": hist.percentiles(scores[:4]),
+            "type_code": type_code,
+            "type_share": round(100.0 * hist.type_counts().get(type_code, 0) / total, 1) if total else 0.0,
+        }
+    )
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+@require_GET
+def type_distribution(request):
+    """
+    タイプ（type_code）ごとの人数と割合。
+    """
+    hist = score_stats.get_store().snapshot()
+    total = hist.total
+    response = FastJsonResponse(
+        {
+            "total_users": total,
+            "types": [
+                {
+                    "type_code": code,
+                    "name": describe_type(code)["name"],
+                    "count": n,
+                    "share": round(100.0 * n / total, 1) if total else 0.0,
+                }
+                for code, n in hist.type_counts().items()
+            ],
+        }
+    )
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+@require_GET
+def metrics(request):
+    """
+    GET /api/metrics
+    -> エンドポイントごとの所要時間ヒストグラムなど（Prometheus text format）。ローカルからのみ。
+    """
+    allowed = profiling._conf()["METRICS_ALLOWED_IPS"]
+    if request.META.get("REMOTE_ADDR") not in allowed:
+        return FastJsonResponse({"error": "forbidden"}, status=403)
+    body = profiling.get_metrics().render() + "\n".join(circuit_breaker.render_metrics()) + "\n"
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@require_GET
+def write_behind_stats(request):
+    """
+    GET /api/diagnose/write_behind/stats
+    -> { enabled, pending, flushes, rows_flushed, flush_size, lag_ms, ... }
+    """
+    return FastJsonResponse(write_behind.stats())
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import logging
+import threading
+
+# プロセス起動時（config.wsgi / config.asgi）にメモリ内の索引を作っておく。
+# 最初のリクエストが DB からの構築を待たないよう、バックグラウンドのスレッドで作る。
+# 作り終わるまでの間、曲検索は upstream に任せ、近傍検索は構築の完了を待つ。
+# 診断ジョブ（local モード）の積み直しもここで行う（前のプロセスで失われたキューの分）。
+# manage.py のコマンドでは呼ばれない。
+
+logger = logging.getLogger(__name__)
+
+
+def _build() -> None:
+    from . import jobs, similar, track_catalog
+
+    try:
+        conf = track_catalog._conf()
+        if conf["ENABLED"] and conf["BUILD_AT_STARTUP"]:
+            track_catalog.get_catalog()
+    except Exception:
+        logger.exception("warm-up: failed to build the track catalog")
+    try:
+        if similar._conf()["BUILD_AT_STARTUP"]:
+            similar.get_index()
+    except Exception:
+        logger.exception("warm-up: failed to build the similarity index")
+    try:
+        if jobs._conf()["SWEEP_AT_STARTUP"]:
+            n = jobs.sweep()
+            if n:
+                logger.info("warm-up: resubmitted %d diagnosis jobs", n)
+    except Exception:
+        logger.exception("warm-up: failed to sweep diagnosis jobs")
+
+
+def _run() -> None:
+    from django.db import connections
+
+    try:
+        _build()
+    finally:
+        connections.close_all()  # このスレッドの接続だけ閉じる
+
+
+def warm_up(background: bool = True) -> None:
+    if not background:
+        _build()
+        return
+    threading.Thread(target=_run, name="warm-up", daemon=True).start()
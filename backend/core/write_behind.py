@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import DiagnosisResult, LatestDiagnosis
+
+# DiagnosisResult の write-behind（まとめ書き）。
+# 保存を待たずにメモリに積み、MAX_ROWS 件たまるか最古が MAX_DELAY_MS 経ったら
+# バックグラウンドスレッドが bulk_create + LatestDiagnosis.point_to を1トランザクションで書く。
+# - 書き込み前でも結果ページは読める（result_cache.get_entry が pending_for() を先に見る）
+# - プロセス終了時（atexit）に残りを書く
+# - 溜まりすぎ（MAX_PENDING）のときはその場で同期保存する
+# - まとめ書きが失敗したら1件ずつ書き直し、その行自体が書けない（IntegrityError / DataError / ValueError。
+#   ユーザーが消えた・値が壊れている等）ものはログに出して捨てる（DEAD_LETTERS 件まで dead_letters に残す）。
+#   それ以外の失敗（DB に繋がらない等）は書けていない分を queue に戻して次の周回でやり直す
+# - 書き込み前に読めるのは積んだプロセスの中だけ（他のワーカーからは flush まで前の結果が見える）
+# WRITE_BEHIND.ENABLED が False なら save_result() はこれまで通り save() するだけ。
+
+logger = logging.getLogger(__name__)
+
+# 1件で書き直しても失敗したら、その行のせい（やり直しても書けない）とみなす例外
+_BAD_ROW_ERRORS = (IntegrityError, DataError, ValueError)
+
+
+def _conf() -> dict:
+    conf = {"ENABLED": False, "MAX_ROWS": 200, "MAX_DELAY_MS": 50, "MAX_PENDING": 10_000, "DEAD_LETTERS": 100}
+    conf.update(getattr(settings, "WRITE_BEHIND", {}))
+    return conf
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        max_rows: int = 200,
+        max_delay_ms: float = 50,
+        max_pending: int = 10_000,
+        dead_letters: int = 100,
+        start: bool = True,
+    ) -> None:
+        self.max_rows = max(1, int(max_rows))
+        self.max_delay = max(0.0, float(max_delay_ms)) / 1000.0
+        self.max_pending = max(1, int(max_pending))
+        self._queue: Deque[Tuple[float, DiagnosisResult]] = deque()
+        self._latest: Dict[str, DiagnosisResult] = {}  # username -> まだ書いていない最新結果
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # 書き込みは1本ずつ（close() とスレッドが重ならないように）
+        self._closed = False
+
+        # metrics
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.flush_errors = 0
+        self.sync_fallbacks = 0
+        self.rows_dropped = 0
+        self.dead_letters: Deque[Dict[str, Any]] = deque(maxlen=max(0, int(dead_letters)))
+        self._sizes: Deque[int] = deque(maxlen=1000)
+        self._lags: Deque[float] = deque(maxlen=1000)  # 積んでからコミットまで（秒）
+
+        self._thread: Optional[threading.Thread] = None
+        if start:
+            self._thread = threading.Thread(target=self._loop, name="diagnosis-write-behind", daemon=True)
+            self._thread.start()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    # -------------------------
+    # producer side
+    # -------------------------
+    def offer(self, result: DiagnosisResult) -> bool:
+        """
+        未保存の result を積む（result.user はロード済みであること）。満杯・停止後なら積まずに False。
+        computed_at は書き込み前の表示用に入れておく（bulk_create で書いた時刻に付け直される）。
+        """
+        result.computed_at = timezone.now()
+        with self._cond:
+            if self._closed or len(self._queue) >= self.max_pending:
+                self.sync_fallbacks += 1
+                return False
+            self._queue.append((time.monotonic(), result))
+            self._latest[result.user.username] = result
+            if len(self._queue) >= self.max_rows:
+                self._cond.notify()
+            return True
+
+    def submit(self, result: DiagnosisResult) -> None:
+        """
+        積めなければその場で save() する。
+        """
+        if not self.offer(result):
+            result.save()
+
+    def pending_for(self, username: str) -> Optional[DiagnosisResult]:
+        with self._cond:
+            return self._latest.get(username)
+
+    # -------------------------
+    # flusher side
+    # -------------------------
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._queue) >= self.max_rows:
+                        break
+                    if self._queue:
+                        wait = self._queue[0][0] + self.max_delay - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # 失敗した分は queue に戻してあるので、少し待って次の周回でやり直す
+                time.sleep(min(1.0, max(self.max_delay, 0.05)))
+            finally:
+                close_old_connections()
+
+    def flush(self) -> int:
+        """
+        積んである分を MAX_ROWS 件ずつ書く。書いた件数を返す。
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    n = min(self.max_rows, len(self._queue))
+                    batch = [self._queue.popleft() for _ in range(n)]
+                if not batch:
+                    return written
+                try:
+                    _write([r for _, r in batch])
+                    done = batch
+                except Exception:
+                    with self._cond:
+                        self.flush_errors += 1
+                    done = self._write_one_by_one(batch)
+                self._finished(done)
+                written += len(done)
+
+    def _write_one_by_one(self, batch: List[Tuple[float, DiagnosisResult]]) -> List[Tuple[float, DiagnosisResult]]:
+        """
+        まとめ書きが失敗した batch を1件ずつ書く。書けた分を返す。
+        その行のせいで書けないものは捨て、それ以外の失敗なら残りを queue に戻して raise する。
+        """
+        done = []
+        for i, (t, r) in enumerate(batch):
+            try:
+                _write([r])
+            except _BAD_ROW_ERRORS as e:
+                self._drop(r, e)
+            except Exception:
+                rest = batch[i:]
+                for _, row in rest:
+                    _unsave(row)
+                with self._cond:
+                    self._queue.extendleft(reversed(rest))
+                self._finished(done)
+                raise
+            else:
+                done.append((t, r))
+        return done
+
+    def _drop(self, result: DiagnosisResult, error: Exception) -> None:
+        username = result.user.username
+        logger.error("write-behind: dropped result for %s: %r", username, error)
+        with self._cond:
+            if self._latest.get(username) is result:
+                del self._latest[username]
+            self.rows_dropped += 1
+            self.dead_letters.append(
+                {
+                    "username": username,
+                    "user_id": result.user_id,
+                    "type_code": result.type_code,
+                    "error": repr(error),
+                    "at": time.time(),
+                }
+            )
+
+    def _finished(self, batch: List[Tuple[float, DiagnosisResult]]) -> None:
+        if not batch:
+            return
+        done = time.monotonic()
+        with self._cond:
+            for _, r in batch:
+                name = r.user.username
+                if self._latest.get(name) is r:
+                    del self._latest[name]
+            self.flushes += 1
+            self.rows_flushed += len(batch)
+            self._sizes.append(len(batch))
+            self._lags.extend(done - t for t, _ in batch)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """
+        スレッドを止めて、残りを書いてから戻る（atexit から呼ばれる）。
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        try:
+            self.flush()
+        finally:
+            close_old_connections()
+
+    # -------------------------
+    # metrics
+    # -------------------------
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            sizes = sorted(self._sizes)
+            lags = sorted(self._lags)
+            oldest = time.monotonic() - self._queue[0][0] if self._queue else 0.0
+            out: Dict[str, Any] = {
+                "pending": len(self._queue),
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+                "flush_errors": self.flush_errors,
+                "sync_fallbacks": self.sync_fallbacks,
+                "rows_dropped": self.rows_dropped,
+                "oldest_pending_ms": round(oldest * 1000, 1),
+                "dead_letters": list(self.dead_letters),
+            }
+        out["flush_size"] = {
+            "mean": round(sum(sizes) / len(sizes), 1) if sizes else 0.0,
+            "p50": _pct(sizes, 0.5),
+            "max": sizes[-1] if sizes else 0,
+        }
+        out["lag_ms"] = {
+            "p50": round(_pct(lags, 0.5) * 1000, 1),
+            "p99": round(_pct(lags, 0.99) * 1000, 1),
+            "max": round(lags[-1] * 1000, 1) if lags else 0.0,
+        }
+        return out
+
+
+def _unsave(result: DiagnosisResult) -> None:
+    # ロールバックされた bulk_create が付けた pk を外して、もう一度 insert できるようにする
+    result.pk = None
+    result._state.adding = True
+
+
+def _write(rows: List[DiagnosisResult]) -> None:
+    try:
+        with transaction.atomic():
+            DiagnosisResult.objects.bulk_create(rows)
+            LatestDiagnosis.point_to(rows)
+    except Exception:
+        for r in rows:
+            _unsave(r)
+        raise
+
+
+def _pct(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+_buffer: Optional[WriteBehindBuffer] = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer() -> Optional[WriteBehindBuffer]:
+    """
+    WRITE_BEHIND.ENABLED なら共有バッファ（初回に作ってスレッドを起こし、atexit で flush）。無効なら None。
+    """
+    global _buffer
+    if _buffer is None:
+        conf = _conf()
+        if not conf["ENABLED"]:
+            return None
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(
+                    max_rows=conf["MAX_ROWS"],
+                    max_delay_ms=conf["MAX_DELAY_MS"],
+                    max_pending=conf["MAX_PENDING"],
+                    dead_letters=conf["DEAD_LETTERS"],
+                )
+                atexit.register(_buffer.close)
+    return _buffer
+
+
+def save_result(result: DiagnosisResult) -> None:
+    buf = get_buffer()
+    if buf is None:
+        result.save()
+    else:
+        buf.submit(result)
+
+
+async def asave_result(result: DiagnosisResult) -> None:
+    buf = get_buffer()
+    if buf is None or not buf.offer(result):
+        await result.asave()
+
+
+def set_buffer(buf: Optional[WriteBehindBuffer]) -> None:
+    """
+    共有バッファを差し替える（テスト用）。前のバッファは残りを書いてから止める。
+    """
+    global _buffer
+    with _buffer_lock:
+        old, _buffer = _buffer, buf
+    if old is not None and old is not buf:
+        old.close()
+
+
+def pending_for(username: str) -> Optional[DiagnosisResult]:
+    buf = _buffer
+    return buf.pending_for(username) if buf is not None else None
+
+
+def stats() -> Dict[str, Any]:
+    buf = get_buffer()
+    if buf is None:
+        return {"enabled": False}
+    return {"enabled": True, **buf.stats()}